@@ -0,0 +1,98 @@
+"""
+Compare benchmark results with a baseline, and fail on regressions
+
+Rows are matched by their title, size and concurrency (and engine, document and op for the results
+of util/sizebench.py). A row regresses when its rate drops, or one of its latency percentiles rises,
+by more than the tolerance. Latencies that stay below the floor are never regressions, so that
+jitter on very fast commands doesn't fail the comparison.
+
+Usage: python3 compare.py baseline.csv benchmark.csv
+"""
+
+import argparse
+import sys
+from collections import defaultdict
+
+import results
+
+# The latency columns checked, with their option names
+LATENCIES = [
+    ('p50', '50.00%-tile'),
+    ('p99', '99.00%-tile'),
+    ('p100', '100.00%-tile'),
+]
+
+
+def change(baseline, current):
+    return (current - baseline) / baseline * 100 if baseline else 0.0
+
+
+def compare(baseline, current, args):
+    """Returns the table of compared values, and the number of regressions"""
+    table = []
+    regressions = 0
+    # Rows with the same key, as in results without sizes, are matched in order
+    rows = defaultdict(list)
+    for row in reversed(current):
+        rows[results.key(row)].append(row)
+    for base in baseline:
+        name = ' '.join(str(column) for column in results.key(base))
+        same = rows[results.key(base)]
+        row = same.pop() if same else None
+        if row is None:
+            failed = not args.allow_missing
+            regressions += failed
+            table.append((name, '-', '', '', '', 'MISSING' if failed else 'missing'))
+            continue
+
+        pct = change(base['rate'], row['rate'])
+        failed = pct < -args.rate
+        regressions += failed
+        table.append((name, 'rate', base['rate'], row['rate'], pct, 'REGRESSION' if failed else 'ok'))
+
+        for option, column in LATENCIES:
+            if column not in base or column not in row:
+                continue
+            pct = change(base[column], row[column])
+            failed = pct > getattr(args, option) and row[column] > args.floor
+            regressions += failed
+            table.append((name, option, base[column], row[column], pct,
+                          'REGRESSION' if failed else 'ok'))
+    return table, regressions
+
+
+def print_table(table, all_rows):
+    print('{:<60} {:>6} {:>12} {:>12} {:>9}  {}'.format(
+        'row', 'metric', 'baseline', 'current', 'change', 'status'))
+    for name, metric, base, current, pct, status in table:
+        if not all_rows and status in ('ok', 'missing'):
+            continue
+        if metric == '-':
+            print('{:<60} {:>6} {:>12} {:>12} {:>9}  {}'.format(name[:60], metric, '', '', '', status))
+        else:
+            print('{:<60} {:>6} {:>12.2f} {:>12.2f} {:>+8.1f}%  {}'.format(
+                name[:60], metric, base, current, pct, status))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ReJSON benchmark regression check',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('baseline', help='CSV results of the baseline')
+    parser.add_argument('current', help='CSV results to check')
+    parser.add_argument('--rate', type=float, default=5, help='tolerated rate drop in percent')
+    parser.add_argument('--p50', type=float, default=10, help='tolerated p50 latency rise in percent')
+    parser.add_argument('--p99', type=float, default=20, help='tolerated p99 latency rise in percent')
+    parser.add_argument('--p100', type=float, default=50, help='tolerated max latency rise in percent')
+    parser.add_argument('--floor', type=float, default=0.05,
+                        help='latency in milliseconds below which rises are tolerated')
+    parser.add_argument('--allow-missing', action='store_true',
+                        help="don't fail on baseline rows missing from the results")
+    parser.add_argument('-a', '--all', action='store_true', help='print the rows that pass too')
+    args = parser.parse_args()
+
+    table, regressions = compare(results.read(args.baseline), results.read(args.current), args)
+    print_table(table, args.all)
+    if regressions:
+        print('\n{} regression(s)'.format(regressions))
+        sys.exit(1)
+    print('\nNo regressions')
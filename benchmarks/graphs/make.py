@@ -1,53 +1,86 @@
 """
 Make charts from ReJSONBenchmark's output
+
+For each operation (set and get, at the root or at a path), one chart of the rate by value size
+and one of the latency percentiles by value size, with a line per engine for the results of
+util/sizebench.py.
+
+Usage: python3 make.py [benchmark.csv] [-o output-directory]
 """
 
+import argparse
+import os
+from collections import defaultdict
+
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-import numpy as np
 
-data = np.genfromtxt('benchmark.csv', delimiter=',', names=True, dtype=None)
+import results
+
+PERCENTILES = ['50.00%-tile', '90.00%-tile', '99.00%-tile', '100.00%-tile']
 
-# Each JSON value has 4 operations: set root, get root, set path, get path
-NOP = 4
 
-# The number of JSON values
-N = int(len(data) / NOP)
+def series(rows, x):
+    """The rows of each operation, by engine, sorted by `x`"""
+    ops = defaultdict(lambda: defaultdict(list))
+    for row in rows:
+        ops[results.op(row)][row.get('engine', 'module')].append(row)
+    for engines in ops.values():
+        for engine_rows in engines.values():
+            engine_rows.sort(key=lambda row: row[x])
+    return ops
 
-# The x locations
-ind = np.arange(N)
 
-# The bars' width
-width = (1 - .3) / NOP
+def filename(*parts):
+    return '_'.join(parts).replace(' ', '_').replace('%', '').replace('.', '') + '.png'
 
-colors = ['r','g','b','y']
 
-fig, ax = plt.subplots()
+def rate_chart(op, engines, x, output):
+    fig, ax = plt.subplots()
+    for engine, rows in sorted(engines.items()):
+        ax.plot([row[x] for row in rows], [row['rate'] for row in rows], marker='o', label=engine)
+    ax.set_xscale('log')
+    ax.set_xlabel('Value size (bytes)' if x == 'size' else 'Concurrency')
+    ax.set_ylabel('Rate (op/s)')
+    ax.set_title('{} rate'.format(op))
+    ax.grid(True)
+    ax.legend()
+    fig.savefig(os.path.join(output, filename('rate', op)))
+    plt.close(fig)
 
-# Iterate each operation
-for oidx in range(NOP):
-    d = data[oidx::NOP]
-    # ax1 = ax[oidx]
 
-    # plt.subplot(NOP,1,oidx+1)
+def latency_chart(op, engine, rows, x, output):
+    fig, ax = plt.subplots()
+    for percentile in PERCENTILES:
+        ax.plot([row[x] for row in rows], [row[percentile] for row in rows], marker='o',
+                label=percentile)
+    ax.set_xscale('log')
+    ax.set_yscale('log')
+    ax.set_xlabel('Value size (bytes)' if x == 'size' else 'Concurrency')
+    ax.set_ylabel('Latency (msec)')
+    ax.set_title('{} latency ({})'.format(op, engine))
+    ax.grid(True)
+    ax.legend()
+    fig.savefig(os.path.join(output, filename('latency', op, engine)))
+    plt.close(fig)
 
-    # Plot the rate as bars
-    plt.bar(ind+oidx*width, d['rate'], width, align='center', color=colors[oidx])
 
-    # Plot the latency as line
-    # tax = plt.twinx()
-    # tax.set_yscale('log')
-    # tax.plot(ind, d['avgLatency'], color='r')
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ReJSON benchmark charts')
+    parser.add_argument('results', nargs='?', default='benchmark.csv', help='CSV results')
+    parser.add_argument('-o', '--output', default='.', help='directory of the charts')
+    args = parser.parse_args()
 
-    # plt.title('{} rate and average latency'.format(d['title'][0]))
-    # ax1.set_ylabel('Rate (op/s)', color='b')
-    # ax1.set_xlabel('Object size (bytes)')
-    # for t in ax1.get_yticklabels():
-    #     t.set_color('b')
-    # ax2.set_ylabel('Average latency (msec)', color='r')
-    # for t in ax2.get_yticklabels():
-    #     t.set_color('r')
-    # plt.xticks(ind, d['size']) 
+    rows = results.read(args.results)
+    # Results without sizes, such as standard.csv, are charted by concurrency
+    x = 'size' if rows and 'size' in rows[0] else 'concurrency'
+    if x == 'concurrency':
+        for row in rows:
+            row[x] = int(row[x])
 
-plt.grid(True)
-plt.xticks(ind + width, d['size'])
-plt.show()
+    os.makedirs(args.output, exist_ok=True)
+    for op, engines in sorted(series(rows, x).items()):
+        rate_chart(op, engines, x, args.output)
+        for engine, engine_rows in sorted(engines.items()):
+            latency_chart(op, engine, engine_rows, x, args.output)
@@ -0,0 +1,47 @@
+"""
+Reading the CSV results of util/benchmark.py and util/sizebench.py
+"""
+
+import csv
+
+# Older results name some columns differently
+ALIASES = {
+    'average latency': 'avgLatency',
+}
+
+# The columns that identify a row, when present
+KEY_COLUMNS = ['engine', 'document', 'op', 'title', 'size', 'concurrency']
+
+METRICS = ['rate', 'avgLatency', '50.00%-tile', '90.00%-tile', '95.00%-tile', '99.00%-tile',
+           '99.50%-tile', '100.00%-tile']
+
+
+def read(path):
+    """The rows of a results file, as dicts with the metrics and the size as numbers"""
+    rows = []
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            row = {ALIASES.get(name, name): value for name, value in row.items()}
+            for name in METRICS:
+                if name in row:
+                    row[name] = float(row[name])
+            if 'size' in row:
+                row['size'] = int(row['size'])
+            rows.append(row)
+    return rows
+
+
+def key(row):
+    """The columns that identify a row, as a tuple"""
+    return tuple(row[name] for name in KEY_COLUMNS if name in row)
+
+
+def op(row):
+    """The operation of a row: set or get, at the root or at a path"""
+    if 'op' in row:
+        return row['op']
+    words = row['title'].split()
+    command = words[0].split('.')[-1].lower()
+    if command not in ('set', 'get'):
+        return words[0]
+    return '{} {}'.format(command, 'root' if len(words) < 3 or words[2] == '.' else 'path')
@@ -0,0 +1,447 @@
+use std::ffi::CStr;
+use std::os::raw::{c_char, c_int, c_void};
+use std::slice;
+use std::time::{Duration, SystemTime, UNIX_EPOCH};
+
+use redis_module::{raw, Context, NextArg, RedisError, RedisResult, RedisValue};
+
+use crate::commands::sindex;
+use crate::first_match::{self, Step};
+use crate::redisjson::RedisJSON;
+use crate::replication::replicate;
+use crate::{backwards_compat_path, REDIS_JSON_TYPE};
+
+/// How often the expiry cycle runs when there's no backlog of expired paths
+const EXPIRE_CYCLE_MS: u64 = 100;
+
+/// Upper bound on the number of paths deleted in one expiry cycle
+const EXPIRE_CYCLE_BATCH: usize = 1000;
+
+pub mod expire_map {
+    use crate::timer_wheel::TimerWheel;
+    use std::collections::HashMap;
+
+    #[derive(Debug, Clone)]
+    pub struct PathExpiry {
+        pub db: i32,
+        pub key: String,
+        pub path: String,
+    }
+
+    pub struct ExpireMap {
+        pub wheel: TimerWheel<PathExpiry>,
+        // (db, key) -> path -> deadline, the source of truth for the wheel's entries.
+        // Wheel entries that don't match are stale and are dropped when they fire.
+        deadlines: HashMap<(i32, String), HashMap<String, u64>>,
+        // Whether the last expiry cycle ran on a master, to notice promotions
+        pub was_master: bool,
+        // The key a RENAME or MOVE is taking the expiries from, until the event of its target
+        pub moving: Option<(i32, String)>,
+    }
+
+    /// A static map, like `schema_map`, since it is shared by the commands and the expiry timer.
+    /// The init function should be called before any other function in this module.
+    static mut EXPIRE_MAP: Option<ExpireMap> = None;
+
+    pub fn init(now: u64) {
+        let map = ExpireMap {
+            wheel: TimerWheel::new(now),
+            deadlines: HashMap::new(),
+            was_master: true,
+            moving: None,
+        };
+        unsafe {
+            EXPIRE_MAP = Some(map);
+        }
+    }
+
+    pub fn as_mut() -> &'static mut ExpireMap {
+        unsafe { EXPIRE_MAP.as_mut() }.unwrap()
+    }
+
+    fn is_same_or_descendant(path: &str, ancestor: &str) -> bool {
+        path.starts_with(ancestor)
+            && match path.as_bytes().get(ancestor.len()) {
+                None | Some(b'.') | Some(b'[') => true,
+                _ => false,
+            }
+    }
+
+    impl ExpireMap {
+        pub fn set(&mut self, db: i32, key: &str, path: &str, deadline: u64) {
+            self.deadlines
+                .entry((db, key.to_owned()))
+                .or_insert_with(HashMap::new)
+                .insert(path.to_owned(), deadline);
+            self.wheel.insert(
+                deadline,
+                PathExpiry {
+                    db,
+                    key: key.to_owned(),
+                    path: path.to_owned(),
+                },
+            );
+        }
+
+        pub fn get(&self, db: i32, key: &str, path: &str) -> Option<u64> {
+            self.deadlines
+                .get(&(db, key.to_owned()))
+                .and_then(|paths| paths.get(path))
+                .copied()
+        }
+
+        ///
+        /// Drops the expiry of `path` and of everything below it
+        ///
+        pub fn clear(&mut self, db: i32, key: &str, path: &str) {
+            let id = (db, key.to_owned());
+            if let Some(paths) = self.deadlines.get_mut(&id) {
+                paths.retain(|p, _| !is_same_or_descendant(p, path));
+                if paths.is_empty() {
+                    self.deadlines.remove(&id);
+                }
+            }
+        }
+
+        ///
+        /// Drops the expiries of every path of `key`, after it was deleted or overwritten
+        ///
+        pub fn clear_key(&mut self, db: i32, key: &str) {
+            self.deadlines.remove(&(db, key.to_owned()));
+        }
+
+        ///
+        /// Drops the expiries of database `db`, or of all of them
+        ///
+        pub fn clear_db(&mut self, db: Option<i32>) {
+            match db {
+                Some(db) => self.deadlines.retain(|(key_db, _), _| *key_db != db),
+                None => self.deadlines.clear(),
+            }
+        }
+
+        ///
+        /// Moves the expiries of a key that was renamed or moved to another database, replacing
+        /// those of the key it overwrote
+        ///
+        pub fn rename(&mut self, from_db: i32, from: &str, to_db: i32, to: &str) {
+            self.clear_key(to_db, to);
+            if let Some(paths) = self.deadlines.remove(&(from_db, from.to_owned())) {
+                for (path, deadline) in paths {
+                    self.set(to_db, to, &path, deadline);
+                }
+            }
+        }
+
+        ///
+        /// Puts every expiry back in a new wheel, once a replica that dropped the entries of the
+        /// wheel is promoted and has to expire the paths itself
+        ///
+        pub fn rearm(&mut self, now: u64) {
+            let mut wheel = TimerWheel::new(now);
+            for ((db, key), paths) in &self.deadlines {
+                for (path, deadline) in paths {
+                    wheel.insert(
+                        *deadline,
+                        PathExpiry {
+                            db: *db,
+                            key: key.clone(),
+                            path: path.clone(),
+                        },
+                    );
+                }
+            }
+            self.wheel = wheel;
+        }
+
+        ///
+        /// Checks that a fired wheel entry is still current, and if so removes it
+        ///
+        pub fn take_due(&mut self, expiry: &PathExpiry, deadline: u64) -> bool {
+            if self.get(expiry.db, &expiry.key, &expiry.path) == Some(deadline) {
+                self.clear(expiry.db, &expiry.key, &expiry.path);
+                true
+            } else {
+                false
+            }
+        }
+
+        pub fn iter(&self) -> impl Iterator<Item = (i32, &String, &String, u64)> {
+            self.deadlines.iter().flat_map(|((db, key), paths)| {
+                paths
+                    .iter()
+                    .map(move |(path, deadline)| (*db, key, path, *deadline))
+            })
+        }
+
+        pub fn len(&self) -> usize {
+            self.deadlines.values().map(|paths| paths.len()).sum()
+        }
+
+        pub fn is_empty(&self) -> bool {
+            self.deadlines.is_empty()
+        }
+    }
+}
+
+pub fn now_millis() -> u64 {
+    SystemTime::now()
+        .duration_since(UNIX_EPOCH)
+        .map_or(0, |d| d.as_millis() as u64)
+}
+
+pub fn selected_db(ctx: &Context) -> i32 {
+    unsafe { raw::RedisModule_GetSelectedDb.unwrap()(ctx.ctx) }
+}
+
+///
+/// Selects database `db`, returns whether it exists
+///
+pub fn select_db(ctx: &Context, db: i32) -> bool {
+    unsafe { raw::RedisModule_SelectDb.unwrap()(ctx.ctx, db) == raw::REDISMODULE_OK as c_int }
+}
+
+fn is_master(ctx: &Context) -> bool {
+    let flags = unsafe { raw::RedisModule_GetContextFlags.unwrap()(ctx.ctx) };
+    (flags as u64 & raw::REDISMODULE_CTX_FLAGS_MASTER as u64) != 0
+}
+
+///
+/// Forgets the expiries of `path` and its descendants, after they were replaced or deleted
+///
+pub fn forget(ctx: &Context, key: &str, path: &str) {
+    expire_map::as_mut().clear(selected_db(ctx), key, path);
+}
+
+///
+/// Arms the expiry cycle timer, and follows the keys that are deleted, renamed or flushed.
+/// Should be called once when the module is loaded.
+///
+pub fn start(ctx: &Context) {
+    expire_map::init(now_millis());
+    let events = raw::REDISMODULE_NOTIFY_GENERIC
+        | raw::REDISMODULE_NOTIFY_STRING
+        | raw::REDISMODULE_NOTIFY_EXPIRED
+        | raw::REDISMODULE_NOTIFY_EVICTED;
+    let flush = raw::RedisModuleEvent {
+        id: raw::REDISMODULE_EVENT_FLUSHDB as u64,
+        dataver: 1,
+    };
+    unsafe {
+        raw::RedisModule_SubscribeToKeyspaceEvents.unwrap()(
+            ctx.ctx,
+            events as c_int,
+            Some(on_keyspace_event),
+        );
+        raw::RedisModule_SubscribeToServerEvent.unwrap()(ctx.ctx, flush, Some(on_flush));
+    }
+    ctx.create_timer(Duration::from_millis(EXPIRE_CYCLE_MS), expire_cycle, ());
+}
+
+///
+/// Drops or moves the expiries of keys that other commands delete, overwrite, rename or move,
+/// so that they don't apply to whatever is later stored under the same name
+///
+extern "C" fn on_keyspace_event(
+    ctx: *mut raw::RedisModuleCtx,
+    _type: c_int,
+    event: *const c_char,
+    key: *mut raw::RedisModuleString,
+) -> c_int {
+    let map = expire_map::as_mut();
+    if map.is_empty() && map.moving.is_none() {
+        return raw::REDISMODULE_OK as c_int;
+    }
+    let ctx = Context::new(ctx);
+    let db = selected_db(&ctx);
+    let key = unsafe {
+        let mut len = 0;
+        let ptr = raw::RedisModule_StringPtrLen.unwrap()(key, &mut len);
+        String::from_utf8_lossy(slice::from_raw_parts(ptr as *const u8, len as usize)).into_owned()
+    };
+    match unsafe { CStr::from_ptr(event) }.to_bytes() {
+        b"rename_from" | b"move_from" => map.moving = Some((db, key)),
+        b"rename_to" | b"move_to" => match map.moving.take() {
+            Some((from_db, from)) => map.rename(from_db, &from, db, &key),
+            None => map.clear_key(db, &key),
+        },
+        b"del" | b"expired" | b"evicted" | b"set" | b"restore" | b"copy_to" => {
+            map.clear_key(db, &key)
+        }
+        _ => {}
+    }
+    raw::REDISMODULE_OK as c_int
+}
+
+extern "C" fn on_flush(
+    _ctx: *mut raw::RedisModuleCtx,
+    _event: raw::RedisModuleEvent,
+    subevent: u64,
+    data: *mut c_void,
+) {
+    if subevent == raw::REDISMODULE_SUBEVENT_FLUSHDB_START as u64 {
+        let info = unsafe { &*(data as *const raw::RedisModuleFlushInfo) };
+        let db = if info.dbnum == -1 {
+            None
+        } else {
+            Some(info.dbnum)
+        };
+        expire_map::as_mut().clear_db(db);
+    }
+}
+
+fn expire_cycle(ctx: &Context, _data: ()) {
+    let map = expire_map::as_mut();
+    let now = now_millis();
+    let master = is_master(ctx);
+    if master && !map.was_master {
+        map.rearm(now);
+    }
+    map.was_master = master;
+    map.wheel.advance(now);
+
+    if master {
+        for (deadline, expiry) in map.wheel.pop_expired(EXPIRE_CYCLE_BATCH) {
+            if map.take_due(&expiry, deadline) {
+                if let Err(e) = expire_path(ctx, &expiry) {
+                    ctx.log_warning(&format!("Failed to expire {:?}: {:?}", expiry, e));
+                }
+            }
+        }
+    } else {
+        // Replicas wait for the master's JSON.DEL, which clears the deadlines. Until then the
+        // deadlines are kept, and put back in the wheel if this replica is promoted.
+        map.wheel.pop_expired(usize::MAX);
+    }
+
+    let delay = if map.wheel.has_expired() && master {
+        1 // Keep draining the backlog, one bounded batch at a time
+    } else {
+        EXPIRE_CYCLE_MS
+    };
+    ctx.create_timer(Duration::from_millis(delay), expire_cycle, ());
+}
+
+fn expire_path(ctx: &Context, expiry: &expire_map::PathExpiry) -> Result<(), RedisError> {
+    select_db(ctx, expiry.db);
+
+    let key = ctx.open_key_writable(&expiry.key);
+    let deleted = match key.get_value::<RedisJSON>(&REDIS_JSON_TYPE)? {
+        Some(doc) => {
+            if expiry.path == "$" {
+                key.delete()?;
+                1
+            } else {
+                let res = doc.delete_path(&expiry.path)?;
+                sindex::update_document(doc);
+                res
+            }
+        }
+        None => 0,
+    };
+    if deleted > 0 {
+        replicate(ctx, "JSON.DEL", &[&expiry.key, &expiry.path]);
+    }
+    Ok(())
+}
+
+///
+/// Array elements move when the array is resized, so an expiry set on an index would delete
+/// whichever element ends up there. Only paths made of object keys can expire.
+///
+fn check_path(path: &str) -> Result<(), RedisError> {
+    match first_match::compile(path) {
+        Ok(Some(steps)) if steps.iter().all(|step| matches!(step, Step::Key(_))) => Ok(()),
+        _ => Err(RedisError::Str(
+            "ERR only paths made of object keys can expire",
+        )),
+    }
+}
+
+///
+/// Sets the expiry of `path` at the absolute `deadline`, which is also what is replicated, so
+/// that the replicas and the AOF don't start the timeout again from their own clock
+///
+fn set_expiry(ctx: &Context, key: &str, path: &str, deadline: u64) -> RedisResult {
+    let exists = ctx
+        .open_key(key)
+        .get_value::<RedisJSON>(&REDIS_JSON_TYPE)?
+        .map_or(false, |doc| doc.get_first(path).is_ok());
+
+    if exists {
+        expire_map::as_mut().set(selected_db(ctx), key, path, deadline);
+        replicate(ctx, "JSON.PEXPIREAT", &[key, path, &deadline.to_string()]);
+        Ok(RedisValue::Integer(1))
+    } else {
+        Ok(RedisValue::Integer(0))
+    }
+}
+
+// JSON.EXPIRE <key> <path> <seconds>
+pub fn expire<I>(ctx: &Context, args: I) -> RedisResult
+where
+    I: IntoIterator<Item = String>,
+{
+    let mut args = args.into_iter().skip(1);
+
+    let key = args.next_string()?;
+    let path = backwards_compat_path(args.next_string()?);
+    let seconds = args.next_i64()?;
+    args.done()?;
+
+    check_path(&path)?;
+    let deadline = Some(seconds)
+        .filter(|&seconds| seconds > 0)
+        .and_then(|seconds| (seconds as u64).checked_mul(1000))
+        .and_then(|millis| millis.checked_add(now_millis()))
+        .ok_or(RedisError::Str("ERR invalid expire time"))?;
+
+    set_expiry(ctx, &key, &path, deadline)
+}
+
+// JSON.PEXPIREAT <key> <path> <unix-time-milliseconds>
+pub fn pexpireat<I>(ctx: &Context, args: I) -> RedisResult
+where
+    I: IntoIterator<Item = String>,
+{
+    let mut args = args.into_iter().skip(1);
+
+    let key = args.next_string()?;
+    let path = backwards_compat_path(args.next_string()?);
+    let deadline = args.next_i64()?;
+    args.done()?;
+
+    check_path(&path)?;
+    if deadline <= 0 {
+        return Err(RedisError::Str("ERR invalid expire time"));
+    }
+
+    set_expiry(ctx, &key, &path, deadline as u64)
+}
+
+// JSON.TTL <key> <path>
+pub fn ttl<I>(ctx: &Context, args: I) -> RedisResult
+where
+    I: IntoIterator<Item = String>,
+{
+    let mut args = args.into_iter().skip(1);
+
+    let key = args.next_string()?;
+    let path = backwards_compat_path(args.next_string()?);
+    args.done()?;
+
+    let exists = ctx
+        .open_key(&key)
+        .get_value::<RedisJSON>(&REDIS_JSON_TYPE)?
+        .map_or(false, |doc| doc.get_first(&path).is_ok());
+
+    let ttl = if !exists {
+        -2
+    } else {
+        match expire_map::as_mut().get(selected_db(ctx), &key, &path) {
+            Some(deadline) => ((deadline.saturating_sub(now_millis()) + 500) / 1000) as i64,
+            None => -1,
+        }
+    };
+    Ok(RedisValue::Integer(ttl))
+}
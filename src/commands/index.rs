@@ -11,6 +11,7 @@ use redisearch_api::{Document, FieldType, TagOptions};
 use crate::error::Error;
 use crate::redisjson::{Format, RedisJSON};
 use crate::schema::Schema;
+use crate::trace;
 use crate::REDIS_JSON_TYPE;
 
 pub mod schema_map {
@@ -85,6 +86,7 @@ pub fn add_document(key: &str, index_name: &str, doc: &RedisJSON) -> RedisResult
     // 3. Build a RS Document and populate the fields from our doc
     // 4. Add the Document to the index
 
+    let _index = trace::phase_guard("index");
     let map = schema_map::as_ref();
 
     if let Some(schema) = map.get(index_name) {
@@ -0,0 +1,562 @@
+// Server-side bulk import of NDJSON files.
+//
+// JSON.LOAD memory-maps a file from the server's filesystem and returns at once. A coordinator
+// thread cuts the file into chunks at line boundaries and has the worker pool parse them, a few at
+// a time, into documents, their keys and their text. The parsed chunks are handed over, in file
+// order, to a timer on the main thread, which sets the documents in batches and gives the event
+// loop back once a batch is done or its time budget is spent. The main thread never reads the
+// mapping. Every document set is replicated as a plain JSON.SET, so replicas and the AOF never need
+// the file. Finished loads are forgotten after a while.
+
+use redis_module::{Context, NextArg, RedisError, RedisResult, RedisValue, REDIS_OK};
+use serde_json::Value;
+use std::collections::VecDeque;
+use std::fs::File;
+use std::os::unix::io::AsRawFd;
+use std::ptr;
+use std::slice;
+use std::str;
+use std::sync::atomic::{AtomicBool, AtomicU64, AtomicUsize, Ordering};
+use std::sync::mpsc::{channel, sync_channel, Receiver, SyncSender, TryRecvError};
+use std::sync::{Arc, Mutex};
+use std::thread;
+use std::time::{Duration, Instant};
+
+use crate::commands::expire::{select_db, selected_db};
+use crate::commands::in_cluster;
+use crate::first_match::{self, Step};
+use crate::offload;
+use crate::parser;
+use crate::redisjson::{Format, SetOptions};
+use crate::replication::replicate;
+use crate::{apply_set, backwards_compat_path, SetArgs};
+
+const DEFAULT_BATCH: usize = 1000;
+/// Time the main thread spends setting documents before serving clients again
+const LOAD_BUDGET_MS: u64 = 5;
+/// Delay between batches, and while waiting for the workers
+const LOAD_CYCLE_MS: u64 = 1;
+const LOAD_IDLE_MS: u64 = 10;
+/// How long the status of a finished load is kept
+const LOAD_RETENTION_MS: u64 = 60_000;
+/// Chunks of about this many bytes are parsed at once, by at most this many workers, and at
+/// most this many parsed chunks wait for the main thread. The rest of the pool stays available
+/// to offloaded commands.
+const CHUNK_BYTES: usize = 1 << 20;
+const MAX_PARSING: usize = 2;
+const MAX_PARSED: usize = 4;
+
+///
+/// A read-only memory mapping of a whole file
+///
+struct Mmap {
+    ptr: *mut libc::c_void,
+    len: usize,
+}
+
+// The mapping is read-only and lives as long as the last reference to it
+unsafe impl Send for Mmap {}
+unsafe impl Sync for Mmap {}
+
+impl Mmap {
+    fn open(path: &str) -> Result<Mmap, String> {
+        let file = File::open(path).map_err(|e| format!("ERR can't open {}: {}", path, e))?;
+        let len = file
+            .metadata()
+            .map_err(|e| format!("ERR can't open {}: {}", path, e))?
+            .len() as usize;
+        if len == 0 {
+            return Ok(Mmap {
+                ptr: ptr::null_mut(),
+                len,
+            });
+        }
+        let ptr = unsafe {
+            libc::mmap(
+                ptr::null_mut(),
+                len,
+                libc::PROT_READ,
+                libc::MAP_PRIVATE,
+                file.as_raw_fd(),
+                0,
+            )
+        };
+        if ptr == libc::MAP_FAILED {
+            return Err(format!("ERR can't map {}", path));
+        }
+        unsafe {
+            libc::madvise(ptr, len, libc::MADV_SEQUENTIAL);
+        }
+        Ok(Mmap { ptr, len })
+    }
+
+    fn bytes(&self) -> &[u8] {
+        if self.len == 0 {
+            &[]
+        } else {
+            unsafe { slice::from_raw_parts(self.ptr as *const u8, self.len) }
+        }
+    }
+}
+
+impl Drop for Mmap {
+    fn drop(&mut self) {
+        if self.len > 0 {
+            unsafe {
+                libc::munmap(self.ptr, self.len);
+            }
+        }
+    }
+}
+
+///
+/// Counters shared by the main thread, the coordinator and the workers
+///
+#[derive(Default)]
+pub struct Progress {
+    parsed_bytes: AtomicUsize,
+    parsed: AtomicU64,
+    loaded: AtomicU64,
+    errors: AtomicU64,
+    cancelled: AtomicBool,
+    last_error: Mutex<Option<String>>,
+}
+
+impl Progress {
+    fn error(&self, msg: String) {
+        self.errors.fetch_add(1, Ordering::Relaxed);
+        *self.last_error.lock().unwrap() = Some(msg);
+    }
+}
+
+///
+/// A parsed line, along with its text for replication
+///
+struct Record {
+    key: String,
+    value: Value,
+    text: String,
+}
+
+pub mod load_map {
+    use super::{Progress, Record};
+    use std::collections::{HashMap, VecDeque};
+    use std::sync::mpsc::Receiver;
+    use std::sync::Arc;
+
+    #[derive(Debug, Clone, Copy, PartialEq)]
+    pub enum State {
+        Running,
+        Done,
+        Cancelled,
+    }
+
+    impl State {
+        pub fn name(self) -> &'static str {
+            match self {
+                State::Running => "running",
+                State::Done => "done",
+                State::Cancelled => "cancelled",
+            }
+        }
+    }
+
+    pub struct Load {
+        pub file: String,
+        pub db: i32,
+        pub batch: usize,
+        pub total_bytes: usize,
+        pub state: State,
+        pub progress: Arc<Progress>,
+        // Only set while running
+        pub(super) parsed: Option<Receiver<Vec<Record>>>,
+        pub(super) pending: VecDeque<Record>,
+    }
+
+    pub struct LoadMap {
+        pub next_id: u64,
+        pub loads: HashMap<String, Load>,
+    }
+
+    /// A static map, like `schema_map`. Loads are only touched from the main thread, and are
+    /// neither persisted nor replicated: the documents they set are.
+    /// The init function should be called only once.
+    static mut LOAD_MAP: Option<LoadMap> = None;
+
+    pub fn init() {
+        let map = LoadMap {
+            next_id: 1,
+            loads: HashMap::new(),
+        };
+        unsafe {
+            LOAD_MAP = Some(map);
+        }
+    }
+
+    pub fn as_ref() -> &'static LoadMap {
+        unsafe { LOAD_MAP.as_ref() }.unwrap()
+    }
+
+    pub fn as_mut() -> &'static mut LoadMap {
+        unsafe { LOAD_MAP.as_mut() }.unwrap()
+    }
+}
+
+///
+/// Where the chunk starting at `start` ends: after the first newline past `CHUNK_BYTES`
+///
+fn chunk_end(bytes: &[u8], start: usize) -> usize {
+    let from = (start + CHUNK_BYTES).min(bytes.len());
+    bytes[from..]
+        .iter()
+        .position(|b| *b == b'\n')
+        .map_or(bytes.len(), |i| from + i + 1)
+}
+
+fn record_key(value: &Value, steps: &[Step], prefix: &str) -> Result<String, String> {
+    let mut visits = 0;
+    match first_match::first(value, steps, &mut visits) {
+        Some(Value::String(s)) => Ok(format!("{}{}", prefix, s)),
+        Some(Value::Number(n)) => Ok(format!("{}{}", prefix, n)),
+        Some(_) => Err("key field must be a string or a number".to_string()),
+        None => Err("missing key field".to_string()),
+    }
+}
+
+///
+/// Parses the lines of `start..end`, skipping the blank and invalid ones
+///
+fn parse_chunk(
+    bytes: &[u8],
+    start: usize,
+    end: usize,
+    steps: &[Step],
+    prefix: &str,
+    progress: &Progress,
+) -> Vec<Record> {
+    let mut records = vec![];
+    let mut line_start = start;
+    for line in bytes[start..end].split(|b| *b == b'\n') {
+        let line_end = line_start + line.len();
+        let text = match line.last() {
+            Some(b'\r') => &line[..line.len() - 1],
+            _ => line,
+        };
+        if !text.iter().all(u8::is_ascii_whitespace) {
+            let record = str::from_utf8(text)
+                .map_err(|e| e.to_string())
+                .and_then(|text| {
+                    let value = parser::from_str(text).map_err(|e| e.msg)?;
+                    let key = record_key(&value, steps, prefix)?;
+                    Ok(Record {
+                        key,
+                        value,
+                        text: text.to_owned(),
+                    })
+                });
+            match record {
+                Ok(record) => records.push(record),
+                Err(e) => progress.error(format!("ERR at byte {}: {}", line_start, e)),
+            }
+        }
+        line_start = line_end + 1;
+    }
+    progress
+        .parsed
+        .fetch_add(records.len() as u64, Ordering::Relaxed);
+    progress
+        .parsed_bytes
+        .fetch_add(end - start, Ordering::Relaxed);
+    records
+}
+
+///
+/// Has the workers parse the file, and hands the parsed chunks to the main thread in file order
+///
+fn coordinate(
+    mmap: Arc<Mmap>,
+    steps: Arc<Vec<Step>>,
+    prefix: Arc<String>,
+    progress: Arc<Progress>,
+    sender: SyncSender<Vec<Record>>,
+) {
+    let mut parsing: VecDeque<Receiver<Vec<Record>>> = VecDeque::new();
+    let mut start = 0;
+    loop {
+        while parsing.len() < MAX_PARSING
+            && start < mmap.len
+            && !progress.cancelled.load(Ordering::Relaxed)
+        {
+            let end = chunk_end(mmap.bytes(), start);
+            let (chunk_sender, chunk_receiver) = channel();
+            let (mmap, steps, prefix, progress) = (
+                Arc::clone(&mmap),
+                Arc::clone(&steps),
+                Arc::clone(&prefix),
+                Arc::clone(&progress),
+            );
+            offload::spawn(move || {
+                let records = parse_chunk(mmap.bytes(), start, end, &steps, &prefix, &progress);
+                let _ = chunk_sender.send(records);
+            });
+            parsing.push_back(chunk_receiver);
+            start = end;
+        }
+        let records = match parsing.pop_front() {
+            Some(chunk_receiver) => chunk_receiver.recv().unwrap_or_default(),
+            None => return,
+        };
+        if sender.send(records).is_err() {
+            // Cancelled
+            return;
+        }
+    }
+}
+
+fn error_message(e: RedisError) -> String {
+    match e {
+        RedisError::Str(s) => s.to_string(),
+        RedisError::String(s) => s,
+        e => format!("{:?}", e),
+    }
+}
+
+fn insert(ctx: &Context, record: Record, progress: &Progress) {
+    let Record { key, value, text } = record;
+    let set = SetArgs {
+        key: &key,
+        path: "$".to_string(),
+        value: &text,
+        format: Format::JSON,
+        set_option: SetOptions::None,
+        index: None,
+        rev: None,
+        schema: None,
+    };
+    match apply_set(ctx, set, value, &|ctx: &Context| {
+        replicate(ctx, "JSON.SET", &[&key, "$", &text])
+    }) {
+        Ok(_) => {
+            progress.loaded.fetch_add(1, Ordering::Relaxed);
+        }
+        Err(e) => progress.error(format!("ERR key {}: {}", key, error_message(e))),
+    }
+}
+
+fn load_cycle(ctx: &Context, id: String) {
+    let load = match load_map::as_mut().loads.get_mut(&id) {
+        Some(load) => load,
+        None => return,
+    };
+    if load.progress.cancelled.load(Ordering::Relaxed) || !select_db(ctx, load.db) {
+        finish(ctx, id, load, load_map::State::Cancelled);
+        return;
+    }
+
+    let started = Instant::now();
+    let budget = Duration::from_millis(LOAD_BUDGET_MS);
+    let mut inserted = 0;
+    let mut delay = LOAD_CYCLE_MS;
+    while inserted < load.batch && started.elapsed() < budget {
+        match load.pending.pop_front() {
+            Some(record) => {
+                insert(ctx, record, &load.progress);
+                inserted += 1;
+            }
+            None => match load.parsed.as_ref().unwrap().try_recv() {
+                Ok(records) => load.pending.extend(records),
+                Err(TryRecvError::Empty) => {
+                    delay = LOAD_IDLE_MS;
+                    break;
+                }
+                Err(TryRecvError::Disconnected) => {
+                    finish(ctx, id, load, load_map::State::Done);
+                    return;
+                }
+            },
+        }
+    }
+    ctx.create_timer(Duration::from_millis(delay), load_cycle, id);
+}
+
+fn finish(ctx: &Context, id: String, load: &mut load_map::Load, state: load_map::State) {
+    load.state = state;
+    // Stops the coordinator, if it's still running, which unmaps the file once the workers are done
+    load.progress.cancelled.store(true, Ordering::Relaxed);
+    load.parsed = None;
+    load.pending.clear();
+    ctx.create_timer(Duration::from_millis(LOAD_RETENTION_MS), forget, id);
+}
+
+fn forget(_ctx: &Context, id: String) {
+    load_map::as_mut().loads.remove(&id);
+}
+
+fn status(id: &str, load: &load_map::Load) -> RedisValue {
+    let progress = &load.progress;
+    let last_error = progress.last_error.lock().unwrap().clone();
+    RedisValue::Array(vec![
+        RedisValue::SimpleStringStatic("id"),
+        RedisValue::BulkString(id.to_string()),
+        RedisValue::SimpleStringStatic("file"),
+        RedisValue::BulkString(load.file.clone()),
+        RedisValue::SimpleStringStatic("state"),
+        RedisValue::SimpleStringStatic(load.state.name()),
+        RedisValue::SimpleStringStatic("bytes"),
+        RedisValue::Integer(progress.parsed_bytes.load(Ordering::Relaxed) as i64),
+        RedisValue::SimpleStringStatic("total_bytes"),
+        RedisValue::Integer(load.total_bytes as i64),
+        RedisValue::SimpleStringStatic("parsed"),
+        RedisValue::Integer(progress.parsed.load(Ordering::Relaxed) as i64),
+        RedisValue::SimpleStringStatic("loaded"),
+        RedisValue::Integer(progress.loaded.load(Ordering::Relaxed) as i64),
+        RedisValue::SimpleStringStatic("errors"),
+        RedisValue::Integer(progress.errors.load(Ordering::Relaxed) as i64),
+        RedisValue::SimpleStringStatic("last_error"),
+        last_error.map_or(RedisValue::Null, RedisValue::BulkString),
+    ])
+}
+
+// JSON.LOAD <file> KEYFIELD <path> [PREFIX <prefix>] [BATCH <n>]
+// JSON.LOAD STATUS [<id>]
+// JSON.LOAD CANCEL <id>
+pub fn load<I>(ctx: &Context, args: I) -> RedisResult
+where
+    I: IntoIterator<Item = String>,
+{
+    let args: Vec<String> = args.into_iter().collect();
+    let is_load = args.len() > 2 && args[2].eq_ignore_ascii_case("KEYFIELD");
+    let mut args = args.into_iter().skip(1);
+
+    if !is_load {
+        return match args.next_string()?.to_uppercase().as_str() {
+            "STATUS" => match args.next() {
+                Some(id) => {
+                    args.done()?;
+                    let load = load_map::as_ref()
+                        .loads
+                        .get(&id)
+                        .ok_or_else(|| RedisError::Str("ERR no such load"))?;
+                    Ok(status(&id, load))
+                }
+                None => {
+                    let mut loads: Vec<(&String, &load_map::Load)> =
+                        load_map::as_ref().loads.iter().collect();
+                    loads.sort_by_key(|(id, _)| id.parse::<u64>().unwrap_or(0));
+                    Ok(RedisValue::Array(
+                        loads.into_iter().map(|(id, load)| status(id, load)).collect(),
+                    ))
+                }
+            },
+            "CANCEL" => {
+                let id = args.next_string()?;
+                args.done()?;
+                let load = load_map::as_ref()
+                    .loads
+                    .get(&id)
+                    .ok_or_else(|| RedisError::Str("ERR no such load"))?;
+                // The timer finishes the load on its next cycle
+                load.progress.cancelled.store(true, Ordering::Relaxed);
+                REDIS_OK
+            }
+            _ => Err(RedisError::Str(
+                "ERR syntax error - try `JSON.LOAD <file> KEYFIELD <path>` or `JSON.LOAD STATUS|CANCEL`",
+            )),
+        };
+    }
+
+    let file = args.next_string()?;
+    args.next_string()?; // KEYFIELD
+    let key_field = backwards_compat_path(args.next_string()?);
+    let mut prefix = String::new();
+    let mut batch = DEFAULT_BATCH;
+    while let Some(arg) = args.next() {
+        match arg.to_uppercase().as_str() {
+            "PREFIX" => prefix = args.next_string()?,
+            "BATCH" => {
+                let n = args.next_i64()?;
+                if n <= 0 {
+                    return Err(RedisError::Str("ERR BATCH must be positive"));
+                }
+                batch = n as usize;
+            }
+            _ => return Err(RedisError::Str("ERR syntax error")),
+        }
+    }
+
+    // The file's keys can hash to any slot
+    if in_cluster(ctx) {
+        return Err(RedisError::Str(
+            "ERR JSON.LOAD isn't supported in cluster mode",
+        ));
+    }
+    if !offload::can_block(ctx) {
+        return Err(RedisError::Str(
+            "ERR JSON.LOAD can only run on a master, outside of MULTI and scripts",
+        ));
+    }
+    let steps = first_match::compile(&key_field)
+        .map_err(RedisError::String)?
+        .ok_or_else(|| RedisError::Str("ERR unsupported KEYFIELD path"))?;
+    let mmap = Arc::new(Mmap::open(&file).map_err(RedisError::String)?);
+    let progress = Arc::new(Progress::default());
+    let (sender, receiver) = sync_channel(MAX_PARSED);
+
+    let map = load_map::as_mut();
+    let id = map.next_id.to_string();
+    map.next_id += 1;
+    map.loads.insert(
+        id.clone(),
+        load_map::Load {
+            file,
+            db: selected_db(ctx),
+            batch,
+            total_bytes: mmap.len,
+            state: load_map::State::Running,
+            progress: Arc::clone(&progress),
+            parsed: Some(receiver),
+            pending: VecDeque::new(),
+        },
+    );
+
+    let (steps, prefix) = (Arc::new(steps), Arc::new(prefix));
+    thread::spawn(move || coordinate(mmap, steps, prefix, progress, sender));
+    ctx.create_timer(Duration::from_millis(LOAD_CYCLE_MS), load_cycle, id.clone());
+    Ok(RedisValue::SimpleString(id))
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn test_parse_chunk() {
+        let bytes =
+            b"{\"id\": 1, \"a\": [1]}\r\n\n  \n{\"id\": \"x\"}\n{\"a\": 2}\n{bad\n{\"id\": 2.5}";
+        let steps = first_match::compile("$.id").unwrap().unwrap();
+        let progress = Progress::default();
+        let records = parse_chunk(bytes, 0, bytes.len(), &steps, "p:", &progress);
+
+        let keys: Vec<&str> = records.iter().map(|r| r.key.as_str()).collect();
+        assert_eq!(keys, vec!["p:1", "p:x", "p:2.5"]);
+        assert_eq!(records[0].text, "{\"id\": 1, \"a\": [1]}");
+        assert_eq!(records[2].text, "{\"id\": 2.5}");
+        assert_eq!(progress.errors.load(Ordering::Relaxed), 2);
+        assert!(progress
+            .last_error
+            .lock()
+            .unwrap()
+            .as_ref()
+            .unwrap()
+            .starts_with("ERR at byte 46: "));
+    }
+
+    #[test]
+    fn test_chunk_end() {
+        let mut bytes = vec![b'x'; CHUNK_BYTES + 10];
+        bytes[CHUNK_BYTES + 3] = b'\n';
+        assert_eq!(chunk_end(&bytes, 0), CHUNK_BYTES + 4);
+        assert_eq!(chunk_end(&bytes, CHUNK_BYTES + 4), bytes.len());
+        assert_eq!(chunk_end(b"{}\n{}", 0), 5);
+    }
+}
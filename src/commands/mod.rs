@@ -1 +1,18 @@
+pub mod expire;
 pub mod index;
+pub mod load;
+pub mod scan;
+pub mod sindex;
+pub mod upload;
+pub mod validate;
+
+use redis_module::{raw, Context};
+
+///
+/// Whether the server runs in cluster mode, where commands that don't name their keys can't be
+/// routed
+///
+pub fn in_cluster(ctx: &Context) -> bool {
+    let flags = unsafe { raw::RedisModule_GetContextFlags.unwrap()(ctx.ctx) } as u64;
+    flags & raw::REDISMODULE_CTX_FLAGS_CLUSTER as u64 != 0
+}
@@ -0,0 +1,84 @@
+use redis_module::{Context, NextArg, RedisError, RedisResult, RedisValue};
+
+use crate::redisjson::{Format, RedisJSON};
+use crate::trace;
+use crate::{backwards_compat_path, REDIS_JSON_TYPE};
+
+// JSON.SCAN <cursor> [MATCH <pattern>] [COUNT <count>] [FILTER <path>] PROJECT <path> [path ...]
+//
+// Iterates the keyspace like SCAN, and replies with the next cursor and, for each JSON key of
+// the iteration whose FILTER path selects at least one value, the key followed by the values at
+// the PROJECT paths, as JSON (null for missing paths).
+pub fn scan<I>(ctx: &Context, args: I) -> RedisResult
+where
+    I: IntoIterator<Item = String>,
+{
+    let mut args = args.into_iter().skip(1);
+
+    let cursor = args.next_string()?;
+    cursor
+        .parse::<u64>()
+        .map_err(|_| RedisError::Str("ERR invalid cursor"))?;
+
+    let mut scan_args = vec![cursor];
+    let mut filter = None;
+    let mut projection = vec![];
+    while let Some(arg) = args.next() {
+        match arg.to_uppercase().as_str() {
+            "MATCH" | "COUNT" => {
+                scan_args.push(arg);
+                scan_args.push(args.next_string()?);
+            }
+            "FILTER" => filter = Some(backwards_compat_path(args.next_string()?)),
+            "PROJECT" => {
+                projection.extend(args.by_ref().map(backwards_compat_path));
+            }
+            _ => return Err(RedisError::Str("ERR syntax error")),
+        }
+    }
+    if projection.is_empty() {
+        return Err(RedisError::WrongArity);
+    }
+
+    let scan_args: Vec<&str> = scan_args.iter().map(String::as_str).collect();
+    let (next_cursor, keys) = match ctx.call("scan", &scan_args)? {
+        RedisValue::Array(mut arr) if arr.len() == 2 => match (arr.remove(0), arr.remove(0)) {
+            (RedisValue::SimpleString(next_cursor), RedisValue::Array(keys)) => (next_cursor, keys),
+            _ => return Err(RedisError::Str("Error on parsing reply from scan")),
+        },
+        _ => return Err(RedisError::Str("Error on parsing reply from scan")),
+    };
+
+    let mut res = vec![];
+    for k in keys {
+        let key = match k {
+            RedisValue::SimpleString(key) => key,
+            _ => return Err(RedisError::Str("Error on parsing reply from scan")),
+        };
+        // Keys of other types are skipped
+        let doc = match ctx.open_key(&key).get_value::<RedisJSON>(&REDIS_JSON_TYPE) {
+            Ok(Some(doc)) => doc,
+            _ => continue,
+        };
+        if let Some(filter) = &filter {
+            let selected = trace::phase("select", || doc.get_values(filter))?;
+            if selected.is_empty() {
+                continue;
+            }
+        }
+        let values = projection
+            .iter()
+            .map(|path| {
+                doc.to_string(path, Format::JSON)
+                    .map_or(RedisValue::Null, RedisValue::BulkString)
+            })
+            .collect();
+        res.push(RedisValue::BulkString(key));
+        res.push(RedisValue::Array(values));
+    }
+
+    Ok(RedisValue::Array(vec![
+        RedisValue::BulkString(next_cursor),
+        RedisValue::Array(res),
+    ]))
+}
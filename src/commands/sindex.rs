@@ -0,0 +1,254 @@
+use std::ops::Bound;
+use std::thread;
+
+use serde_json::{Map, Value};
+
+use redis_module::{
+    Context, NextArg, RedisError, RedisResult, RedisValue, ThreadSafeContext, REDIS_OK,
+};
+
+use crate::commands::expire::{select_db, selected_db};
+use crate::redisjson::{Format, RedisJSON, ValueIndex};
+use crate::secondary_index::{IndexValue, SecondaryIndex};
+use crate::trace;
+use crate::{backwards_compat_path, REDIS_JSON_TYPE};
+
+pub mod sindex_map {
+    use crate::secondary_index::SecondaryIndex;
+    use std::collections::HashMap;
+
+    type SecondaryIndexMap = HashMap<String, SecondaryIndex>;
+
+    /// A static map, for the same reasons as `schema_map`.
+    /// The init function should be called only once.
+    static mut SINDEX_MAP: Option<SecondaryIndexMap> = None;
+
+    pub fn init() {
+        let map = HashMap::new();
+        unsafe {
+            SINDEX_MAP = Some(map);
+        }
+    }
+
+    pub fn as_ref() -> &'static SecondaryIndexMap {
+        unsafe { SINDEX_MAP.as_ref() }.unwrap()
+    }
+
+    pub fn as_mut() -> &'static mut SecondaryIndexMap {
+        unsafe { SINDEX_MAP.as_mut() }.unwrap()
+    }
+}
+
+pub fn add_path(index_name: &str, path: &str) -> RedisResult {
+    let index = sindex_map::as_mut()
+        .entry(index_name.to_owned())
+        .or_insert_with(|| SecondaryIndex::new(index_name));
+
+    if index.paths.contains_key(path) {
+        Err(RedisError::Str("Path already indexed"))
+    } else {
+        index.paths.insert(path.to_owned(), Default::default());
+        REDIS_OK
+    }
+}
+
+///
+/// Re-indexes a document after it was written, if it belongs to a built-in index
+///
+pub fn update_document(doc: &RedisJSON) {
+    let _index = trace::phase_guard("index");
+    if let Some(value_index) = &doc.value_index {
+        if let Some(index) = sindex_map::as_mut().get_mut(&value_index.index_name) {
+            index.update(value_index.db, &value_index.key, |path| {
+                doc.get_values(path)
+                    .map_or_else(|_| vec![], IndexValue::collect)
+            });
+        }
+    }
+}
+
+pub fn remove_document(value_index: &ValueIndex) {
+    if let Some(index) = sindex_map::as_mut().get_mut(&value_index.index_name) {
+        index.remove(value_index.db, &value_index.key);
+    }
+}
+
+fn parse_scalar(json: &str) -> Result<IndexValue, RedisError> {
+    serde_json::from_str::<Value>(json)
+        .ok()
+        .as_ref()
+        .and_then(IndexValue::from_json)
+        .ok_or_else(|| RedisError::Str("ERR expected a JSON scalar"))
+}
+
+///
+/// Range bounds: `-` and `+` are unbounded, a `(` prefix makes the bound exclusive
+///
+fn parse_bound(bound: &str) -> Result<Bound<IndexValue>, RedisError> {
+    let bound = match bound {
+        "-" | "+" => Bound::Unbounded,
+        _ if bound.starts_with('(') => Bound::Excluded(parse_scalar(&bound[1..])?),
+        _ => Bound::Included(parse_scalar(bound)?),
+    };
+    match &bound {
+        Bound::Included(v) | Bound::Excluded(v) if !v.is_ordered() => Err(RedisError::Str(
+            "ERR range bounds must be numbers or strings",
+        )),
+        _ => Ok(bound),
+    }
+}
+
+// JSON.SINDEX ADD <index> <path>
+// JSON.SINDEX DEL <index>
+// JSON.SINDEX INFO <index>
+pub fn sindex<I>(ctx: &Context, args: I) -> RedisResult
+where
+    I: IntoIterator<Item = String>,
+{
+    let mut args = args.into_iter().skip(1);
+
+    let subcommand = args.next_string()?;
+    let index_name = args.next_string()?;
+
+    match subcommand.to_uppercase().as_str() {
+        "ADD" => {
+            let path = backwards_compat_path(args.next_string()?);
+            args.done()?;
+            add_path(&index_name, &path)?;
+
+            // Index the documents that were added with this index before the path was, in every
+            // database
+            thread::spawn(move || {
+                let ts_ctx = ThreadSafeContext::new();
+                let (mut db, mut cursor): (i32, u64) = (0, 0);
+                loop {
+                    let ctx = ts_ctx.lock();
+                    // Thread safe contexts start on database 0
+                    if !select_db(&ctx, db) {
+                        break;
+                    }
+                    match scan_and_update(&*ctx, &index_name, cursor) {
+                        Ok(c) => cursor = c,
+                        Err(e) => {
+                            ctx.log_warning(&format!("Failed to index {}: {:?}", index_name, e));
+                            return;
+                        }
+                    }
+                    // Lets other clients in between the batches
+                    drop(ctx);
+                    if cursor == 0 {
+                        db += 1;
+                    }
+                }
+            });
+
+            ctx.replicate_verbatim();
+            REDIS_OK
+        }
+        "DEL" => {
+            args.done()?;
+            match sindex_map::as_mut().remove(&index_name) {
+                Some(_) => {
+                    ctx.replicate_verbatim();
+                    REDIS_OK
+                }
+                None => Err(RedisError::Str("Index not found")),
+            }
+        }
+        "INFO" => {
+            args.done()?;
+            let index = sindex_map::as_ref()
+                .get(&index_name)
+                .ok_or_else(|| RedisError::Str("Index not found"))?;
+            let mut res: Vec<RedisValue> = Vec::with_capacity(index.paths.len() * 2);
+            for (path, indexes) in &index.paths {
+                let len: usize = indexes.values().map(|path_index| path_index.len()).sum();
+                res.push(RedisValue::BulkString(path.clone()));
+                res.push(RedisValue::Integer(len as i64));
+            }
+            Ok(RedisValue::Array(res))
+        }
+        _ => Err(RedisError::Str(
+            "ERR unknown subcommand - try `JSON.SINDEX ADD|DEL|INFO`",
+        )),
+    }
+}
+
+fn scan_and_update(ctx: &Context, index_name: &str, cursor: u64) -> Result<u64, RedisError> {
+    let values = ctx.call("scan", &[&cursor.to_string()]);
+    match values {
+        Ok(RedisValue::Array(arr)) => match (arr.get(0), arr.get(1)) {
+            (Some(RedisValue::SimpleString(next_cursor)), Some(RedisValue::Array(keys))) => {
+                let cursor = next_cursor.parse().unwrap();
+                for k in keys {
+                    if let RedisValue::SimpleString(key) = k {
+                        // Keys of other types are skipped
+                        if let Ok(Some(doc)) =
+                            ctx.open_key(&key).get_value::<RedisJSON>(&REDIS_JSON_TYPE)
+                        {
+                            let belongs = doc
+                                .value_index
+                                .as_ref()
+                                .map_or(false, |value_index| value_index.index_name == index_name);
+                            if belongs {
+                                update_document(doc);
+                            }
+                        }
+                    } else {
+                        return Err(RedisError::Str("Error on parsing reply from scan"));
+                    }
+                }
+                Ok(cursor)
+            }
+            _ => Err(RedisError::Str("Error on parsing reply from scan")),
+        },
+        _ => Err(RedisError::Str("Error on parsing reply from scan")),
+    }
+}
+
+// JSON.SQUERY <index> <path> EQ <json-scalar> [projection-path]
+// JSON.SQUERY <index> <path> RANGE <min> <max> [projection-path]
+pub fn squery<I>(ctx: &Context, args: I) -> RedisResult
+where
+    I: IntoIterator<Item = String>,
+{
+    let mut args = args.into_iter().skip(1);
+
+    let index_name = args.next_string()?;
+    let path = backwards_compat_path(args.next_string()?);
+
+    // Only the documents of the selected database
+    let path_index = sindex_map::as_ref()
+        .get(&index_name)
+        .ok_or_else(|| RedisError::Str("ERR no such index"))?
+        .path_index(&path, selected_db(ctx))
+        .ok_or_else(|| RedisError::Str("ERR path is not indexed"))?;
+    let empty = Default::default();
+    let path_index = path_index.unwrap_or(&empty);
+
+    let keys = match args.next_string()?.to_uppercase().as_str() {
+        "EQ" => path_index.get(&parse_scalar(&args.next_string()?)?),
+        "RANGE" => {
+            let min = parse_bound(&args.next_string()?)?;
+            let max = parse_bound(&args.next_string()?)?;
+            path_index.range(min, max)
+        }
+        _ => return Err(RedisError::Str("ERR expected EQ or RANGE")),
+    };
+
+    let projection = args
+        .next()
+        .map_or_else(|| "$".to_string(), backwards_compat_path);
+    args.done()?;
+
+    let mut result = Map::new();
+    for key in keys {
+        let values: Vec<Value> = match ctx.open_key(key).get_value::<RedisJSON>(&REDIS_JSON_TYPE)? {
+            Some(doc) => doc.get_values(&projection)?.into_iter().cloned().collect(),
+            None => continue,
+        };
+        result.insert(key.to_string(), Value::Array(values));
+    }
+
+    Ok(RedisJSON::serialize(&Value::Object(result), Format::JSON)?.into())
+}
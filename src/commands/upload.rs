@@ -0,0 +1,253 @@
+use std::ffi::CString;
+use std::os::raw::c_int;
+use std::slice;
+use std::time::Duration;
+
+use redis_module::{raw, Context, RedisError, RedisResult, RedisValue, REDIS_OK};
+
+use crate::commands::expire::{now_millis, selected_db};
+use crate::commands::in_cluster;
+use crate::incremental::IncrementalParser;
+use crate::redisjson::{Format, RedisJSON, SetOptions};
+use crate::replication::replicate;
+use crate::{apply_set, backwards_compat_path, SetArgs, REDIS_JSON_TYPE};
+
+/// Sessions that see no command for this long are dropped
+const UPLOAD_TIMEOUT_MS: u64 = 60_000;
+
+/// How often abandoned sessions are looked for
+const UPLOAD_SWEEP_MS: u64 = 10_000;
+
+pub mod upload_map {
+    use crate::incremental::IncrementalParser;
+    use crate::redisjson::SetOptions;
+    use std::collections::HashMap;
+
+    pub struct Upload {
+        pub db: i32,
+        pub key: String,
+        pub path: String,
+        pub set_option: SetOptions,
+        pub parser: IncrementalParser,
+        pub last_used: u64,
+    }
+
+    pub struct UploadMap {
+        pub next_id: u64,
+        pub uploads: HashMap<String, Upload>,
+    }
+
+    /// A static map, like `schema_map`. Upload sessions are not part of the keyspace,
+    /// so they are neither persisted nor replicated.
+    /// The init function should be called only once.
+    static mut UPLOAD_MAP: Option<UploadMap> = None;
+
+    pub fn init() {
+        let map = UploadMap {
+            next_id: 1,
+            uploads: HashMap::new(),
+        };
+        unsafe {
+            UPLOAD_MAP = Some(map);
+        }
+    }
+
+    pub fn as_mut() -> &'static mut UploadMap {
+        unsafe { UPLOAD_MAP.as_mut() }.unwrap()
+    }
+}
+
+fn take_upload(id: &str) -> Result<upload_map::Upload, RedisError> {
+    upload_map::as_mut()
+        .uploads
+        .remove(id)
+        .ok_or_else(|| RedisError::Str("ERR no such upload"))
+}
+
+///
+/// Registers the command and arms the timer that drops abandoned uploads, should be called once
+/// when the module is loaded.
+///
+/// The command is registered by hand, rather than with the others, since its chunks are taken as
+/// they are: a chunk may end in the middle of a multibyte character, which isn't valid UTF-8 on
+/// its own.
+///
+pub fn start(ctx: &Context) -> c_int {
+    ctx.create_timer(Duration::from_millis(UPLOAD_SWEEP_MS), sweep, ());
+    let name = CString::new("json.upload").unwrap();
+    let flags = CString::new("write deny-oom").unwrap();
+    unsafe {
+        raw::RedisModule_CreateCommand.unwrap()(
+            ctx.ctx,
+            name.as_ptr(),
+            Some(upload_command),
+            flags.as_ptr(),
+            0,
+            0,
+            0,
+        )
+    }
+}
+
+fn sweep(ctx: &Context, _data: ()) {
+    let now = now_millis();
+    upload_map::as_mut()
+        .uploads
+        .retain(|_, upload| now.saturating_sub(upload.last_used) < UPLOAD_TIMEOUT_MS);
+    ctx.create_timer(Duration::from_millis(UPLOAD_SWEEP_MS), sweep, ());
+}
+
+extern "C" fn upload_command(
+    ctx: *mut raw::RedisModuleCtx,
+    argv: *mut *mut raw::RedisModuleString,
+    argc: c_int,
+) -> c_int {
+    let context = Context::new(ctx);
+    let args = unsafe { slice::from_raw_parts(argv, argc as usize) }
+        .iter()
+        .map(|&arg| unsafe {
+            let mut len = 0;
+            let ptr = raw::RedisModule_StringPtrLen.unwrap()(arg, &mut len);
+            slice::from_raw_parts(ptr as *const u8, len as usize).to_vec()
+        })
+        .collect();
+    context.reply(upload(&context, args)) as c_int
+}
+
+fn next_string<I: Iterator<Item = Vec<u8>>>(args: &mut I) -> Result<String, RedisError> {
+    let arg = args.next().ok_or(RedisError::WrongArity)?;
+    String::from_utf8(arg).map_err(|_| RedisError::Str("ERR invalid UTF-8 in argument"))
+}
+
+fn done<I: Iterator<Item = Vec<u8>>>(args: &mut I) -> Result<(), RedisError> {
+    match args.next() {
+        Some(_) => Err(RedisError::WrongArity),
+        None => Ok(()),
+    }
+}
+
+// JSON.UPLOAD BEGIN <key> <path> [NX | XX]
+// JSON.UPLOAD CHUNK <id> <data>
+// JSON.UPLOAD COMMIT <id>
+// JSON.UPLOAD ABORT <id>
+pub fn upload<I>(ctx: &Context, args: I) -> RedisResult
+where
+    I: IntoIterator<Item = Vec<u8>>,
+{
+    let mut args = args.into_iter().skip(1);
+    let now = now_millis();
+
+    // Chunks and commits don't name the key, so they can't be routed to its node
+    if in_cluster(ctx) {
+        return Err(RedisError::Str(
+            "ERR JSON.UPLOAD isn't supported in cluster mode",
+        ));
+    }
+
+    match next_string(&mut args)?.to_uppercase().as_str() {
+        "BEGIN" => {
+            let key = next_string(&mut args)?;
+            let path = backwards_compat_path(next_string(&mut args)?);
+            let set_option = match args.next() {
+                Some(s) => match String::from_utf8_lossy(&s).to_uppercase().as_str() {
+                    "NX" => SetOptions::NotExists,
+                    "XX" => SetOptions::AlreadyExists,
+                    _ => return Err(RedisError::Str("ERR syntax error")),
+                },
+                None => SetOptions::None,
+            };
+            done(&mut args)?;
+
+            let map = upload_map::as_mut();
+            let id = map.next_id.to_string();
+            map.next_id += 1;
+            map.uploads.insert(
+                id.clone(),
+                upload_map::Upload {
+                    db: selected_db(ctx),
+                    key,
+                    path,
+                    set_option,
+                    parser: IncrementalParser::new(),
+                    last_used: now,
+                },
+            );
+            Ok(RedisValue::SimpleString(id))
+        }
+        "CHUNK" => {
+            let id = next_string(&mut args)?;
+            let data = args.next().ok_or(RedisError::WrongArity)?;
+            done(&mut args)?;
+
+            let map = upload_map::as_mut();
+            let upload = map
+                .uploads
+                .get_mut(&id)
+                .ok_or_else(|| RedisError::Str("ERR no such upload"))?;
+            upload.last_used = now;
+            match upload.parser.feed(&data) {
+                Ok(()) => Ok(RedisValue::Integer(upload.parser.offset() as i64)),
+                Err(e) => {
+                    // The upload can't be completed anymore
+                    map.uploads.remove(&id);
+                    Err(e.into())
+                }
+            }
+        }
+        "COMMIT" => {
+            let id = next_string(&mut args)?;
+            done(&mut args)?;
+
+            // A commit from the wrong database leaves the upload as it is
+            let upload = upload_map::as_mut()
+                .uploads
+                .get(&id)
+                .ok_or_else(|| RedisError::Str("ERR no such upload"))?;
+            if upload.db != selected_db(ctx) {
+                return Err(RedisError::Str(
+                    "ERR the upload was started in another database",
+                ));
+            }
+            let upload_map::Upload {
+                key,
+                path,
+                set_option,
+                parser,
+                ..
+            } = take_upload(&id)?;
+            let json = parser.finish()?;
+            let set = SetArgs {
+                key: &key,
+                path: path.clone(),
+                value: "",
+                format: Format::JSON,
+                set_option,
+                index: None,
+                rev: None,
+                schema: None,
+            };
+
+            // Replicate the resulting value rather than the chunks
+            apply_set(ctx, set, json, &|ctx: &Context| {
+                let value = ctx
+                    .open_key(&key)
+                    .get_value::<RedisJSON>(&REDIS_JSON_TYPE)
+                    .ok()
+                    .flatten()
+                    .and_then(|doc| doc.to_string(&path, Format::JSON).ok());
+                if let Some(value) = value {
+                    replicate(ctx, "JSON.SET", &[&key, &path, &value]);
+                }
+            })
+        }
+        "ABORT" => {
+            let id = next_string(&mut args)?;
+            done(&mut args)?;
+            take_upload(&id)?;
+            REDIS_OK
+        }
+        _ => Err(RedisError::Str(
+            "ERR unknown subcommand - try `JSON.UPLOAD BEGIN|CHUNK|COMMIT|ABORT`",
+        )),
+    }
+}
@@ -0,0 +1,83 @@
+use redis_module::{Context, NextArg, RedisError, RedisResult, REDIS_OK};
+
+use crate::commands::in_cluster;
+use crate::redisjson::{Format, RedisJSON};
+use crate::validator::Validator;
+
+pub mod validator_map {
+    use crate::validator::Validator;
+    use std::collections::HashMap;
+
+    type ValidatorMap = HashMap<String, Validator>;
+
+    /// A static map, for the same reasons as `schema_map`.
+    /// The init function should be called only once.
+    static mut VALIDATOR_MAP: Option<ValidatorMap> = None;
+
+    pub fn init() {
+        let map = HashMap::new();
+        unsafe {
+            VALIDATOR_MAP = Some(map);
+        }
+    }
+
+    pub fn as_ref() -> &'static ValidatorMap {
+        unsafe { VALIDATOR_MAP.as_ref() }.unwrap()
+    }
+
+    pub fn as_mut() -> &'static mut ValidatorMap {
+        unsafe { VALIDATOR_MAP.as_mut() }.unwrap()
+    }
+}
+
+///
+/// Compiles `source` and registers it as schema `name`, replacing any schema of that name.
+/// Documents bound to a replaced schema are validated against the new one on their next write.
+///
+pub fn add_schema(name: &str, source: &str) -> RedisResult {
+    let validator = Validator::compile(source).map_err(RedisError::String)?;
+    validator_map::as_mut().insert(name.to_owned(), validator);
+    REDIS_OK
+}
+
+// JSON.SETSCHEMA <name> <schema>
+pub fn set_schema<I>(ctx: &Context, args: I) -> RedisResult
+where
+    I: IntoIterator<Item = String>,
+{
+    let mut args = args.into_iter().skip(1);
+
+    // Schemas aren't keys, so one registered through a shard would be missing from the others
+    if in_cluster(ctx) {
+        return Err(RedisError::Str(
+            "ERR JSON.SETSCHEMA isn't supported in cluster mode",
+        ));
+    }
+
+    let name = args.next_string()?;
+    let source = args.next_string()?;
+    args.done()?;
+
+    add_schema(&name, &source)?;
+    ctx.replicate_verbatim();
+    REDIS_OK
+}
+
+// JSON.VALIDATE <name> <json>
+pub fn validate<I>(_ctx: &Context, args: I) -> RedisResult
+where
+    I: IntoIterator<Item = String>,
+{
+    let mut args = args.into_iter().skip(1);
+
+    let name = args.next_string()?;
+    let json = args.next_string()?;
+    args.done()?;
+
+    let validator = validator_map::as_ref()
+        .get(&name)
+        .ok_or_else(|| RedisError::Str("ERR no such schema"))?;
+    let value = RedisJSON::parse_str(&json, Format::JSON)?;
+    validator.validate(&value).map_err(RedisError::String)?;
+    REDIS_OK
+}
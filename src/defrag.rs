@@ -0,0 +1,495 @@
+// Defragmentation and capacity reclamation of documents.
+//
+// The module API this module is built on doesn't let Redis's active defrag move the allocations of
+// module values, so documents are defragmented by a cycle of our own: while `activedefrag` is
+// enabled and the allocator is fragmented past `active-defrag-ignore-bytes` and
+// `active-defrag-threshold-lower`, a timer walks the JSON keys incrementally, a bounded number of
+// nodes per cycle, and moves the buffers of arrays, strings and objects to fresh allocations of the
+// exact size. New allocations are served from the allocator's fullest pages, which lets it release
+// the sparse ones, and the excess capacity left by growing and shrinking containers is given back
+// on the way. The thresholds are checked before each pass over the keyspace, a started pass runs to
+// its end.
+//
+// Keys are opened read-only: moving buffers doesn't change the documents, and signaling them as
+// modified would abort the transactions WATCHing them and invalidate the clients tracking them.
+//
+// Writes that remove values in place also release the excess capacity of the containers they
+// shrink, as soon as it's above a slack threshold.
+
+use crate::commands::expire::select_db;
+use crate::first_match::Step;
+use crate::redisjson::RedisJSON;
+use crate::REDIS_JSON_TYPE;
+use redis_module::{raw, Context, RedisValue};
+use serde_json::Value;
+use std::mem;
+use std::os::raw::{c_char, c_int};
+use std::time::Duration;
+
+/// Period of the cycle while active defrag is enabled, and while it isn't
+const DEFRAG_CYCLE_MS: u64 = 100;
+const DEFRAG_IDLE_MS: u64 = 1000;
+/// Work done per cycle, in nodes moved, object entries rebuilt and keys scanned
+const DEFRAG_CYCLE_BUDGET: usize = 10_000;
+const DEFRAG_SCAN_COUNT: usize = 100;
+
+/// Excess capacity is only released when it's worth reallocating
+const MIN_SLACK_BYTES: usize = 256;
+const MAX_SLACK_RATIO: usize = 4;
+
+struct DefragState {
+    // Whether a pass over the keyspace is under way
+    in_pass: bool,
+    db: i32,
+    scan_cursor: String,
+    // Whether the last SCAN batch of `db` was fetched
+    scanned: bool,
+    // Keys of the last SCAN batch still to walk, the last one first
+    keys: Vec<String>,
+    // Where the walk of the last key stopped
+    node_cursor: Vec<usize>,
+}
+
+/// Only touched from the main thread, by the cycle timer.
+static mut DEFRAG_STATE: Option<DefragState> = None;
+
+fn has_slack<T>(len: usize, capacity: usize) -> bool {
+    let slack = capacity - len;
+    slack * mem::size_of::<T>() >= MIN_SLACK_BYTES && slack * MAX_SLACK_RATIO > len
+}
+
+///
+/// Releases the excess capacity of an array or a string, when above the slack threshold
+///
+pub fn reclaim(value: &mut Value) {
+    match value {
+        Value::Array(arr) if has_slack::<Value>(arr.len(), arr.capacity()) => arr.shrink_to_fit(),
+        Value::String(s) if has_slack::<u8>(s.len(), s.capacity()) => s.shrink_to_fit(),
+        _ => {}
+    }
+}
+
+///
+/// The value `steps` lead to, if they are all keys and indexes
+///
+pub fn get_mut<'a>(mut value: &'a mut Value, steps: &[Step]) -> Option<&'a mut Value> {
+    for step in steps {
+        value = match step {
+            Step::Key(key) => value.as_object_mut()?.get_mut(key)?,
+            Step::Index(index) => {
+                let arr = value.as_array_mut()?;
+                // Like `first_match::first`
+                let index = if *index < 0 {
+                    (*index + arr.len() as isize).max(0) as usize
+                } else {
+                    *index as usize
+                };
+                arr.get_mut(index)?
+            }
+            Step::Wildcard | Step::Descendant(_) => return None,
+        };
+    }
+    Some(value)
+}
+
+fn moved<T>(before: *const T, after: *const T, len: usize) -> usize {
+    (len > 0 && before != after) as usize
+}
+
+///
+/// Moves the buffer of `value` to a fresh allocation of the exact size, returns the work done and
+/// the number of buffers that actually moved
+///
+fn realloc(value: &mut Value) -> (usize, usize) {
+    match value {
+        Value::Array(arr) if arr.capacity() > 0 => {
+            let before = arr.as_ptr();
+            let mut fresh = Vec::with_capacity(arr.len());
+            fresh.append(arr);
+            *arr = fresh;
+            (1, moved(before, arr.as_ptr(), arr.len()))
+        }
+        Value::String(s) if s.capacity() > 0 => {
+            let before = s.as_ptr();
+            *s = s.as_str().to_owned();
+            (1, moved(before, s.as_ptr(), s.len()))
+        }
+        Value::Object(map) => {
+            // The map's own nodes can't be observed, only its keys
+            let len = map.len();
+            let mut count = 0;
+            *map = mem::take(map)
+                .into_iter()
+                .map(|(key, value)| {
+                    let fresh = key.as_str().to_owned();
+                    count += moved(key.as_ptr(), fresh.as_ptr(), key.len());
+                    (fresh, value)
+                })
+                .collect();
+            (1 + len, count)
+        }
+        _ => (1, 0),
+    }
+}
+
+///
+/// Defragments `value`, depth first, until `budget` runs out. `cursor` holds the position of each
+/// node on the way to where the walk stopped, and should be empty for a new walk. `moved` is
+/// increased by the number of buffers that moved. Returns whether the walk is complete.
+///
+/// The cursor is made of child positions, so a walk resumed on a value that changed in between
+/// may skip or revisit a few nodes, but always terminates.
+///
+pub fn defrag(
+    value: &mut Value,
+    cursor: &mut Vec<usize>,
+    budget: &mut usize,
+    moved: &mut usize,
+) -> bool {
+    walk(value, cursor, 0, budget, moved)
+}
+
+fn walk(
+    value: &mut Value,
+    cursor: &mut Vec<usize>,
+    depth: usize,
+    budget: &mut usize,
+    moved: &mut usize,
+) -> bool {
+    if cursor.len() == depth {
+        // Not resuming below this node
+        if *budget == 0 {
+            return false;
+        }
+        let (work, count) = realloc(value);
+        *budget = budget.saturating_sub(work);
+        *moved += count;
+        cursor.push(0);
+    }
+    let done = match value {
+        Value::Array(arr) => walk_children(arr.iter_mut(), cursor, depth, budget, moved),
+        Value::Object(map) => walk_children(map.values_mut(), cursor, depth, budget, moved),
+        _ => true,
+    };
+    if done {
+        cursor.truncate(depth);
+    }
+    done
+}
+
+fn walk_children<'a, I>(
+    children: I,
+    cursor: &mut Vec<usize>,
+    depth: usize,
+    budget: &mut usize,
+    moved: &mut usize,
+) -> bool
+where
+    I: Iterator<Item = &'a mut Value>,
+{
+    for (i, child) in children.enumerate().skip(cursor[depth]) {
+        cursor[depth] = i;
+        if !walk(child, cursor, depth + 1, budget, moved) {
+            return false;
+        }
+    }
+    true
+}
+
+///
+/// Defragments the document at `key` from `cursor` on, see `defrag`. Keys that aren't JSON are
+/// complete walks.
+///
+pub fn defrag_key(
+    ctx: &Context,
+    key: &str,
+    cursor: &mut Vec<usize>,
+    budget: &mut usize,
+    moved: &mut usize,
+) -> bool {
+    match ctx.open_key(key).get_value::<RedisJSON>(&REDIS_JSON_TYPE) {
+        Ok(Some(_)) => {}
+        // Gone, or of another type
+        _ => return true,
+    }
+    // Read-only keys only hand out shared references to their values, so the key is reopened
+    // through the raw API to reach the document
+    unsafe {
+        let name = raw::RedisModule_CreateString.unwrap()(
+            ctx.ctx,
+            key.as_ptr() as *const c_char,
+            key.len() as _,
+        );
+        let redis_key =
+            raw::RedisModule_OpenKey.unwrap()(ctx.ctx, name, raw::REDISMODULE_READ as c_int)
+                as *mut raw::RedisModuleKey;
+        let doc = raw::RedisModule_ModuleTypeGetValue.unwrap()(redis_key) as *mut RedisJSON;
+        let done = match doc.as_mut() {
+            Some(doc) => doc.defrag(cursor, budget, moved),
+            None => true,
+        };
+        raw::RedisModule_CloseKey.unwrap()(redis_key);
+        raw::RedisModule_FreeString.unwrap()(ctx.ctx, name);
+        done
+    }
+}
+
+fn config_get(ctx: &Context, name: &str) -> Option<String> {
+    match ctx.call("config", &["get", name]) {
+        Ok(RedisValue::Array(mut reply)) if reply.len() == 2 => match reply.pop() {
+            Some(RedisValue::SimpleString(value)) => Some(value),
+            _ => None,
+        },
+        _ => None,
+    }
+}
+
+fn active_defrag_enabled(ctx: &Context) -> bool {
+    config_get(ctx, "activedefrag").map_or(false, |enabled| enabled == "yes")
+}
+
+///
+/// Whether the allocator is fragmented enough for a pass, by the thresholds Redis's own active
+/// defrag starts at
+///
+fn fragmented(ctx: &Context) -> bool {
+    let ignore_bytes = config_get(ctx, "active-defrag-ignore-bytes").and_then(|v| v.parse().ok());
+    let threshold = config_get(ctx, "active-defrag-threshold-lower").and_then(|v| v.parse().ok());
+    let info = match ctx.call("info", &["memory"]) {
+        Ok(RedisValue::SimpleString(info)) => info,
+        _ => return false,
+    };
+    match (ignore_bytes, threshold, fragmentation(&info)) {
+        (Some(ignore_bytes), Some(threshold), Some((ratio, bytes))) => {
+            bytes > ignore_bytes && (ratio - 1.0) * 100.0 > threshold
+        }
+        _ => false,
+    }
+}
+
+///
+/// The allocator's fragmentation ratio and bytes, from the reply of `INFO memory`
+///
+fn fragmentation(info: &str) -> Option<(f64, i64)> {
+    let field = |name: &str| {
+        info.lines().find_map(|line| {
+            let mut parts = line.trim_end().splitn(2, ':');
+            match (parts.next(), parts.next()) {
+                (Some(field), Some(value)) if field == name => Some(value.to_string()),
+                _ => None,
+            }
+        })
+    };
+    let ratio = field("allocator_frag_ratio")?.parse().ok()?;
+    let bytes = field("allocator_frag_bytes")?.parse().ok()?;
+    Some((ratio, bytes))
+}
+
+///
+/// Arms the defrag cycle timer, should be called once when the module is loaded
+///
+pub fn start(ctx: &Context) {
+    unsafe {
+        DEFRAG_STATE = Some(DefragState {
+            in_pass: false,
+            db: 0,
+            scan_cursor: "0".to_string(),
+            scanned: false,
+            keys: vec![],
+            node_cursor: vec![],
+        });
+    }
+    ctx.create_timer(Duration::from_millis(DEFRAG_IDLE_MS), defrag_cycle, ());
+}
+
+fn defrag_cycle(ctx: &Context, _data: ()) {
+    let state = unsafe { DEFRAG_STATE.as_mut() }.unwrap();
+    if active_defrag_enabled(ctx) && !state.in_pass {
+        state.in_pass = fragmented(ctx);
+    }
+    let delay = if active_defrag_enabled(ctx) && state.in_pass {
+        run(ctx, state, DEFRAG_CYCLE_BUDGET);
+        DEFRAG_CYCLE_MS
+    } else {
+        DEFRAG_IDLE_MS
+    };
+    ctx.create_timer(Duration::from_millis(delay), defrag_cycle, ());
+}
+
+fn run(ctx: &Context, state: &mut DefragState, mut budget: usize) {
+    if !select_db(ctx, state.db) {
+        end_pass(ctx, state);
+        return;
+    }
+
+    while budget > 0 {
+        if let Some(key) = state.keys.last() {
+            let mut moved = 0;
+            let done = defrag_key(ctx, key, &mut state.node_cursor, &mut budget, &mut moved);
+            if !done {
+                return;
+            }
+            state.keys.pop();
+            state.node_cursor.clear();
+            continue;
+        }
+
+        if state.scanned {
+            // Done with this database, on to the next one
+            state.db += 1;
+            state.scan_cursor = "0".to_string();
+            state.scanned = false;
+            if !select_db(ctx, state.db) {
+                end_pass(ctx, state);
+                return;
+            }
+        }
+
+        budget = budget.saturating_sub(DEFRAG_SCAN_COUNT);
+        let reply = ctx.call(
+            "scan",
+            &[&state.scan_cursor, "COUNT", &DEFRAG_SCAN_COUNT.to_string()],
+        );
+        let (next_cursor, keys) = match reply {
+            Ok(RedisValue::Array(mut reply)) if reply.len() == 2 => {
+                match (reply.pop(), reply.pop()) {
+                    (Some(RedisValue::Array(keys)), Some(RedisValue::SimpleString(cursor))) => {
+                        (cursor, keys)
+                    }
+                    _ => return,
+                }
+            }
+            _ => return,
+        };
+        state
+            .keys
+            .extend(keys.into_iter().rev().filter_map(|key| match key {
+                RedisValue::SimpleString(key) => Some(key),
+                _ => None,
+            }));
+        state.scanned = next_cursor == "0";
+        state.scan_cursor = next_cursor;
+    }
+}
+
+///
+/// Rewinds to the first database once past the last one, the next pass waits for fragmentation
+///
+fn end_pass(ctx: &Context, state: &mut DefragState) {
+    state.in_pass = false;
+    state.db = 0;
+    state.scan_cursor = "0".to_string();
+    state.scanned = false;
+    select_db(ctx, 0);
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn doc() -> Value {
+        serde_json::from_str(
+            r#"{
+                "a": [1, [2, 3], {"b": "x", "c": [4, 5, 6]}],
+                "d": {"e": {"f": "yyy"}},
+                "g": "zz"
+            }"#,
+        )
+        .unwrap()
+    }
+
+    #[test]
+    fn test_defrag_resumes() {
+        let expected = doc();
+        for per_cycle in 1..20 {
+            let mut value = doc();
+            let mut cursor = vec![];
+            let mut cycles = 0;
+            loop {
+                cycles += 1;
+                let mut budget = per_cycle;
+                if defrag(&mut value, &mut cursor, &mut budget, &mut 0) {
+                    break;
+                }
+                assert!(cycles < 100);
+            }
+            assert!(cursor.is_empty());
+            assert_eq!(value, expected);
+        }
+    }
+
+    #[test]
+    fn test_defrag_releases_capacity() {
+        let mut arr = Vec::with_capacity(100);
+        arr.push(Value::from(1));
+        let mut s = String::with_capacity(100);
+        s.push('x');
+        let mut value = Value::Array(vec![Value::Array(arr), Value::String(s)]);
+        let mut budget = usize::MAX;
+        let mut moved = 0;
+        defrag(&mut value, &mut vec![], &mut budget, &mut moved);
+        assert_eq!(value[0].as_array().unwrap().capacity(), 1);
+        assert_eq!(value[1].as_str().unwrap(), "x");
+        // The outer and inner arrays and the string, not the number
+        assert_eq!(moved, 3);
+
+        // Only the outer array has a buffer
+        let mut value = Value::Array(vec![Value::Array(vec![]), Value::from(""), Value::Null]);
+        let mut moved = 0;
+        let mut budget = usize::MAX;
+        defrag(&mut value, &mut vec![], &mut budget, &mut moved);
+        assert_eq!(moved, 1);
+    }
+
+    #[test]
+    fn test_fragmentation() {
+        let info = "# Memory\r\nused_memory:1000\r\nallocator_frag_ratio:1.25\r\n\
+                    allocator_frag_bytes:2048\r\n";
+        assert_eq!(fragmentation(info), Some((1.25, 2048)));
+        assert_eq!(fragmentation("# Memory\r\nused_memory:1000\r\n"), None);
+    }
+
+    #[test]
+    fn test_defrag_changed_value() {
+        let mut value = doc();
+        let mut cursor = vec![];
+        let mut budget = 5;
+        assert!(!defrag(&mut value, &mut cursor, &mut budget, &mut 0));
+        // Replaced by a smaller value before the walk resumes
+        value = Value::from(vec![1, 2]);
+        let mut budget = usize::MAX;
+        assert!(defrag(&mut value, &mut cursor, &mut budget, &mut 0));
+        assert!(cursor.is_empty());
+    }
+
+    #[test]
+    fn test_reclaim() {
+        let mut value = Value::Array(Vec::with_capacity(64));
+        value
+            .as_array_mut()
+            .unwrap()
+            .extend((0..4).map(Value::from));
+        reclaim(&mut value);
+        assert_eq!(value.as_array().unwrap().capacity(), 4);
+
+        // Too little to bother
+        let mut small = Vec::with_capacity(12);
+        small.extend((0..10).map(Value::from));
+        let mut value = Value::Array(small);
+        reclaim(&mut value);
+        assert_eq!(value.as_array().unwrap().capacity(), 12);
+
+        let mut value = doc();
+        let steps = [
+            Step::Key("a".to_string()),
+            Step::Index(-1),
+            Step::Key("c".to_string()),
+        ];
+        assert_eq!(
+            get_mut(&mut value, &steps),
+            Some(&mut Value::from(vec![4, 5, 6]))
+        );
+        assert_eq!(get_mut(&mut value, &[Step::Wildcard]), None);
+        assert_eq!(get_mut(&mut value, &[Step::Key("x".to_string())]), None);
+    }
+}
@@ -0,0 +1,350 @@
+// Merkle digests of documents, for JSON.DIGEST and DEBUG DIGEST.
+//
+// The digest of a container is computed from the digests of its members, and is cached in a tree
+// that mirrors the document. A write forgets the cached digests along its path, so digesting the
+// document again only recomputes the containers on that path, from the cached digests of their
+// other members. Digests are computed lazily, on the first request after a write.
+//
+// To keep the cache small, only containers with other containers in them, or with at least
+// `MIN_CACHED_LEN` members, get an entry. The others are hashed on each request.
+//
+// Object digests don't depend on the order of the members, so documents that only differ by
+// the order of their keys have the same digest.
+
+use crate::first_match::Step;
+use serde_json::Value;
+use std::collections::HashMap;
+
+const MIN_CACHED_LEN: usize = 16;
+
+const FNV_OFFSET: u64 = 0xcbf2_9ce4_8422_2325;
+const FNV_PRIME: u64 = 0x0100_0000_01b3;
+
+// Type tags
+const NULL: u8 = 0;
+const BOOL: u8 = 1;
+const NUMBER: u8 = 2;
+const STRING: u8 = 3;
+const ARRAY: u8 = 4;
+const OBJECT: u8 = 5;
+const MEMBER: u8 = 6;
+
+///
+/// The cached digests of a container and of its members
+///
+#[derive(Debug, Default)]
+pub struct Digests {
+    hash: Option<u64>,
+    keys: HashMap<String, Digests>,
+    indexes: HashMap<usize, Digests>,
+}
+
+impl Digests {
+    pub fn is_empty(&self) -> bool {
+        self.hash.is_none() && self.keys.is_empty() && self.indexes.is_empty()
+    }
+}
+
+/// FNV-1a, with a final avalanche so that digests of similar values look unrelated
+struct Hasher(u64);
+
+impl Hasher {
+    fn new(tag: u8) -> Self {
+        let mut hasher = Hasher(FNV_OFFSET);
+        hasher.write(&[tag]);
+        hasher
+    }
+
+    fn write(&mut self, bytes: &[u8]) {
+        for b in bytes {
+            self.0 ^= u64::from(*b);
+            self.0 = self.0.wrapping_mul(FNV_PRIME);
+        }
+    }
+
+    fn write_u64(&mut self, n: u64) {
+        self.write(&n.to_le_bytes());
+    }
+
+    fn finish(&self) -> u64 {
+        // splitmix64's finalizer
+        let mut x = self.0;
+        x = (x ^ (x >> 30)).wrapping_mul(0xbf58_476d_1ce4_e5b9);
+        x = (x ^ (x >> 27)).wrapping_mul(0x94d0_49bb_1331_11eb);
+        x ^ (x >> 31)
+    }
+}
+
+fn is_cached(value: &Value) -> bool {
+    match value {
+        Value::Array(arr) => arr.len() >= MIN_CACHED_LEN || arr.iter().any(is_container),
+        Value::Object(map) => map.len() >= MIN_CACHED_LEN || map.values().any(is_container),
+        _ => false,
+    }
+}
+
+fn is_container(value: &Value) -> bool {
+    value.is_array() || value.is_object()
+}
+
+///
+/// The digest of `value`, without the cache
+///
+pub fn hash(value: &Value) -> u64 {
+    digest(&mut Digests::default(), value)
+}
+
+///
+/// The digest of `value`, whose cached digests are `digests`
+///
+pub fn digest(digests: &mut Digests, value: &Value) -> u64 {
+    if let Some(hash) = digests.hash {
+        return hash;
+    }
+    let hash = match value {
+        Value::Null => Hasher::new(NULL).finish(),
+        Value::Bool(b) => {
+            let mut hasher = Hasher::new(BOOL);
+            hasher.write(&[*b as u8]);
+            hasher.finish()
+        }
+        Value::Number(n) => {
+            let mut hasher = Hasher::new(NUMBER);
+            hasher.write(n.to_string().as_bytes());
+            hasher.finish()
+        }
+        Value::String(s) => {
+            let mut hasher = Hasher::new(STRING);
+            hasher.write(s.as_bytes());
+            hasher.finish()
+        }
+        Value::Array(arr) => {
+            let mut hasher = Hasher::new(ARRAY);
+            hasher.write_u64(arr.len() as u64);
+            for (i, member) in arr.iter().enumerate() {
+                let hash = if is_cached(member) {
+                    digest(digests.indexes.entry(i).or_default(), member)
+                } else {
+                    hash(member)
+                };
+                hasher.write_u64(hash);
+            }
+            hasher.finish()
+        }
+        Value::Object(map) => {
+            // Summing the members keeps the digest independent of their order
+            let mut sum: u64 = 0;
+            for (key, member) in map {
+                let hash = if is_cached(member) {
+                    match digests.keys.get_mut(key.as_str()) {
+                        Some(member_digests) => digest(member_digests, member),
+                        None => digest(digests.keys.entry(key.clone()).or_default(), member),
+                    }
+                } else {
+                    hash(member)
+                };
+                let mut hasher = Hasher::new(MEMBER);
+                hasher.write_u64(key.len() as u64);
+                hasher.write(key.as_bytes());
+                hasher.write_u64(hash);
+                sum = sum.wrapping_add(hasher.finish());
+            }
+            let mut hasher = Hasher::new(OBJECT);
+            hasher.write_u64(map.len() as u64);
+            hasher.write_u64(sum);
+            hasher.finish()
+        }
+    };
+    if is_cached(value) {
+        digests.hash = Some(hash);
+    }
+    hash
+}
+
+fn resolve(arr: &[Value], index: isize) -> usize {
+    // Like `first_match::first`
+    if index < 0 {
+        (index + arr.len() as isize).max(0) as usize
+    } else {
+        index as usize
+    }
+}
+
+///
+/// The digest of the value `steps` lead to in `value`, `None` if they don't lead to a single
+/// value or if it's missing
+///
+pub fn digest_at(digests: &mut Digests, value: &Value, steps: &[Step]) -> Option<u64> {
+    let mut digests = Some(digests);
+    let mut value = value;
+    for step in steps {
+        let (next_value, next_digests) = match step {
+            Step::Key(key) => {
+                let member = value.as_object()?.get(key)?;
+                let member_digests = match digests {
+                    Some(d) if is_cached(member) => Some(d.keys.entry(key.clone()).or_default()),
+                    _ => None,
+                };
+                (member, member_digests)
+            }
+            Step::Index(index) => {
+                let arr = value.as_array()?;
+                let index = resolve(arr, *index);
+                let member = arr.get(index)?;
+                let member_digests = match digests {
+                    Some(d) if is_cached(member) => Some(d.indexes.entry(index).or_default()),
+                    _ => None,
+                };
+                (member, member_digests)
+            }
+            Step::Wildcard | Step::Descendant(_) => return None,
+        };
+        value = next_value;
+        digests = next_digests;
+    }
+    Some(match digests {
+        Some(digests) => digest(digests, value),
+        None => hash(value),
+    })
+}
+
+///
+/// Forgets the cached digests a write at `steps` in `value` makes stale, before it's applied.
+/// When `shifts` is set the write may move the members that follow its target, as removing an
+/// array element does.
+///
+pub fn invalidate(digests: &mut Digests, value: &Value, steps: &[Step], shifts: bool) {
+    let mut digests = digests;
+    let mut value = value;
+    digests.hash = None;
+    for (i, step) in steps.iter().enumerate() {
+        let last = i + 1 == steps.len();
+        match step {
+            Step::Key(key) => {
+                if last {
+                    digests.keys.remove(key.as_str());
+                    return;
+                }
+                let member = match value.as_object().and_then(|map| map.get(key)) {
+                    Some(member) => member,
+                    None => return,
+                };
+                digests = match digests.keys.get_mut(key.as_str()) {
+                    Some(member_digests) => member_digests,
+                    None => return,
+                };
+                value = member;
+            }
+            Step::Index(index) => {
+                let arr = match value.as_array() {
+                    Some(arr) => arr,
+                    None => return,
+                };
+                let index = resolve(arr, *index);
+                if last {
+                    if shifts {
+                        digests.indexes.clear();
+                    } else {
+                        digests.indexes.remove(&index);
+                    }
+                    return;
+                }
+                let member = match arr.get(index) {
+                    Some(member) => member,
+                    None => return,
+                };
+                digests = match digests.indexes.get_mut(&index) {
+                    Some(member_digests) => member_digests,
+                    None => return,
+                };
+                value = member;
+            }
+            Step::Wildcard | Step::Descendant(_) => {
+                // Anything below may change
+                *digests = Digests::default();
+                return;
+            }
+        }
+        digests.hash = None;
+    }
+    if steps.is_empty() {
+        *digests = Digests::default();
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn doc() -> Value {
+        let items: Vec<Value> = (0..20)
+            .map(|i| serde_json::json!({"id": i, "tags": ["a", i.to_string()]}))
+            .collect();
+        serde_json::json!({"items": items, "meta": {"name": "x", "nested": {"n": [1, 2]}}})
+    }
+
+    fn key(key: &str) -> Step {
+        Step::Key(key.to_string())
+    }
+
+    #[test]
+    fn test_digest() {
+        let value = doc();
+        let mut digests = Digests::default();
+        assert_eq!(digest(&mut digests, &value), hash(&value));
+        assert!(digests.hash.is_some());
+        assert_eq!(digests.keys["items"].indexes.len(), 20);
+
+        // Object digests ignore the order of the keys
+        let a: Value = serde_json::from_str(r#"{"a": 1, "b": [true, null]}"#).unwrap();
+        let b: Value = serde_json::from_str(r#"{"b": [true, null], "a": 1}"#).unwrap();
+        assert_eq!(hash(&a), hash(&b));
+        assert_ne!(hash(&a), hash(&Value::from(vec![1])));
+        assert_ne!(hash(&Value::from("1")), hash(&Value::from(1)));
+        assert_ne!(
+            hash(&Value::from(vec![1, 2])),
+            hash(&Value::from(vec![2, 1]))
+        );
+
+        let steps = [key("items"), Step::Index(-1), key("tags")];
+        assert_eq!(
+            digest_at(&mut digests, &value, &steps),
+            Some(hash(&value["items"][19]["tags"]))
+        );
+        assert_eq!(digest_at(&mut digests, &value, &[key("missing")]), None);
+        assert_eq!(digest_at(&mut digests, &value, &[Step::Wildcard]), None);
+    }
+
+    #[test]
+    fn test_invalidate() {
+        let mut value = doc();
+        let mut digests = Digests::default();
+        digest(&mut digests, &value);
+
+        // Replacing a value
+        let steps = [key("items"), Step::Index(3), key("id")];
+        invalidate(&mut digests, &value, &steps, false);
+        assert!(digests.hash.is_none());
+        assert!(digests.keys["items"].hash.is_none());
+        assert!(digests.keys["items"].indexes[&4].hash.is_some());
+        value["items"][3]["id"] = Value::from(42);
+        assert_eq!(digest(&mut digests, &value), hash(&value));
+
+        // Removing an array element
+        let steps = [key("items"), Step::Index(0)];
+        invalidate(&mut digests, &value, &steps, true);
+        value["items"].as_array_mut().unwrap().remove(0);
+        assert_eq!(digest(&mut digests, &value), hash(&value));
+
+        // Changes below a wildcard
+        invalidate(&mut digests, &value, &[key("meta"), Step::Wildcard], false);
+        assert!(digests.keys["items"].hash.is_some());
+        value["meta"]["nested"]["n"] = Value::from(3);
+        assert_eq!(digest(&mut digests, &value), hash(&value));
+
+        // The root
+        invalidate(&mut digests, &value, &[], false);
+        value = Value::from(vec![1]);
+        assert_eq!(digest(&mut digests, &value), hash(&value));
+    }
+}
@@ -0,0 +1,419 @@
+// Lazy evaluation of JSON paths for commands that only need the first match.
+//
+// `jsonpath_lib::select` collects every match before the caller keeps the first one, which for
+// wildcards and recursive descent means walking the whole document. Paths made only of keys,
+// indexes, wildcards and recursive descent to a key are evaluated here instead, depth first and
+// in the same order as `jsonpath_lib`, stopping at the first match. Other paths (filters, ranges,
+// unions...) aren't supported and are left to `jsonpath_lib`.
+//
+// The same paths can also be resolved to the locations of all their matches, several paths at
+// once, in a single walk of the document (`locate_all`).
+
+use jsonpath_lib::parser::{NodeVisitor, ParseToken};
+use jsonpath_lib::Parser;
+use serde_json::Value;
+
+#[derive(Debug, Clone, PartialEq)]
+pub enum Step {
+    Key(String),
+    Index(isize),
+    Wildcard,
+    Descendant(String),
+}
+
+struct StepParser {
+    steps: Vec<Step>,
+    last_token: Option<ParseToken>,
+    supported: bool,
+}
+
+impl NodeVisitor for StepParser {
+    fn visit_token(&mut self, token: &ParseToken) {
+        if !self.supported {
+            return;
+        }
+        let step = match (&self.last_token, token) {
+            (None, ParseToken::Absolute)
+            | (Some(ParseToken::Absolute), ParseToken::In)
+            | (Some(ParseToken::Absolute), ParseToken::Leaves)
+            | (Some(ParseToken::Absolute), ParseToken::Array)
+            | (Some(ParseToken::Key(_)), ParseToken::In)
+            | (Some(ParseToken::Key(_)), ParseToken::Leaves)
+            | (Some(ParseToken::Key(_)), ParseToken::Array)
+            | (Some(ParseToken::All), ParseToken::In)
+            | (Some(ParseToken::All), ParseToken::Leaves)
+            | (Some(ParseToken::All), ParseToken::Array)
+            | (Some(ParseToken::ArrayEof), ParseToken::In)
+            | (Some(ParseToken::ArrayEof), ParseToken::Leaves)
+            | (Some(ParseToken::ArrayEof), ParseToken::Array) => None,
+
+            (Some(ParseToken::In), ParseToken::Key(key)) => Some(Step::Key(key.clone())),
+            (Some(ParseToken::Leaves), ParseToken::Key(key)) => Some(Step::Descendant(key.clone())),
+            (Some(ParseToken::In), ParseToken::All) => Some(Step::Wildcard),
+
+            // Bracket notation: the step is added at ArrayEof
+            (Some(ParseToken::Array), ParseToken::Key(_))
+            | (Some(ParseToken::Array), ParseToken::Number(_))
+            | (Some(ParseToken::Array), ParseToken::All) => None,
+            (Some(ParseToken::Key(key)), ParseToken::ArrayEof) => Some(Step::Key(key.clone())),
+            (Some(ParseToken::Number(num)), ParseToken::ArrayEof) => {
+                Some(Step::Index(*num as isize))
+            }
+            (Some(ParseToken::All), ParseToken::ArrayEof) => Some(Step::Wildcard),
+
+            _ => {
+                self.supported = false;
+                return;
+            }
+        };
+        self.steps.extend(step);
+        self.last_token = Some(token.clone());
+    }
+}
+
+///
+/// The steps of `path`, or `None` if it uses anything this module doesn't evaluate
+///
+pub fn compile(path: &str) -> Result<Option<Vec<Step>>, String> {
+    let node = Parser::compile(path)?;
+    let mut visitor = StepParser {
+        steps: vec![],
+        last_token: None,
+        supported: true,
+    };
+    visitor.visit(&node);
+
+    // A path can't end halfway through a step, like `$..`
+    let complete = match visitor.last_token {
+        Some(ParseToken::Absolute)
+        | Some(ParseToken::Key(_))
+        | Some(ParseToken::All)
+        | Some(ParseToken::ArrayEof) => true,
+        _ => false,
+    };
+    Ok(if visitor.supported && complete {
+        Some(visitor.steps)
+    } else {
+        None
+    })
+}
+
+fn find_child<'a, F>(value: &'a Value, f: F) -> Option<&'a Value>
+where
+    F: FnMut(&'a Value) -> Option<&'a Value>,
+{
+    match value {
+        Value::Array(arr) => arr.iter().find_map(f),
+        Value::Object(map) => map.values().find_map(f),
+        _ => None,
+    }
+}
+
+///
+/// The first value `steps` lead to from `value`, counting the nodes visited on the way in `visits`
+///
+pub fn first<'a>(value: &'a Value, steps: &[Step], visits: &mut u64) -> Option<&'a Value> {
+    *visits += 1;
+    let (step, rest) = match steps.split_first() {
+        Some(split) => split,
+        None => return Some(value),
+    };
+    match step {
+        Step::Key(key) => value
+            .as_object()?
+            .get(key)
+            .and_then(|v| first(v, rest, visits)),
+        Step::Index(index) => {
+            let arr = value.as_array()?;
+            // Negative indexes count from the end, and stop at the first element
+            let index = if *index < 0 {
+                (*index + arr.len() as isize).max(0) as usize
+            } else {
+                *index as usize
+            };
+            arr.get(index).and_then(|v| first(v, rest, visits))
+        }
+        Step::Wildcard => find_child(value, |v| first(v, rest, visits)),
+        Step::Descendant(key) => descendant(value, key, rest, visits),
+    }
+}
+
+fn descendant<'a>(
+    value: &'a Value,
+    key: &str,
+    rest: &[Step],
+    visits: &mut u64,
+) -> Option<&'a Value> {
+    *visits += 1;
+    // Like jsonpath_lib: a node's own match comes before those of its descendants
+    if let Some(found) = value
+        .as_object()
+        .and_then(|map| map.get(key))
+        .and_then(|v| first(v, rest, visits))
+    {
+        return Some(found);
+    }
+    find_child(value, |v| descendant(v, key, rest, visits))
+}
+
+///
+/// Resolves an index into an array of `len` elements like `first` does
+///
+fn resolve(index: isize, len: usize) -> usize {
+    if index < 0 {
+        (index + len as isize).max(0) as usize
+    } else {
+        index as usize
+    }
+}
+
+///
+/// The locations of all the values any of `paths` leads to, as keys and non-negative indexes,
+/// each listed once. All the paths are followed in a single walk of `value`: every node is visited
+/// at most once, along with where each path that got there stands.
+///
+pub fn locate_all(value: &Value, paths: &[Vec<Step>]) -> Vec<Vec<Step>> {
+    // (path, position of its next step)
+    let states: Vec<(usize, usize)> = (0..paths.len()).map(|path| (path, 0)).collect();
+    let mut location = vec![];
+    let mut found = vec![];
+    locate(value, paths, &states, &mut location, &mut found);
+    found
+}
+
+fn push_state(states: &mut Vec<(usize, usize)>, state: (usize, usize)) {
+    if !states.contains(&state) {
+        states.push(state);
+    }
+}
+
+///
+/// Where the paths at `states` stand after a step to the member `key` or `index`
+///
+fn member_states(
+    paths: &[Vec<Step>],
+    states: &[(usize, usize)],
+    key: Option<&str>,
+    index: Option<usize>,
+    len: usize,
+) -> Vec<(usize, usize)> {
+    let mut next = vec![];
+    for &(path, pos) in states {
+        match paths[path].get(pos) {
+            Some(Step::Key(k)) if Some(k.as_str()) == key => push_state(&mut next, (path, pos + 1)),
+            Some(Step::Index(i)) if index == Some(resolve(*i, len)) => {
+                push_state(&mut next, (path, pos + 1))
+            }
+            Some(Step::Wildcard) => push_state(&mut next, (path, pos + 1)),
+            Some(Step::Descendant(k)) => {
+                if Some(k.as_str()) == key {
+                    push_state(&mut next, (path, pos + 1));
+                }
+                // Keep looking further down
+                push_state(&mut next, (path, pos));
+            }
+            _ => {}
+        }
+    }
+    next
+}
+
+fn locate(
+    value: &Value,
+    paths: &[Vec<Step>],
+    states: &[(usize, usize)],
+    location: &mut Vec<Step>,
+    found: &mut Vec<Vec<Step>>,
+) {
+    if states.iter().any(|&(path, pos)| pos == paths[path].len()) {
+        found.push(location.clone());
+    }
+    let scan = states
+        .iter()
+        .any(|&(path, pos)| match paths[path].get(pos) {
+            Some(Step::Wildcard) | Some(Step::Descendant(_)) => true,
+            _ => false,
+        });
+
+    match value {
+        Value::Object(map) => {
+            let mut visit = |key: &String, member: &Value, location: &mut Vec<Step>| {
+                let next = member_states(paths, states, Some(key), None, map.len());
+                if !next.is_empty() {
+                    location.push(Step::Key(key.clone()));
+                    locate(member, paths, &next, location, found);
+                    location.pop();
+                }
+            };
+            if scan {
+                for (key, member) in map {
+                    visit(key, member, location);
+                }
+            } else {
+                // Only the members named by the paths
+                let mut keys: Vec<&String> = vec![];
+                for &(path, pos) in states {
+                    if let Some(Step::Key(key)) = paths[path].get(pos) {
+                        if !keys.contains(&key) {
+                            keys.push(key);
+                        }
+                    }
+                }
+                for key in keys {
+                    if let Some(member) = map.get(key.as_str()) {
+                        visit(key, member, location);
+                    }
+                }
+            }
+        }
+        Value::Array(arr) => {
+            let mut visit = |index: usize, location: &mut Vec<Step>| {
+                let next = member_states(paths, states, None, Some(index), arr.len());
+                if !next.is_empty() {
+                    location.push(Step::Index(index as isize));
+                    locate(&arr[index], paths, &next, location, found);
+                    location.pop();
+                }
+            };
+            if scan {
+                for index in 0..arr.len() {
+                    visit(index, location);
+                }
+            } else {
+                let mut indexes: Vec<usize> = vec![];
+                for &(path, pos) in states {
+                    if let Some(Step::Index(index)) = paths[path].get(pos) {
+                        let index = resolve(*index, arr.len());
+                        if index < arr.len() && !indexes.contains(&index) {
+                            indexes.push(index);
+                        }
+                    }
+                }
+                indexes.sort_unstable();
+                for index in indexes {
+                    visit(index, location);
+                }
+            }
+        }
+        _ => {}
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn test_same_first_match_as_select() {
+        let doc: Value = serde_json::from_str(
+            r#"{
+                "a": {"b": [{"c": 1}, {"c": 2, "d": {"c": 3}}], "c": 0},
+                "e": [[1, 2], [3, [4, 5]]],
+                "f": {"g": {"h": "x"}, "i": {"h": "y"}},
+                "j": 7
+            }"#,
+        )
+        .unwrap();
+
+        let paths = [
+            "$",
+            "$.a",
+            "$.a.b[1].c",
+            "$['a']['c']",
+            "$.e[1][1][-1]",
+            "$.e[-10]",
+            "$.e[10]",
+            "$.*",
+            "$.*.h",
+            "$.f.*.h",
+            "$[*]",
+            "$.e[*][1]",
+            "$..c",
+            "$..h",
+            "$.a..c",
+            "$..b[1].d",
+            "$..d.c",
+            "$..missing",
+            "$.j.k",
+            "$.j[0]",
+        ];
+        for path in paths.iter() {
+            let steps = compile(path).unwrap();
+            assert!(steps.is_some(), "{}", path);
+            assert_eq!(
+                first(&doc, &steps.unwrap(), &mut 0),
+                jsonpath_lib::select(&doc, path).unwrap().first().cloned(),
+                "{}",
+                path
+            );
+        }
+
+        for path in ["$..*", "$.a[0:1]", "$.a[?(@.c)]", "$['a','e']", "$.e[0,1]"].iter() {
+            assert!(compile(path).unwrap().is_none(), "{}", path);
+        }
+    }
+
+    #[test]
+    fn test_locate_all() {
+        let doc: Value = serde_json::from_str(
+            r#"{
+                "a": {"b": [{"c": 1}, {"c": 2, "d": {"c": 3}}], "c": 0},
+                "e": [[1, 2], [3, [4, 5]]],
+                "f": {"g": {"h": "x"}, "i": {"h": "y"}}
+            }"#,
+        )
+        .unwrap();
+
+        let at = |location: &[Step]| {
+            let mut value = &doc;
+            for step in location {
+                value = match step {
+                    Step::Key(key) => &value[key.as_str()],
+                    Step::Index(index) => &value[*index as usize],
+                    _ => panic!("{:?}", location),
+                };
+            }
+            value.clone()
+        };
+        let sorted = |mut values: Vec<Value>| {
+            values.sort_by_key(|v| v.to_string());
+            values
+        };
+
+        // The same values as jsonpath_lib, alone or together
+        let paths = [
+            "$.a.b[1].c",
+            "$.e[-1][-1]",
+            "$.e[10]",
+            "$.*.h",
+            "$..c",
+            "$.f.*",
+            "$..d.c",
+        ];
+        let compiled: Vec<Vec<Step>> = paths.iter().map(|p| compile(p).unwrap().unwrap()).collect();
+        for (path, steps) in paths.iter().zip(compiled.iter()) {
+            let located = locate_all(&doc, &[steps.clone()]);
+            assert_eq!(
+                sorted(located.iter().map(|l| at(l)).collect()),
+                sorted(
+                    jsonpath_lib::select(&doc, path)
+                        .unwrap()
+                        .into_iter()
+                        .cloned()
+                        .collect()
+                ),
+                "{}",
+                path
+            );
+        }
+
+        // Every location once, even when several paths lead there
+        let located = locate_all(&doc, &compiled);
+        for (i, location) in located.iter().enumerate() {
+            assert!(!located[i + 1..].contains(location), "{:?}", location);
+        }
+        assert!(located.contains(&vec![Step::Key("a".into()), Step::Key("c".into())]));
+        assert!(located.contains(&vec![Step::Key("e".into()), Step::Index(1), Step::Index(1)]));
+        assert_eq!(located.len(), 7);
+    }
+}
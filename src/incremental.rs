@@ -0,0 +1,303 @@
+// Incremental JSON parser.
+//
+// Builds a `serde_json::Value` from text that arrives in chunks of any size, without ever holding
+// the whole text: only the containers being built and the current scalar token are kept. Scalar
+// tokens are handed to serde_json once complete, so escapes, numbers and error cases match
+// `serde_json::from_str`, and so does the nesting limit.
+
+use crate::error::Error;
+use serde_json::{Map, Value};
+use std::mem;
+
+/// The same nesting limit as serde_json's
+const MAX_DEPTH: usize = 128;
+
+enum Frame {
+    Array(Vec<Value>),
+    Object(Map<String, Value>, Option<String>),
+}
+
+#[derive(Clone, Copy, PartialEq)]
+enum State {
+    Value,
+    ArrayValueOrEnd,
+    ObjectKeyOrEnd,
+    ObjectKey,
+    Colon,
+    AfterValue,
+    String { escape: bool, key: bool },
+    Number,
+    Literal,
+    Done,
+}
+
+pub struct IncrementalParser {
+    stack: Vec<Frame>,
+    state: State,
+    token: Vec<u8>,
+    root: Option<Value>,
+    offset: usize,
+}
+
+impl IncrementalParser {
+    pub fn new() -> Self {
+        IncrementalParser {
+            stack: vec![],
+            state: State::Value,
+            token: vec![],
+            root: None,
+            offset: 0,
+        }
+    }
+
+    ///
+    /// Number of bytes fed so far
+    ///
+    pub fn offset(&self) -> usize {
+        self.offset
+    }
+
+    pub fn feed(&mut self, chunk: &[u8]) -> Result<(), Error> {
+        for &b in chunk {
+            self.byte(b)?;
+            self.offset += 1;
+        }
+        Ok(())
+    }
+
+    pub fn finish(mut self) -> Result<Value, Error> {
+        match self.state {
+            State::Number | State::Literal if self.stack.is_empty() => self.end_scalar()?,
+            _ => {}
+        }
+        match self.root.take() {
+            Some(value) => Ok(value),
+            None => Err("ERR unexpected end of JSON input".into()),
+        }
+    }
+
+    fn error(&self, msg: &str) -> Error {
+        format!("ERR {} at byte {}", msg, self.offset).into()
+    }
+
+    fn byte(&mut self, b: u8) -> Result<(), Error> {
+        match self.state {
+            State::String { escape, key } => {
+                self.token.push(b);
+                if escape {
+                    self.state = State::String { escape: false, key };
+                } else if b == b'\\' {
+                    self.state = State::String { escape: true, key };
+                } else if b == b'"' {
+                    if key {
+                        let key = serde_json::from_slice(&self.token)?;
+                        self.token.clear();
+                        if let Some(Frame::Object(_, pending)) = self.stack.last_mut() {
+                            *pending = Some(key);
+                        }
+                        self.state = State::Colon;
+                    } else {
+                        self.end_scalar()?;
+                    }
+                }
+                return Ok(());
+            }
+            State::Number => match b {
+                b'0'..=b'9' | b'-' | b'+' | b'.' | b'e' | b'E' => {
+                    self.token.push(b);
+                    return Ok(());
+                }
+                _ => self.end_scalar()?,
+            },
+            State::Literal => match b {
+                b'a'..=b'z' => {
+                    self.token.push(b);
+                    return Ok(());
+                }
+                _ => self.end_scalar()?,
+            },
+            _ => {}
+        }
+
+        if let b' ' | b'\t' | b'\n' | b'\r' = b {
+            return Ok(());
+        }
+
+        match self.state {
+            State::Value => self.begin_value(b),
+            State::ArrayValueOrEnd => {
+                if b == b']' {
+                    self.end_container()
+                } else {
+                    self.begin_value(b)
+                }
+            }
+            State::ObjectKeyOrEnd | State::ObjectKey => match b {
+                b'"' => {
+                    self.token.push(b);
+                    self.state = State::String {
+                        escape: false,
+                        key: true,
+                    };
+                    Ok(())
+                }
+                b'}' if self.state == State::ObjectKeyOrEnd => self.end_container(),
+                _ => Err(self.error("expected an object key")),
+            },
+            State::Colon => {
+                if b == b':' {
+                    self.state = State::Value;
+                    Ok(())
+                } else {
+                    Err(self.error("expected ':'"))
+                }
+            }
+            State::AfterValue => match (b, self.stack.last()) {
+                (b',', Some(Frame::Array(_))) => {
+                    self.state = State::Value;
+                    Ok(())
+                }
+                (b',', Some(Frame::Object(..))) => {
+                    self.state = State::ObjectKey;
+                    Ok(())
+                }
+                (b']', Some(Frame::Array(_))) | (b'}', Some(Frame::Object(..))) => {
+                    self.end_container()
+                }
+                _ => Err(self.error("expected ',' or the end of the container")),
+            },
+            State::Done => Err(self.error("trailing characters")),
+            State::String { .. } | State::Number | State::Literal => unreachable!(),
+        }
+    }
+
+    fn begin_value(&mut self, b: u8) -> Result<(), Error> {
+        match b {
+            b'[' | b'{' => {
+                if self.stack.len() + 1 >= MAX_DEPTH {
+                    return Err(self.error("recursion limit exceeded"));
+                }
+                if b == b'[' {
+                    self.stack.push(Frame::Array(vec![]));
+                    self.state = State::ArrayValueOrEnd;
+                } else {
+                    self.stack.push(Frame::Object(Map::new(), None));
+                    self.state = State::ObjectKeyOrEnd;
+                }
+            }
+            b'"' => {
+                self.token.push(b);
+                self.state = State::String {
+                    escape: false,
+                    key: false,
+                };
+            }
+            b'-' | b'0'..=b'9' => {
+                self.token.push(b);
+                self.state = State::Number;
+            }
+            b'a'..=b'z' => {
+                self.token.push(b);
+                self.state = State::Literal;
+            }
+            _ => return Err(self.error("expected a value")),
+        }
+        Ok(())
+    }
+
+    fn end_scalar(&mut self) -> Result<(), Error> {
+        let value = serde_json::from_slice(&self.token)
+            .map_err(|e| self.error(&format!("invalid value ({})", e)))?;
+        self.token.clear();
+        self.add_value(value);
+        Ok(())
+    }
+
+    fn end_container(&mut self) -> Result<(), Error> {
+        let value = match self.stack.pop() {
+            Some(Frame::Array(arr)) => Value::Array(arr),
+            Some(Frame::Object(map, _)) => Value::Object(map),
+            None => return Err(self.error("unexpected end of container")),
+        };
+        self.add_value(value);
+        Ok(())
+    }
+
+    fn add_value(&mut self, value: Value) {
+        match self.stack.last_mut() {
+            Some(Frame::Array(arr)) => arr.push(value),
+            Some(Frame::Object(map, pending)) => {
+                map.insert(mem::take(pending).unwrap_or_default(), value);
+            }
+            None => {
+                self.root = Some(value);
+                self.state = State::Done;
+                return;
+            }
+        }
+        self.state = State::AfterValue;
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use std::fs;
+
+    fn parse_chunked(data: &[u8], chunk_size: usize) -> Result<Value, Error> {
+        let mut parser = IncrementalParser::new();
+        for chunk in data.chunks(chunk_size) {
+            parser.feed(chunk)?;
+        }
+        parser.finish()
+    }
+
+    #[test]
+    fn test_chunks() {
+        let json = r#" {"a": [1, -2.5e3, "x\"yé", true, null, {}], "b": {"c": []}, "d": 0} "#;
+        let expected: Value = serde_json::from_str(json).unwrap();
+        for chunk_size in 1..json.len() + 1 {
+            assert_eq!(
+                parse_chunked(json.as_bytes(), chunk_size).unwrap(),
+                expected
+            );
+        }
+        assert_eq!(parse_chunked(b"42", 1).unwrap(), Value::from(42));
+        assert!(parse_chunked(b"[1,]", 1).is_err());
+        assert!(parse_chunked(b"{\"a\" 1}", 1).is_err());
+        assert!(parse_chunked(b"[1] [2]", 1).is_err());
+        assert!(parse_chunked(b"[1", 1).is_err());
+        assert!(parse_chunked(b"", 1).is_err());
+
+        // Same nesting limit as serde_json
+        for depth in &[127, 128] {
+            let json = format!("{}{}", "[".repeat(*depth), "]".repeat(*depth));
+            assert_eq!(
+                parse_chunked(json.as_bytes(), 3).is_ok(),
+                serde_json::from_str::<Value>(&json).is_ok()
+            );
+        }
+    }
+
+    #[test]
+    fn test_corpus() {
+        let dir = concat!(env!("CARGO_MANIFEST_DIR"), "/tests/files");
+        for entry in fs::read_dir(dir).unwrap() {
+            let path = entry.unwrap().path();
+            if path.extension().map_or(true, |ext| ext != "json") {
+                continue;
+            }
+            let data = fs::read(&path).unwrap();
+            let expected = serde_json::from_slice::<Value>(&data);
+            for &chunk_size in &[1, 7, 4096] {
+                match (&expected, parse_chunked(&data, chunk_size)) {
+                    (Ok(expected), Ok(value)) => assert_eq!(expected, &value, "{:?}", path),
+                    (Err(_), Err(_)) => {}
+                    (expected, value) => {
+                        panic!("{:?}: serde_json {:?}, chunked {:?}", path, expected, value)
+                    }
+                }
+            }
+        }
+    }
+}
@@ -4,27 +4,41 @@ extern crate redis_module;
 use redis_module::native_types::RedisType;
 use redis_module::raw::RedisModuleTypeMethods;
 use redis_module::{raw as rawmod, NextArg};
-use redis_module::{Context, RedisError, RedisResult, RedisValue, REDIS_OK};
+use redis_module::{Context, RedisError, RedisResult, RedisValue, ThreadSafeContext, REDIS_OK};
 use serde_json::{Number, Value};
 
+use std::collections::{HashMap, HashSet};
+use std::mem;
 use std::os::raw::c_int;
 use std::{i64, usize};
 
 mod array_index;
 mod backward;
 mod commands;
+mod defrag;
+mod digest;
 mod error;
+mod first_match;
 mod formatter;
+mod incremental;
 mod nodevisitor;
+mod offload;
+mod parser;
 mod redisjson;
+mod replication;
 mod schema; // TODO: Remove
+mod secondary_index;
+mod timer_wheel;
+mod trace;
+mod validator;
 
 use crate::array_index::ArrayIndex;
-use crate::commands::index;
+use crate::commands::{expire, index, sindex};
 use crate::error::Error;
 use crate::redisjson::{Format, Path, RedisJSON, SetOptions, ValueIndex};
+use crate::replication::replicate;
 
-pub const REDIS_JSON_TYPE_VERSION: i32 = 2;
+pub const REDIS_JSON_TYPE_VERSION: i32 = 7;
 
 static REDIS_JSON_TYPE: RedisType = RedisType::new(
     "ReJSON-RL",
@@ -36,10 +50,10 @@ static REDIS_JSON_TYPE: RedisType = RedisType::new(
         rdb_save: Some(redisjson::type_methods::rdb_save),
         aof_rewrite: None, // TODO add support
         free: Some(redisjson::type_methods::free),
+        digest: Some(redisjson::type_methods::digest),
 
         // Currently unused by Redis
         mem_usage: None,
-        digest: None,
 
         // Auxiliary data (v2)
         aux_load: Some(redisjson::type_methods::aux_load),
@@ -64,25 +78,88 @@ fn backwards_compat_path(mut path: String) -> String {
     path
 }
 
+fn parse_rev(rev: &str) -> Result<u64, RedisError> {
+    rev.parse()
+        .map_err(|_| RedisError::Str("ERR revision is not a non-negative integer"))
+}
+
+///
+/// Strips a trailing `REV <revision>` option from the arguments of a mutating command,
+/// as long as at least `min_args` arguments (including the command name) are left
+///
+fn take_rev_option(args: &mut Vec<String>, min_args: usize) -> Result<Option<u64>, RedisError> {
+    let len = args.len();
+    if len >= min_args + 2 && args[len - 2].eq_ignore_ascii_case("REV") {
+        let rev = parse_rev(&args[len - 1])?;
+        args.truncate(len - 2);
+        Ok(Some(rev))
+    } else {
+        Ok(None)
+    }
+}
+
 ///
-/// JSON.DEL <key> [path]
+/// Strips a `REV <revision>` option from the arguments of a command with a variadic tail, where
+/// it comes right after the key so that it can't be mistaken for the tail's last arguments
 ///
-fn json_del(ctx: &Context, args: Vec<String>) -> RedisResult {
+fn take_leading_rev_option(args: &mut Vec<String>) -> Result<Option<u64>, RedisError> {
+    if args.len() >= 4 && args[2].eq_ignore_ascii_case("REV") {
+        let rev = parse_rev(&args[3])?;
+        args.drain(2..4);
+        Ok(Some(rev))
+    } else {
+        Ok(None)
+    }
+}
+
+///
+/// Traces a `<command> <key> [path] ...` call, when JSON.DEBUG TRACE is on
+///
+fn trace_call(command: &'static str, args: &[String]) -> Option<trace::CallGuard> {
+    if !trace::enabled() {
+        return None;
+    }
+    let key = args.get(1).map_or("", |key| key.as_str());
+    let path = args.get(2).map_or_else(
+        || "$".to_string(),
+        |path| backwards_compat_path(path.clone()),
+    );
+    trace::begin(command, key, &path)
+}
+
+///
+/// JSON.DEL <key> [REV <revision>] [path ...]
+///
+/// The values at all the paths are found in a single walk of the document, and removed in an
+/// order that keeps the array indexes of those still to remove valid.
+///
+fn json_del(ctx: &Context, mut args: Vec<String>) -> RedisResult {
+    let rev = take_leading_rev_option(&mut args)?;
+    let _trace = trace_call("JSON.DEL", &args);
     let mut args = args.into_iter().skip(1);
 
-    let key = args.next_string()?;
-    let path = backwards_compat_path(args.next_string()?);
+    let key_name = args.next_string()?;
+    let mut paths: Vec<String> = args.map(backwards_compat_path).collect();
+    if paths.is_empty() {
+        paths.push("$".to_string());
+    }
 
-    let key = ctx.open_key_writable(&key);
+    let key = ctx.open_key_writable(&key_name);
     let deleted = match key.get_value::<RedisJSON>(&REDIS_JSON_TYPE)? {
         Some(doc) => {
-            let res = if path == "$" {
+            doc.check_rev(rev)?;
+            let res = if paths.iter().any(|path| path == "$") {
                 key.delete()?;
                 1
             } else {
-                doc.delete_path(&path)?
+                let res = doc.delete_paths(&paths)?;
+                sindex::update_document(doc);
+                res
             };
-            ctx.replicate_verbatim();
+            for path in &paths {
+                expire::forget(ctx, &key_name, path);
+            }
+            trace::phase("replicate", || ctx.replicate_verbatim());
             res
         }
         None => 0,
@@ -90,47 +167,137 @@ fn json_del(ctx: &Context, args: Vec<String>) -> RedisResult {
     Ok(deleted.into())
 }
 
-///
-/// JSON.SET <key> <path> <json> [NX | XX | FORMAT <format> | INDEX <index>]
-///
-fn json_set(ctx: &Context, args: Vec<String>) -> RedisResult {
-    let mut args = args.into_iter().skip(1);
-
-    let key = args.next_string()?;
-    let path = backwards_compat_path(args.next_string()?);
-    let value = args.next_string()?;
+struct SetArgs<'a> {
+    key: &'a str,
+    path: String,
+    value: &'a str,
+    format: Format,
+    set_option: SetOptions,
+    // The name of the index given with `INDEX`
+    index: Option<String>,
+    rev: Option<u64>,
+    schema: Option<String>,
+}
 
-    let mut format = Format::JSON;
-    let mut set_option = SetOptions::None;
-    let mut value_index = None;
+fn parse_set_args(args: &[String]) -> Result<SetArgs, RedisError> {
+    let mut args = args.iter().skip(1);
+    let mut next = || args.next().ok_or(RedisError::WrongArity);
+
+    let key = next()?;
+    let path = backwards_compat_path(next()?.to_string());
+    let value = next()?;
+
+    let mut set = SetArgs {
+        key,
+        path,
+        value,
+        format: Format::JSON,
+        set_option: SetOptions::None,
+        index: None,
+        rev: None,
+        schema: None,
+    };
 
-    while let Some(s) = args.next() {
+    while let Ok(s) = next() {
         match s.to_uppercase().as_str() {
-            "NX" => set_option = SetOptions::NotExists,
-            "XX" => set_option = SetOptions::AlreadyExists,
+            "NX" => set.set_option = SetOptions::NotExists,
+            "XX" => set.set_option = SetOptions::AlreadyExists,
             "FORMAT" => {
-                format = Format::from_str(args.next_string()?.as_str())?;
+                set.format = Format::from_str(next()?.as_str())?;
             }
             "INDEX" => {
-                value_index = Some(ValueIndex {
-                    key: key.clone(),
-                    index_name: args.next_string()?,
-                });
+                set.index = Some(next()?.clone());
+            }
+            "REV" => {
+                set.rev = Some(parse_rev(next()?)?);
+            }
+            "SCHEMA" => {
+                set.schema = Some(next()?.clone());
             }
             _ => break,
         };
     }
+    Ok(set)
+}
 
-    let redis_key = ctx.open_key_writable(&key);
+///
+/// JSON.SET <key> <path> <json> [NX | XX | FORMAT <format> | INDEX <index> | REV <revision>
+///                               | SCHEMA <name>]
+///
+/// Values of at least `offload::threshold()` bytes are parsed by the worker pool, while the
+/// client is blocked, and then set while holding the GIL.
+///
+fn json_set(ctx: &Context, args: Vec<String>) -> RedisResult {
+    let _trace = trace_call("JSON.SET", &args);
+    let set = parse_set_args(&args)?;
+
+    if offload::should_offload(ctx, set.value.len()) {
+        let blocked_client = ctx.block_client();
+        offload::spawn(move || {
+            // Already validated on the main thread
+            let set = parse_set_args(&args).unwrap();
+            let argv: Vec<&str> = args[1..].iter().map(|arg| arg.as_str()).collect();
+
+            let thread_ctx = ThreadSafeContext::with_blocked_client(blocked_client);
+            let res = RedisJSON::parse_str(set.value, set.format)
+                .map_err(RedisError::from)
+                .and_then(|json| {
+                    let ctx = thread_ctx.lock();
+                    // No verbatim replication from a thread safe context
+                    apply_set(&ctx, set, json, &|ctx: &Context| {
+                        replicate(ctx, "JSON.SET", &argv)
+                    })
+                });
+            thread_ctx.reply(res);
+        });
+        return Ok(RedisValue::NoReply);
+    }
+
+    let json = RedisJSON::parse_str(set.value, set.format)?;
+    apply_set(ctx, set, json, &|ctx: &Context| ctx.replicate_verbatim())
+}
+
+fn apply_set(
+    ctx: &Context,
+    set: SetArgs,
+    json: Value,
+    replicate: &dyn Fn(&Context),
+) -> RedisResult {
+    let SetArgs {
+        key,
+        path,
+        set_option,
+        index,
+        rev,
+        schema,
+        ..
+    } = set;
+    let value_index = index.map(|index_name| ValueIndex {
+        key: key.to_string(),
+        index_name,
+        db: expire::selected_db(ctx),
+    });
+
+    let redis_key = ctx.open_key_writable(key);
     let current = redis_key.get_value::<RedisJSON>(&REDIS_JSON_TYPE)?;
 
     match (current, set_option) {
         (Some(ref mut doc), ref op) => {
-            if doc.set_value(&value, &path, op, format)? {
+            doc.check_rev(rev)?;
+            let updated = match &schema {
+                Some(name) => doc.set_json_with_schema(json, &path, op, name)?,
+                None => doc.set_json(json, &path, op)?,
+            };
+            if updated {
                 if let Some(value_index) = value_index {
-                    index::add_document(&key, &value_index.index_name, &doc)?;
+                    index::add_document(key, &value_index.index_name, &doc)?;
+                    if let Some(old) = doc.value_index.replace(value_index) {
+                        sindex::remove_document(&old);
+                    }
                 }
-                ctx.replicate_verbatim();
+                sindex::update_document(doc);
+                expire::forget(ctx, key, &path);
+                trace::phase("replicate", || replicate(ctx));
                 REDIS_OK
             } else {
                 Ok(RedisValue::Null)
@@ -138,7 +305,14 @@ fn json_set(ctx: &Context, args: Vec<String>) -> RedisResult {
         }
         (None, SetOptions::AlreadyExists) => Ok(RedisValue::Null),
         (None, _) => {
-            let doc = RedisJSON::from_str(&value, &value_index, format)?;
+            // A missing key is at revision 0
+            if rev.map_or(false, |rev| rev != 0) {
+                return Err(RedisError::Str("ERR revision mismatch"));
+            }
+            let mut doc = RedisJSON::from_value(json, &value_index);
+            if let Some(name) = &schema {
+                doc.bind_schema(name)?;
+            }
             if path == "$" {
                 redis_key.set_value(&REDIS_JSON_TYPE, doc)?;
 
@@ -147,9 +321,11 @@ fn json_set(ctx: &Context, args: Vec<String>) -> RedisResult {
                     // since the original doc is consumed by set_value.
                     // Can we do better than this?
                     let doc = redis_key.get_value(&REDIS_JSON_TYPE)?.unwrap();
-                    index::add_document(&key, &value_index.index_name, doc)?;
+                    index::add_document(key, &value_index.index_name, doc)?;
+                    sindex::update_document(doc);
                 }
-                ctx.replicate_verbatim();
+                expire::forget(ctx, key, &path);
+                trace::phase("replicate", || replicate(ctx));
                 REDIS_OK
             } else {
                 Err(RedisError::Str(
@@ -160,13 +336,79 @@ fn json_set(ctx: &Context, args: Vec<String>) -> RedisResult {
     }
 }
 
+///
+/// JSON.MSET <key> <path> <json> [<key> <path> <json> ...]
+///
+/// The writes are applied in order to copies of the documents, which only replace them once
+/// every write succeeded. Documents created by the batch are built aside the same way, and only
+/// added to the keyspace at the end.
+///
+fn json_mset(ctx: &Context, args: Vec<String>) -> RedisResult {
+    let _trace = trace_call("JSON.MSET", &args);
+    if args.len() < 4 || (args.len() - 1) % 3 != 0 {
+        return Err(RedisError::WrongArity);
+    }
+
+    let mut staged: HashMap<&str, RedisJSON> = HashMap::new();
+    let mut created: HashSet<&str> = HashSet::new();
+    let mut written: Vec<(&str, String)> = vec![];
+
+    for write in args[1..].chunks(3) {
+        let key = write[0].as_str();
+        let path = backwards_compat_path(write[1].clone());
+        let json = RedisJSON::parse_str(&write[2], Format::JSON)?;
+
+        if !staged.contains_key(key) {
+            match ctx.open_key(key).get_value::<RedisJSON>(&REDIS_JSON_TYPE)? {
+                Some(doc) => {
+                    staged.insert(key, doc.stage());
+                }
+                None if path == "$" => {
+                    staged.insert(key, RedisJSON::from_value(json, &None));
+                    created.insert(key);
+                    written.push((key, path));
+                    continue;
+                }
+                None => {
+                    return Err(RedisError::Str(
+                        "ERR new objects must be created at the root",
+                    ))
+                }
+            }
+        }
+        if let Some(doc) = staged.get_mut(key) {
+            doc.set_json(json, &path, &SetOptions::None)?;
+        }
+        written.push((key, path));
+    }
+
+    for (key, mut doc) in staged {
+        let redis_key = ctx.open_key_writable(key);
+        if created.contains(key) {
+            redis_key.set_value(&REDIS_JSON_TYPE, doc)?;
+        } else if let Some(current) = redis_key.get_value::<RedisJSON>(&REDIS_JSON_TYPE)? {
+            mem::swap(current, &mut doc);
+            sindex::update_document(current);
+        }
+    }
+    for (key, path) in written {
+        expire::forget(ctx, key, &path);
+    }
+
+    trace::phase("replicate", || ctx.replicate_verbatim());
+    REDIS_OK
+}
+
 ///
 /// JSON.GET <key>
 ///         [INDENT indentation-string]
 ///         [NEWLINE line-break-string]
 ///         [SPACE space-string]
+///         [IFREV revision]
 ///         [path ...]
 ///
+/// Serializing a value of at least `offload::threshold()` bytes is left to the worker pool.
+///
 /// TODO add support for multi path
 fn json_get(ctx: &Context, args: Vec<String>) -> RedisResult {
     let mut args = args.into_iter().skip(1);
@@ -177,6 +419,7 @@ fn json_get(ctx: &Context, args: Vec<String>) -> RedisResult {
     let mut indent = String::new();
     let mut space = String::new();
     let mut newline = String::new();
+    let mut if_rev = None;
     while let Ok(arg) = args.next_string() {
         match arg.to_uppercase().as_str() {
             "INDENT" => {
@@ -195,6 +438,9 @@ fn json_get(ctx: &Context, args: Vec<String>) -> RedisResult {
             "FORMAT" => {
                 format = Format::from_str(args.next_string()?.as_str())?;
             }
+            "IFREV" => {
+                if_rev = Some(parse_rev(&args.next_string()?)?);
+            }
             _ => {
                 paths.push(Path::new(arg));
             }
@@ -205,16 +451,44 @@ fn json_get(ctx: &Context, args: Vec<String>) -> RedisResult {
     if paths.is_empty() {
         paths.push(Path::new("$".to_string()));
     }
+    let _trace = if trace::enabled() {
+        let path: Vec<&str> = paths.iter().map(|path| path.path.as_str()).collect();
+        trace::begin("JSON.GET", &key, &path.join(" "))
+    } else {
+        None
+    };
 
     let key = ctx.open_key_writable(&key);
-    let value = match key.get_value::<RedisJSON>(&REDIS_JSON_TYPE)? {
-        Some(doc) => doc
-            .to_json(&mut paths, indent, newline, space, format)?
-            .into(),
-        None => RedisValue::Null,
+    let doc = match key.get_value::<RedisJSON>(&REDIS_JSON_TYPE)? {
+        Some(doc) => doc,
+        None => return Ok(RedisValue::Null),
+    };
+    if if_rev == Some(doc.rev()) {
+        return Ok(RedisValue::SimpleStringStatic("NOTMODIFIED"));
+    }
+    let rev = if_rev.map(|_| doc.rev());
+    let reply = move |json: String| match rev {
+        Some(rev) => RedisValue::Array(vec![RedisValue::Integer(rev as i64), json.into()]),
+        None => json.into(),
     };
 
-    Ok(value)
+    let selected = doc.select(&mut paths)?;
+    if offload::is_large(&selected, offload::threshold()) && offload::can_block(ctx) {
+        // Serialize a snapshot, since the document may change before the worker is done
+        let snapshot = selected.into_owned();
+        let blocked_client = ctx.block_client();
+        offload::spawn(move || {
+            let res = RedisJSON::format(&snapshot, &indent, &newline, &space, format)
+                .map(reply)
+                .map_err(RedisError::from);
+            ThreadSafeContext::with_blocked_client(blocked_client).reply(res);
+        });
+        return Ok(RedisValue::NoReply);
+    }
+
+    Ok(reply(RedisJSON::format(
+        &selected, &indent, &newline, &space, format,
+    )?))
 }
 
 ///
@@ -228,6 +502,11 @@ fn json_mget(ctx: &Context, args: Vec<String>) -> RedisResult {
     args.last().ok_or(RedisError::WrongArity).and_then(|path| {
         let path = backwards_compat_path(path.to_string());
         let keys = &args[1..args.len() - 1];
+        let _trace = if trace::enabled() {
+            trace::begin("JSON.MGET", &keys.join(" "), &path)
+        } else {
+            None
+        };
 
         let results: Result<Vec<RedisValue>, RedisError> = keys
             .iter()
@@ -250,6 +529,7 @@ fn json_mget(ctx: &Context, args: Vec<String>) -> RedisResult {
 /// JSON.STRLEN <key> [path]
 ///
 fn json_str_len(ctx: &Context, args: Vec<String>) -> RedisResult {
+    let _trace = trace_call("JSON.STRLEN", &args);
     json_len(ctx, args, |doc, path| doc.str_len(path))
 }
 
@@ -257,6 +537,7 @@ fn json_str_len(ctx: &Context, args: Vec<String>) -> RedisResult {
 /// JSON.TYPE <key> [path]
 ///
 fn json_type(ctx: &Context, args: Vec<String>) -> RedisResult {
+    let _trace = trace_call("JSON.TYPE", &args);
     let mut args = args.into_iter().skip(1);
     let key = args.next_string()?;
     let path = backwards_compat_path(args.next_string()?);
@@ -278,6 +559,7 @@ fn json_type(ctx: &Context, args: Vec<String>) -> RedisResult {
 /// JSON.NUMINCRBY <key> <path> <number>
 ///
 fn json_num_incrby(ctx: &Context, args: Vec<String>) -> RedisResult {
+    let _trace = trace_call("JSON.NUMINCRBY", &args);
     json_num_op(ctx, args, |i1, i2| i1 + i2, |f1, f2| f1 + f2)
 }
 
@@ -285,6 +567,7 @@ fn json_num_incrby(ctx: &Context, args: Vec<String>) -> RedisResult {
 /// JSON.NUMMULTBY <key> <path> <number>
 ///
 fn json_num_multby(ctx: &Context, args: Vec<String>) -> RedisResult {
+    let _trace = trace_call("JSON.NUMMULTBY", &args);
     json_num_op(ctx, args, |i1, i2| i1 * i2, |f1, f2| f1 * f2)
 }
 
@@ -292,14 +575,16 @@ fn json_num_multby(ctx: &Context, args: Vec<String>) -> RedisResult {
 /// JSON.NUMPOWBY <key> <path> <number>
 ///
 fn json_num_powby(ctx: &Context, args: Vec<String>) -> RedisResult {
+    let _trace = trace_call("JSON.NUMPOWBY", &args);
     json_num_op(ctx, args, |i1, i2| i1.pow(i2 as u32), |f1, f2| f1.powf(f2))
 }
 
-fn json_num_op<I, F>(ctx: &Context, args: Vec<String>, op_i64: I, op_f64: F) -> RedisResult
+fn json_num_op<I, F>(ctx: &Context, mut args: Vec<String>, op_i64: I, op_f64: F) -> RedisResult
 where
     I: Fn(i64, i64) -> i64,
     F: Fn(f64, f64) -> f64,
 {
+    let rev = take_rev_option(&mut args, 4)?;
     let mut args = args.into_iter().skip(1);
 
     let key = args.next_string()?;
@@ -311,12 +596,15 @@ where
     key.get_value::<RedisJSON>(&REDIS_JSON_TYPE)?
         .ok_or_else(RedisError::nonexistent_key)
         .and_then(|doc| {
+            doc.check_rev(rev)?;
             doc.value_op(&path, |value| {
                 do_json_num_op(&number, value, &op_i64, &op_f64)
             })
             .map(|v| {
-                ctx.replicate_verbatim();
-                v.to_string().into()
+                sindex::update_document(doc);
+                trace::phase("replicate", || ctx.replicate_verbatim());
+                v.map_or_else(|| Value::Null.to_string(), |v| v.to_string())
+                    .into()
             })
             .map_err(|e| e.into())
         })
@@ -324,10 +612,10 @@ where
 
 fn do_json_num_op<I, F>(
     in_value: &str,
-    curr_value: &Value,
+    curr_value: &mut Value,
     op_i64: I,
     op_f64: F,
-) -> Result<Value, Error>
+) -> Result<Number, Error>
 where
     I: FnOnce(i64, i64) -> i64,
     F: FnOnce(f64, f64) -> f64,
@@ -335,7 +623,7 @@ where
     if let Value::Number(curr_value) = curr_value {
         let in_value = &serde_json::from_str(in_value)?;
         if let Value::Number(in_value) = in_value {
-            let num_res = match (curr_value.as_i64(), in_value.as_i64()) {
+            let num_res: Number = match (curr_value.as_i64(), in_value.as_i64()) {
                 (Some(num1), Some(num2)) => op_i64(num1, num2).into(),
                 _ => {
                     let num1 = curr_value.as_f64().unwrap();
@@ -344,7 +632,8 @@ where
                 }
             };
 
-            Ok(Value::Number(num_res))
+            *curr_value = num_res.clone();
+            Ok(num_res)
         } else {
             Err(err_json(in_value, "number"))
         }
@@ -362,9 +651,11 @@ fn err_json(value: &Value, expected_value: &'static str) -> Error {
 }
 
 ///
-/// JSON.STRAPPEND <key> [path] <json-string>
+/// JSON.STRAPPEND <key> [path] <json-string> [REV <revision>]
 ///
-fn json_str_append(ctx: &Context, args: Vec<String>) -> RedisResult {
+fn json_str_append(ctx: &Context, mut args: Vec<String>) -> RedisResult {
+    let _trace = trace_call("JSON.STRAPPEND", &args);
+    let rev = take_rev_option(&mut args, 3)?;
     let mut args = args.into_iter().skip(1);
 
     let key = args.next_string()?;
@@ -387,34 +678,37 @@ fn json_str_append(ctx: &Context, args: Vec<String>) -> RedisResult {
     key.get_value::<RedisJSON>(&REDIS_JSON_TYPE)?
         .ok_or_else(RedisError::nonexistent_key)
         .and_then(|doc| {
+            doc.check_rev(rev)?;
             doc.value_op(&path, |value| do_json_str_append(&json, value))
-                .map(|v| {
-                    ctx.replicate_verbatim();
-                    v.as_str().map_or(usize::MAX, |v| v.len()).into()
+                .map(|len| {
+                    sindex::update_document(doc);
+                    trace::phase("replicate", || ctx.replicate_verbatim());
+                    len.unwrap_or(usize::MAX).into()
                 })
                 .map_err(|e| e.into())
         })
 }
 
-fn do_json_str_append(json: &str, value: &Value) -> Result<Value, Error> {
-    value
-        .as_str()
-        .ok_or_else(|| err_json(value, "string"))
-        .and_then(|curr| {
-            let v = serde_json::from_str(json)?;
-            if let Value::String(s) = v {
-                let new_value = [curr, s.as_str()].concat();
-                Ok(Value::String(new_value))
-            } else {
-                Err(format!("ERR wrong type of value - expected string but found {}", v).into())
-            }
-        })
+fn do_json_str_append(json: &str, value: &mut Value) -> Result<usize, Error> {
+    if let Value::String(curr) = value {
+        let v = serde_json::from_str(json)?;
+        if let Value::String(s) = v {
+            curr.push_str(&s);
+            Ok(curr.len())
+        } else {
+            Err(format!("ERR wrong type of value - expected string but found {}", v).into())
+        }
+    } else {
+        Err(err_json(value, "string"))
+    }
 }
 
 ///
-/// JSON.ARRAPPEND <key> <path> <json> [json ...]
+/// JSON.ARRAPPEND <key> <path> <json> [json ...] [REV <revision>]
 ///
-fn json_arr_append(ctx: &Context, args: Vec<String>) -> RedisResult {
+fn json_arr_append(ctx: &Context, mut args: Vec<String>) -> RedisResult {
+    let _trace = trace_call("JSON.ARRAPPEND", &args);
+    let rev = take_rev_option(&mut args, 4)?;
     let mut args = args.into_iter().skip(1).peekable();
 
     let key = args.next_string()?;
@@ -428,30 +722,32 @@ fn json_arr_append(ctx: &Context, args: Vec<String>) -> RedisResult {
     key.get_value::<RedisJSON>(&REDIS_JSON_TYPE)?
         .ok_or_else(RedisError::nonexistent_key)
         .and_then(|doc| {
+            doc.check_rev(rev)?;
             doc.value_op(&path, |value| do_json_arr_append(args.clone(), value))
-                .map(|v| {
-                    ctx.replicate_verbatim();
-                    v.as_array().map_or(usize::MAX, |v| v.len()).into()
+                .map(|len| {
+                    sindex::update_document(doc);
+                    trace::phase("replicate", || ctx.replicate_verbatim());
+                    len.unwrap_or(usize::MAX).into()
                 })
                 .map_err(|e| e.into())
         })
 }
 
-fn do_json_arr_append<I>(args: I, value: &Value) -> Result<Value, Error>
+fn do_json_arr_append<I>(args: I, value: &mut Value) -> Result<usize, Error>
 where
     I: Iterator<Item = String>,
 {
-    value
-        .as_array()
-        .ok_or_else(|| err_json(value, "array"))
-        .and_then(|curr| {
-            let items: Vec<Value> = args
-                .map(|json| serde_json::from_str(&json))
-                .collect::<Result<_, _>>()?;
-
-            let new_value = [curr.as_slice(), &items].concat();
-            Ok(Value::Array(new_value))
-        })
+    if let Value::Array(curr) = value {
+        // Parsed first, so that nothing is appended if one of them is invalid
+        let items: Vec<Value> = args
+            .map(|json| parser::from_str(&json))
+            .collect::<Result<_, _>>()?;
+
+        curr.extend(items);
+        Ok(curr.len())
+    } else {
+        Err(err_json(value, "array"))
+    }
 }
 
 ///
@@ -460,6 +756,7 @@ where
 /// scalar - number, string, Boolean (true or false), or null
 ///
 fn json_arr_index(ctx: &Context, args: Vec<String>) -> RedisResult {
+    let _trace = trace_call("JSON.ARRINDEX", &args);
     let mut args = args.into_iter().skip(1);
 
     let key = args.next_string()?;
@@ -480,9 +777,11 @@ fn json_arr_index(ctx: &Context, args: Vec<String>) -> RedisResult {
 }
 
 ///
-/// JSON.ARRINSERT <key> <path> <index> <json> [json ...]
+/// JSON.ARRINSERT <key> <path> <index> <json> [json ...] [REV <revision>]
 ///
-fn json_arr_insert(ctx: &Context, args: Vec<String>) -> RedisResult {
+fn json_arr_insert(ctx: &Context, mut args: Vec<String>) -> RedisResult {
+    let _trace = trace_call("JSON.ARRINSERT", &args);
+    let rev = take_rev_option(&mut args, 5)?;
     let mut args = args.into_iter().skip(1).peekable();
 
     let key = args.next_string()?;
@@ -497,55 +796,59 @@ fn json_arr_insert(ctx: &Context, args: Vec<String>) -> RedisResult {
     key.get_value::<RedisJSON>(&REDIS_JSON_TYPE)?
         .ok_or_else(RedisError::nonexistent_key)
         .and_then(|doc| {
+            doc.check_rev(rev)?;
             doc.value_op(&path, |value| {
                 do_json_arr_insert(args.clone(), index, value)
             })
-            .map(|v| {
-                ctx.replicate_verbatim();
-                v.as_array().map_or(usize::MAX, |v| v.len()).into()
+            .map(|len| {
+                sindex::update_document(doc);
+                trace::phase("replicate", || ctx.replicate_verbatim());
+                len.unwrap_or(usize::MAX).into()
             })
             .map_err(|e| e.into())
         })
 }
 
-fn do_json_arr_insert<I>(args: I, index: i64, value: &Value) -> Result<Value, Error>
+fn do_json_arr_insert<I>(args: I, index: i64, value: &mut Value) -> Result<usize, Error>
 where
     I: Iterator<Item = String>,
 {
-    value
-        .as_array()
-        .ok_or_else(|| err_json(value, "array"))
-        .and_then(|curr| {
-            let len = curr.len() as i64;
-
-            if !(-len..len).contains(&index) {
-                return Err("ERR index out of bounds".into());
-            }
+    if let Value::Array(curr) = value {
+        let len = curr.len() as i64;
 
-            let index = index.normalize(len);
+        if !(-len..len).contains(&index) {
+            return Err("ERR index out of bounds".into());
+        }
 
-            let items: Vec<Value> = args
-                .map(|json| serde_json::from_str(&json))
-                .collect::<Result<_, _>>()?;
+        let index = index.normalize(len);
 
-            let mut new_value = curr.to_owned();
-            new_value.splice(index..index, items.into_iter());
+        let items: Vec<Value> = args
+            .map(|json| parser::from_str(&json))
+            .collect::<Result<_, _>>()?;
 
-            Ok(Value::Array(new_value))
-        })
+        curr.splice(index..index, items);
+        Ok(curr.len())
+    } else {
+        Err(err_json(value, "array"))
+    }
 }
 
 ///
 /// JSON.ARRLEN <key> [path]
 ///
 fn json_arr_len(ctx: &Context, args: Vec<String>) -> RedisResult {
+    let _trace = trace_call("JSON.ARRLEN", &args);
     json_len(ctx, args, |doc, path| doc.arr_len(path))
 }
 
 ///
-/// JSON.ARRPOP <key> [path [index]]
+/// JSON.ARRPOP <key> [path [index]] [REV <revision>]
+///
+/// `REV` needs an explicit path, or `JSON.ARRPOP key REV 1` would also pop from path `REV`.
 ///
-fn json_arr_pop(ctx: &Context, args: Vec<String>) -> RedisResult {
+fn json_arr_pop(ctx: &Context, mut args: Vec<String>) -> RedisResult {
+    let _trace = trace_call("JSON.ARRPOP", &args);
+    let rev = take_rev_option(&mut args, 3)?;
     let mut args = args.into_iter().skip(1);
 
     let key = args.next_string()?;
@@ -560,48 +863,51 @@ fn json_arr_pop(ctx: &Context, args: Vec<String>) -> RedisResult {
         .unwrap_or(("$".to_string(), i64::MAX));
 
     let key = ctx.open_key_writable(&key);
-    let mut res = Value::Null;
 
-    key.get_value::<RedisJSON>(&REDIS_JSON_TYPE)?
+    let res = key
+        .get_value::<RedisJSON>(&REDIS_JSON_TYPE)?
         .ok_or_else(RedisError::nonexistent_key)
         .and_then(|doc| {
-            doc.value_op(&path, |value| do_json_arr_pop(index, &mut res, value))
+            doc.check_rev(rev)?;
+            doc.value_op(&path, |value| do_json_arr_pop(index, value))
                 .map(|v| {
-                    ctx.replicate_verbatim();
-                    v
+                    sindex::update_document(doc);
+                    trace::phase("replicate", || ctx.replicate_verbatim());
+                    v.unwrap_or(Value::Null)
                 })
                 .map_err(|e| e.into())
         })?;
     Ok(RedisJSON::serialize(&res, Format::JSON)?.into())
 }
 
-fn do_json_arr_pop(mut index: i64, res: &mut Value, value: &Value) -> Result<Value, Error> {
-    value
-        .as_array()
-        .ok_or_else(|| err_json(value, "array"))
-        .and_then(|curr| {
-            let len = curr.len() as i64;
+fn do_json_arr_pop(mut index: i64, value: &mut Value) -> Result<Value, Error> {
+    if let Value::Array(curr) = value {
+        let len = curr.len() as i64;
 
-            index = index.min(len - 1);
+        index = index.min(len - 1);
 
-            if index < 0 {
-                index += len;
-            }
+        if index < 0 {
+            index += len;
+        }
 
-            if index >= len || index < 0 {
-                return Err("ERR index out of bounds".into());
-            }
+        if index >= len || index < 0 {
+            return Err("ERR index out of bounds".into());
+        }
 
-            let mut new_value = curr.to_owned();
-            *res = new_value.remove(index as usize);
-            Ok(Value::Array(new_value))
-        })
+        let popped = curr.remove(index as usize);
+        defrag::reclaim(value);
+        Ok(popped)
+    } else {
+        Err(err_json(value, "array"))
+    }
 }
 
 ///
-/// JSON.ARRTRIM <key> <path> <start> <stop>
+/// JSON.ARRTRIM <key> <path> <start> <stop> [REV <revision>]
 ///
-fn json_arr_trim(ctx: &Context, args: Vec<String>) -> RedisResult {
+fn json_arr_trim(ctx: &Context, mut args: Vec<String>) -> RedisResult {
+    let _trace = trace_call("JSON.ARRTRIM", &args);
+    let rev = take_rev_option(&mut args, 5)?;
     let mut args = args.into_iter().skip(1);
 
     let key = args.next_string()?;
@@ -614,38 +920,43 @@ fn json_arr_trim(ctx: &Context, args: Vec<String>) -> RedisResult {
     key.get_value::<RedisJSON>(&REDIS_JSON_TYPE)?
         .ok_or_else(RedisError::nonexistent_key)
         .and_then(|doc| {
-            doc.value_op(&path, |value| do_json_arr_trim(start, stop, &value))
-                .map(|v| {
-                    ctx.replicate_verbatim();
-                    v.as_array().map_or(usize::MAX, |v| v.len()).into()
+            doc.check_rev(rev)?;
+            doc.value_op(&path, |value| do_json_arr_trim(start, stop, value))
+                .map(|len| {
+                    sindex::update_document(doc);
+                    trace::phase("replicate", || ctx.replicate_verbatim());
+                    len.unwrap_or(usize::MAX).into()
                 })
                 .map_err(|e| e.into())
         })
 }
 
-fn do_json_arr_trim(start: i64, stop: i64, value: &Value) -> Result<Value, Error> {
-    value
-        .as_array()
-        .ok_or_else(|| err_json(value, "array"))
-        .and_then(|curr| {
-            let len = curr.len() as i64;
-            let stop = stop.normalize(len);
+fn do_json_arr_trim(start: i64, stop: i64, value: &mut Value) -> Result<usize, Error> {
+    if let Value::Array(curr) = value {
+        let len = curr.len() as i64;
+        let stop = stop.normalize(len);
 
-            let range = if start > len || start > stop as i64 {
-                0..0 // Return an empty array
-            } else {
-                start.normalize(len)..(stop + 1)
-            };
+        let range = if start > len || start > stop as i64 {
+            0..0 // Leave an empty array
+        } else {
+            start.normalize(len)..(stop + 1)
+        };
 
-            let res = &curr[range];
-            Ok(Value::Array(res.to_vec()))
-        })
+        curr.truncate(range.end);
+        curr.drain(..range.start.min(curr.len()));
+        let len = curr.len();
+        defrag::reclaim(value);
+        Ok(len)
+    } else {
+        Err(err_json(value, "array"))
+    }
 }
 
 ///
 /// JSON.OBJKEYS <key> [path]
 ///
 fn json_obj_keys(ctx: &Context, args: Vec<String>) -> RedisResult {
+    let _trace = trace_call("JSON.OBJKEYS", &args);
     let mut args = args.into_iter().skip(1);
     let key = args.next_string()?;
     let path = backwards_compat_path(args.next_string()?);
@@ -664,9 +975,72 @@ fn json_obj_keys(ctx: &Context, args: Vec<String>) -> RedisResult {
 /// JSON.OBJLEN <key> [path]
 ///
 fn json_obj_len(ctx: &Context, args: Vec<String>) -> RedisResult {
+    let _trace = trace_call("JSON.OBJLEN", &args);
     json_len(ctx, args, |doc, path| doc.obj_len(path))
 }
 
+///
+/// JSON.DIGEST <key> [path]
+///
+/// Cached digests make this O(depth) after a write, as only the containers on the written path
+/// are hashed again.
+///
+fn json_digest(ctx: &Context, args: Vec<String>) -> RedisResult {
+    let _trace = trace_call("JSON.DIGEST", &args);
+    let mut args = args.into_iter().skip(1);
+    let key = args.next_string()?;
+    let path = args
+        .next()
+        .map_or_else(|| "$".to_string(), backwards_compat_path);
+    args.done()?;
+
+    let key = ctx.open_key(&key);
+    let value = match key.get_value::<RedisJSON>(&REDIS_JSON_TYPE)? {
+        Some(doc) => format!("{:016x}", doc.digest(&path)?).into(),
+        None => RedisValue::Null,
+    };
+    Ok(value)
+}
+
+///
+/// JSON.COPY <src> <dst> [path]
+///
+/// Copying the root shares the whole document with the source, in constant time and memory, until
+/// either of them is written to. Sharing is all or nothing: that first write copies the whole
+/// document, whatever the size of the change. Copying any other path is a deep copy, right away.
+///
+fn json_copy(ctx: &Context, args: Vec<String>) -> RedisResult {
+    let _trace = trace_call("JSON.COPY", &args);
+    let mut args = args.into_iter().skip(1);
+    let src = args.next_string()?;
+    let dst = args.next_string()?;
+    let path = args
+        .next()
+        .map_or_else(|| "$".to_string(), backwards_compat_path);
+    args.done()?;
+
+    let copy = match ctx
+        .open_key(&src)
+        .get_value::<RedisJSON>(&REDIS_JSON_TYPE)?
+    {
+        Some(doc) if path == "$" => doc.share(),
+        Some(doc) => doc.copy_of(&path)?,
+        None => return Ok(RedisValue::Integer(0)),
+    };
+
+    let key = ctx.open_key_writable(&dst);
+    if key.get_value::<RedisJSON>(&REDIS_JSON_TYPE)?.is_some() {
+        return Ok(RedisValue::Integer(0));
+    }
+    key.set_value(&REDIS_JSON_TYPE, copy)?;
+    expire::forget(ctx, &dst, "$");
+    if let Some(doc) = key.get_value::<RedisJSON>(&REDIS_JSON_TYPE)? {
+        sindex::update_document(doc);
+    }
+    trace::phase("replicate", || ctx.replicate_verbatim());
+    Ok(RedisValue::Integer(1))
+}
+
 ///
 /// JSON.DEBUG <subcommand & arguments>
 ///
@@ -688,10 +1062,48 @@ fn json_debug(ctx: &Context, args: Vec<String>) -> RedisResult {
             };
             Ok(value.into())
         }
+        "OFFLOAD" => {
+            if let Some(threshold) = args.next() {
+                let threshold = threshold
+                    .parse()
+                    .map_err(|_| RedisError::Str("ERR threshold is not a non-negative integer"))?;
+                args.done()?;
+                offload::set_threshold(threshold);
+            }
+            Ok(RedisValue::Integer(offload::threshold() as i64))
+        }
+        "PARSER" => {
+            if let Some(backend) = args.next() {
+                let backend = parser::Backend::from_str(&backend)?;
+                args.done()?;
+                parser::set_backend(backend)?;
+            }
+            Ok(RedisValue::SimpleStringStatic(parser::backend().name()))
+        }
+        "DEFRAG" => {
+            let key = args.next_string()?;
+            args.done()?;
+
+            // Checks the type
+            ctx.open_key(&key)
+                .get_value::<RedisJSON>(&REDIS_JSON_TYPE)?;
+            let (mut budget, mut moved) = (usize::MAX, 0);
+            defrag::defrag_key(ctx, &key, &mut vec![], &mut budget, &mut moved);
+            Ok(RedisValue::Integer(moved as i64))
+        }
+        "TRACE" => json_debug_trace(args),
         "HELP" => {
             let results = vec![
-                "MEMORY <key> [path] - reports memory usage",
-                "HELP                - this message",
+                "MEMORY <key> [path]   - reports memory usage",
+                "OFFLOAD [threshold]   - gets or sets the payload size from which parsing and",
+                "                        serializing run on worker threads, 0 disables it",
+                "PARSER [SCALAR|SIMD]  - gets or sets the JSON parser",
+                "DEFRAG <key>          - moves the document to fresh allocations",
+                "TRACE ON [SIZE <n>] [SLOWER-THAN <usec>]",
+                "                      - traces the phases of the last n calls, or of those",
+                "                        taking at least usec microseconds",
+                "TRACE OFF|GET|RESET   - stops tracing, lists or forgets the traced calls",
+                "HELP                  - this message",
             ];
             Ok(results.into())
         }
@@ -701,10 +1113,84 @@ fn json_debug(ctx: &Context, args: Vec<String>) -> RedisResult {
     }
 }
 
+///
+/// JSON.DEBUG TRACE ON [SIZE <n>] [SLOWER-THAN <usec>]
+/// JSON.DEBUG TRACE OFF|GET|RESET
+///
+fn json_debug_trace<I: Iterator<Item = String>>(mut args: I) -> RedisResult {
+    match args.next_string()?.to_uppercase().as_str() {
+        "ON" => {
+            let mut size = trace::DEFAULT_SIZE;
+            let mut slower_than_us = 0;
+            while let Some(arg) = args.next() {
+                let value = args.next_i64()?;
+                if value < 0 {
+                    return Err(RedisError::Str("ERR value is not a non-negative integer"));
+                }
+                match arg.to_uppercase().as_str() {
+                    "SIZE" => size = value as usize,
+                    "SLOWER-THAN" => slower_than_us = value as u64,
+                    _ => return Err(RedisError::Str("ERR syntax error")),
+                }
+            }
+            trace::enable(size, slower_than_us.saturating_mul(1000));
+            REDIS_OK
+        }
+        "OFF" => {
+            args.done()?;
+            trace::disable();
+            REDIS_OK
+        }
+        "GET" => {
+            args.done()?;
+            let pairs = |entries: &[(&'static str, u64)]| {
+                entries
+                    .iter()
+                    .flat_map(|&(name, n)| {
+                        vec![
+                            RedisValue::SimpleStringStatic(name),
+                            RedisValue::Integer(n as i64),
+                        ]
+                    })
+                    .collect::<Vec<RedisValue>>()
+            };
+            let calls = trace::calls()
+                .iter()
+                .map(|call| {
+                    RedisValue::Array(vec![
+                        RedisValue::SimpleStringStatic("command"),
+                        RedisValue::SimpleStringStatic(call.command),
+                        RedisValue::SimpleStringStatic("key"),
+                        RedisValue::BulkString(call.key.clone()),
+                        RedisValue::SimpleStringStatic("path"),
+                        RedisValue::BulkString(call.path.clone()),
+                        RedisValue::SimpleStringStatic("total_ns"),
+                        RedisValue::Integer(call.total_ns as i64),
+                        RedisValue::SimpleStringStatic("phases"),
+                        RedisValue::Array(pairs(&call.phases)),
+                        RedisValue::SimpleStringStatic("counts"),
+                        RedisValue::Array(pairs(&call.counts)),
+                    ])
+                })
+                .collect();
+            Ok(RedisValue::Array(calls))
+        }
+        "RESET" => {
+            args.done()?;
+            trace::reset();
+            REDIS_OK
+        }
+        _ => Err(RedisError::Str(
+            "ERR unknown subcommand - try `JSON.DEBUG TRACE ON|OFF|GET|RESET`",
+        )),
+    }
+}
+
 ///
 /// JSON.RESP <key> [path]
 ///
 fn json_resp(ctx: &Context, args: Vec<String>) -> RedisResult {
+    let _trace = trace_call("JSON.RESP", &args);
     let mut args = args.into_iter().skip(1);
 
     let key = args.next_string()?;
@@ -778,6 +1264,18 @@ fn json_cache_init(_ctx: &Context, _args: Vec<String>) -> RedisResult {
 
 pub extern "C" fn init(raw_ctx: *mut rawmod::RedisModuleCtx) -> c_int {
     crate::commands::index::schema_map::init();
+    crate::commands::load::load_map::init();
+    crate::commands::sindex::sindex_map::init();
+    crate::commands::upload::upload_map::init();
+    crate::commands::validate::validator_map::init();
+    crate::offload::init();
+    crate::parser::init();
+    crate::commands::expire::start(&Context::new(raw_ctx));
+    crate::defrag::start(&Context::new(raw_ctx));
+    let status = crate::commands::upload::start(&Context::new(raw_ctx));
+    if status == rawmod::REDISMODULE_ERR as c_int {
+        return status;
+    }
     redisearch_api::init(raw_ctx)
 }
 
@@ -793,6 +1291,7 @@ redis_module! {
         ["json.get", json_get, "readonly", 1,1,1],
         ["json.mget", json_mget, "readonly", 1,1,1],
         ["json.set", json_set, "write deny-oom", 1,1,1],
+        ["json.mset", json_mset, "write deny-oom", 1,-1,3],
         ["json.type", json_type, "readonly", 1,1,1],
         ["json.numincrby", json_num_incrby, "write", 1,1,1],
         ["json.nummultby", json_num_multby, "write", 1,1,1],
@@ -807,11 +1306,22 @@ redis_module! {
         ["json.arrtrim", json_arr_trim, "write", 1,1,1],
         ["json.objkeys", json_obj_keys, "readonly", 1,1,1],
         ["json.objlen", json_obj_len, "readonly", 1,1,1],
-        ["json.debug", json_debug, "readonly", 1,1,1],
+        ["json.debug", json_debug, "write", 1,1,1],
+        ["json.digest", json_digest, "readonly", 1,1,1],
+        ["json.copy", json_copy, "write deny-oom", 1,2,1],
         ["json.forget", json_del, "write", 1,1,1],
         ["json.resp", json_resp, "readonly", 1,1,1],
         ["json.index", commands::index::index, "write deny-oom", 1,1,1],
         ["json.qget", commands::index::qget, "readonly", 1,1,1],
+        ["json.expire", commands::expire::expire, "write", 1,1,1],
+        ["json.pexpireat", commands::expire::pexpireat, "write", 1,1,1],
+        ["json.sindex", commands::sindex::sindex, "write", 0,0,0],
+        ["json.squery", commands::sindex::squery, "readonly", 0,0,0],
+        ["json.scan", commands::scan::scan, "readonly", 0,0,0],
+        ["json.ttl", commands::expire::ttl, "readonly", 1,1,1],
+        ["json.load", commands::load::load, "admin deny-oom", 0,0,0],
+        ["json.setschema", commands::validate::set_schema, "write deny-oom", 0,0,0],
+        ["json.validate", commands::validate::validate, "readonly", 0,0,0],
         ["json._cacheinfo", json_cache_info, "readonly", 1,1,1],
         ["json._cacheinit", json_cache_init, "write", 1,1,1],
     ],
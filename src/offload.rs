@@ -0,0 +1,144 @@
+// Worker pool for parsing and serializing large documents off the Redis main thread.
+//
+// A command whose payload is above the threshold blocks its client and hands the CPU-heavy part
+// of its work to one of the workers. The worker then either locks the GIL to apply the result to
+// the keyspace, or replies directly, and unblocks the client. Other clients keep being served
+// in the meantime. Reads hand the workers a clone of the selected value, so the snapshot they
+// serialize can't change under them.
+
+use redis_module::{raw, Context};
+use serde_json::Value;
+use std::sync::atomic::{AtomicUsize, Ordering};
+use std::sync::mpsc::{channel, Receiver, Sender};
+use std::sync::{Arc, Mutex};
+use std::thread;
+
+/// Payloads of at least this many bytes are offloaded, 0 disables offloading
+pub const DEFAULT_THRESHOLD: usize = 1 << 20;
+
+const WORKERS: usize = 4;
+
+static THRESHOLD: AtomicUsize = AtomicUsize::new(DEFAULT_THRESHOLD);
+
+type Job = Box<dyn FnOnce() + Send + 'static>;
+
+/// The pool is created once, when the module is loaded, and lives as long as the process.
+static mut POOL: Option<Mutex<Sender<Job>>> = None;
+
+pub fn init() {
+    let (sender, receiver) = channel::<Job>();
+    let receiver = Arc::new(Mutex::new(receiver));
+    for i in 0..WORKERS {
+        let receiver = Arc::clone(&receiver);
+        thread::Builder::new()
+            .name(format!("rejson-worker-{}", i))
+            .spawn(move || work(&receiver))
+            .unwrap();
+    }
+    unsafe {
+        POOL = Some(Mutex::new(sender));
+    }
+}
+
+fn work(receiver: &Mutex<Receiver<Job>>) {
+    loop {
+        let job = match receiver.lock().unwrap().recv() {
+            Ok(job) => job,
+            Err(_) => return,
+        };
+        job();
+    }
+}
+
+pub fn spawn<F>(job: F)
+where
+    F: FnOnce() + Send + 'static,
+{
+    let pool = unsafe { POOL.as_ref() }.unwrap();
+    pool.lock().unwrap().send(Box::new(job)).unwrap();
+}
+
+pub fn threshold() -> usize {
+    THRESHOLD.load(Ordering::Relaxed)
+}
+
+pub fn set_threshold(threshold: usize) {
+    THRESHOLD.store(threshold, Ordering::Relaxed);
+}
+
+///
+/// Whether the calling client may be blocked: MULTI, Lua and replicated or loaded commands
+/// must run to completion before anything else does
+///
+pub fn can_block(ctx: &Context) -> bool {
+    let flags = unsafe { raw::RedisModule_GetContextFlags.unwrap()(ctx.ctx) } as u64;
+    let master = raw::REDISMODULE_CTX_FLAGS_MASTER as u64;
+    let denied = (raw::REDISMODULE_CTX_FLAGS_MULTI
+        | raw::REDISMODULE_CTX_FLAGS_LUA
+        | raw::REDISMODULE_CTX_FLAGS_LOADING) as u64;
+    flags & master != 0 && flags & denied == 0
+}
+
+pub fn should_offload(ctx: &Context, len: usize) -> bool {
+    let threshold = threshold();
+    threshold > 0 && len >= threshold && can_block(ctx)
+}
+
+///
+/// Whether serializing `value` would produce at least `threshold` bytes, give or take.
+/// Stops walking as soon as the estimate gets there, so it's cheap even for huge values.
+///
+pub fn is_large(value: &Value, threshold: usize) -> bool {
+    fn estimate(value: &Value, budget: &mut usize) -> bool {
+        let size = match value {
+            Value::Null | Value::Bool(_) => 5,
+            Value::Number(_) => 8,
+            Value::String(s) => s.len() + 2,
+            Value::Array(arr) => {
+                *budget = budget.saturating_sub(arr.len() + 2);
+                return *budget == 0 || arr.iter().any(|v| estimate(v, budget));
+            }
+            Value::Object(obj) => {
+                *budget = budget.saturating_sub(obj.len() + 2);
+                return *budget == 0
+                    || obj.iter().any(|(k, v)| {
+                        *budget = budget.saturating_sub(k.len() + 3);
+                        *budget == 0 || estimate(v, budget)
+                    });
+            }
+        };
+        *budget = budget.saturating_sub(size);
+        *budget == 0
+    }
+
+    let mut budget = threshold;
+    threshold > 0 && estimate(value, &mut budget)
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use std::sync::mpsc::channel;
+
+    #[test]
+    fn test_is_large() {
+        let value: Value = serde_json::from_str(r#"{"a":[1,2,3],"b":"0123456789"}"#).unwrap();
+        let len = serde_json::to_string(&value).unwrap().len();
+        assert!(is_large(&value, len / 2));
+        assert!(!is_large(&value, len * 2));
+        assert!(!is_large(&value, 0));
+    }
+
+    #[test]
+    fn test_spawn() {
+        init();
+        let (sender, receiver) = channel();
+        for i in 0..10 {
+            let sender = sender.clone();
+            spawn(move || sender.send(i).unwrap());
+        }
+        let mut results: Vec<i32> = receiver.iter().take(10).collect();
+        results.sort();
+        assert_eq!(results, (0..10).collect::<Vec<i32>>());
+    }
+}
@@ -0,0 +1,203 @@
+// JSON text parsing backends.
+//
+// serde_json's scalar parser is always available. Builds with the `simd` feature also carry
+// simd-json, which is chosen when the module is loaded if the CPU has the instructions it needs.
+// Both backends build the same `serde_json::Value` tree.
+
+use crate::error::Error;
+use serde_json::Value;
+#[cfg(feature = "simd")]
+use serde_json::{Map, Number};
+use std::sync::atomic::{AtomicBool, Ordering};
+
+/// Below this size the copy simd-json needs costs more than it saves
+const SIMD_MIN_LEN: usize = 64;
+
+/// serde_json's nesting limit: containers may nest one level less deep than this
+#[cfg(feature = "simd")]
+const MAX_DEPTH: usize = 128;
+
+static USE_SIMD: AtomicBool = AtomicBool::new(false);
+
+#[derive(Debug, Clone, Copy, PartialEq)]
+pub enum Backend {
+    Scalar,
+    Simd,
+}
+
+impl Backend {
+    pub fn from_str(s: &str) -> Result<Backend, Error> {
+        match s.to_uppercase().as_str() {
+            "SCALAR" => Ok(Backend::Scalar),
+            "SIMD" => Ok(Backend::Simd),
+            _ => Err("ERR unknown parser - try SCALAR or SIMD".into()),
+        }
+    }
+
+    pub fn name(self) -> &'static str {
+        match self {
+            Backend::Scalar => "SCALAR",
+            Backend::Simd => "SIMD",
+        }
+    }
+}
+
+///
+/// Picks the parser, should be called once when the module is loaded
+///
+pub fn init() {
+    USE_SIMD.store(simd_supported(), Ordering::Relaxed);
+}
+
+#[cfg(all(feature = "simd", any(target_arch = "x86", target_arch = "x86_64")))]
+pub fn simd_supported() -> bool {
+    is_x86_feature_detected!("avx2") || is_x86_feature_detected!("sse4.2")
+}
+
+#[cfg(all(feature = "simd", target_arch = "aarch64"))]
+pub fn simd_supported() -> bool {
+    // NEON is part of the baseline
+    true
+}
+
+#[cfg(not(all(
+    feature = "simd",
+    any(target_arch = "x86", target_arch = "x86_64", target_arch = "aarch64")
+)))]
+pub fn simd_supported() -> bool {
+    false
+}
+
+pub fn backend() -> Backend {
+    if USE_SIMD.load(Ordering::Relaxed) {
+        Backend::Simd
+    } else {
+        Backend::Scalar
+    }
+}
+
+pub fn set_backend(backend: Backend) -> Result<(), Error> {
+    if backend == Backend::Simd && !simd_supported() {
+        return Err("ERR the SIMD parser isn't supported by this build or CPU".into());
+    }
+    USE_SIMD.store(backend == Backend::Simd, Ordering::Relaxed);
+    Ok(())
+}
+
+pub fn from_str(data: &str) -> Result<Value, Error> {
+    if data.len() >= SIMD_MIN_LEN && USE_SIMD.load(Ordering::Relaxed) {
+        parse_simd(data)
+    } else {
+        parse_scalar(data)
+    }
+}
+
+fn parse_scalar(data: &str) -> Result<Value, Error> {
+    Ok(serde_json::from_str(data)?)
+}
+
+#[cfg(feature = "simd")]
+fn parse_simd(data: &str) -> Result<Value, Error> {
+    // simd-json parses in place, into a flat tape of nodes that's turned into the `Value` tree
+    // directly, rather than through serde's visitors
+    let mut bytes = data.as_bytes().to_vec();
+    let tape = simd_json::to_tape(&mut bytes).map_err(|e| Error::from(e.to_string()))?;
+    from_tape(&mut tape.0.into_iter(), MAX_DEPTH)
+}
+
+///
+/// The value whose nodes come next on the tape. Containers are followed by their members, and
+/// object members by their key. Fails when containers nest `remaining_depth` deep, like serde_json
+/// does.
+///
+#[cfg(feature = "simd")]
+fn from_tape<'input, I>(nodes: &mut I, remaining_depth: usize) -> Result<Value, Error>
+where
+    I: Iterator<Item = simd_json::Node<'input>>,
+{
+    use simd_json::{Node, StaticNode};
+
+    let value = match nodes.next() {
+        Some(Node::String(s)) => Value::String(s.to_owned()),
+        Some(Node::Array { len, .. }) => {
+            let remaining_depth = nested(remaining_depth)?;
+            Value::Array(
+                (0..len)
+                    .map(|_| from_tape(nodes, remaining_depth))
+                    .collect::<Result<_, _>>()?,
+            )
+        }
+        Some(Node::Object { len, .. }) => {
+            let remaining_depth = nested(remaining_depth)?;
+            let mut map = Map::new();
+            for _ in 0..len {
+                if let Some(Node::String(key)) = nodes.next() {
+                    map.insert(key.to_owned(), from_tape(nodes, remaining_depth)?);
+                }
+            }
+            Value::Object(map)
+        }
+        Some(Node::Static(StaticNode::I64(n))) => n.into(),
+        Some(Node::Static(StaticNode::U64(n))) => n.into(),
+        Some(Node::Static(StaticNode::F64(n))) => {
+            Number::from_f64(n).map_or(Value::Null, Value::Number)
+        }
+        Some(Node::Static(StaticNode::Bool(b))) => Value::Bool(b),
+        Some(Node::Static(StaticNode::Null)) | None => Value::Null,
+    };
+    Ok(value)
+}
+
+#[cfg(feature = "simd")]
+fn nested(remaining_depth: usize) -> Result<usize, Error> {
+    match remaining_depth - 1 {
+        0 => Err("recursion limit exceeded".into()),
+        remaining_depth => Ok(remaining_depth),
+    }
+}
+
+#[cfg(not(feature = "simd"))]
+fn parse_simd(data: &str) -> Result<Value, Error> {
+    parse_scalar(data)
+}
+
+#[cfg(all(test, feature = "simd"))]
+mod tests {
+    use super::*;
+    use std::fs;
+
+    #[test]
+    fn test_corpus() {
+        let dir = concat!(env!("CARGO_MANIFEST_DIR"), "/tests/files");
+        for entry in fs::read_dir(dir).unwrap() {
+            let path = entry.unwrap().path();
+            if path.extension().map_or(true, |ext| ext != "json") {
+                continue;
+            }
+            let data = match fs::read_to_string(&path) {
+                Ok(data) => data,
+                Err(_) => continue, // Not UTF-8, so never gets to the parser
+            };
+
+            // Same verdict on every file, and the same tree for the ones that parse
+            match (parse_scalar(&data), parse_simd(&data)) {
+                (Ok(scalar), Ok(simd)) => assert_eq!(scalar, simd, "{:?}", path),
+                (Err(_), Err(_)) => {}
+                (scalar, simd) => panic!("{:?}: scalar {:?}, simd {:?}", path, scalar, simd),
+            }
+        }
+    }
+
+    #[test]
+    fn test_depth() {
+        for depth in 126..130 {
+            let data = "[".repeat(depth) + &"]".repeat(depth);
+            assert_eq!(
+                parse_scalar(&data).is_ok(),
+                parse_simd(&data).is_ok(),
+                "{}",
+                depth
+            );
+        }
+    }
+}
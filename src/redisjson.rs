@@ -5,21 +5,34 @@
 // It can be operated on (e.g. INCR) and serialized back to JSON.
 
 use crate::backward;
-use crate::commands::index;
+use crate::commands::{expire, index, sindex, validate};
+use crate::defrag;
+use crate::digest::{self, Digests};
 use crate::error::Error;
+use crate::first_match::{self, Step};
 use crate::formatter::RedisJsonFormatter;
 use crate::nodevisitor::{StaticPathElement, StaticPathParser, VisitStatus};
+use crate::parser;
+use crate::trace;
+use crate::validator::{Location, Validator};
 use crate::REDIS_JSON_TYPE_VERSION;
 
 use bson::decode_document;
+use expire::expire_map;
 use index::schema_map;
 use jsonpath_lib::SelectorMut;
 use redis_module::raw::{self, Status};
 use serde::Serialize;
 use serde_json::{Map, Value};
+use sindex::sindex_map;
+use std::borrow::Cow;
+use std::cell::RefCell;
+use std::cmp::Ordering;
 use std::io::Cursor;
 use std::mem;
 use std::os::raw::{c_int, c_void};
+use std::sync::Arc;
+use validate::validator_map;
 
 #[derive(Debug, PartialEq)]
 pub enum SetOptions {
@@ -71,18 +84,27 @@ impl Path {
 pub struct ValueIndex {
     pub key: String,
     pub index_name: String,
+    // The database of the key, since the same key name can be indexed in several of them
+    pub db: i32,
 }
 
 #[derive(Debug)]
 pub struct RedisJSON {
-    data: Value,
+    // Shared by the copies JSON.COPY makes, until one of them is written to
+    data: Arc<Value>,
     pub value_index: Option<ValueIndex>,
+    // Bumped on every successful write, used by IFREV reads and REV compare-and-set writes
+    rev: u64,
+    // The name of the JSON Schema writes are validated against
+    json_schema: Option<String>,
+    // Computed on demand, by reads
+    digests: RefCell<Digests>,
 }
 
 impl RedisJSON {
     pub fn parse_str(data: &str, format: Format) -> Result<Value, Error> {
-        match format {
-            Format::JSON => Ok(serde_json::from_str(data)?),
+        trace::phase("parse", || match format {
+            Format::JSON => parser::from_str(data),
             Format::BSON => decode_document(&mut Cursor::new(data.as_bytes()))
                 .map(|docs| {
                     let v = if !docs.is_empty() {
@@ -95,7 +117,7 @@ impl RedisJSON {
                     Ok(v)
                 })
                 .unwrap_or_else(|e| Err(e.to_string().into())),
-        }
+        })
     }
 
     pub fn from_str(
@@ -104,10 +126,90 @@ impl RedisJSON {
         format: Format,
     ) -> Result<Self, Error> {
         let value = RedisJSON::parse_str(data, format)?;
-        Ok(Self {
-            data: value,
+        Ok(Self::from_value(value, value_index))
+    }
+
+    pub fn from_value(value: Value, value_index: &Option<ValueIndex>) -> Self {
+        Self {
+            data: Arc::new(value),
             value_index: value_index.clone(),
-        })
+            rev: 1,
+            json_schema: None,
+            digests: RefCell::default(),
+        }
+    }
+
+    ///
+    /// A new document sharing this one's data, in constant time. Sharing is all or nothing: the
+    /// first write to either document copies the whole of its data, whatever the write's size.
+    ///
+    pub fn share(&self) -> Self {
+        Self::copied(Arc::clone(&self.data))
+    }
+
+    ///
+    /// A new document with a deep copy of the value at `path`, which shares nothing
+    ///
+    pub fn copy_of(&self, path: &str) -> Result<Self, Error> {
+        Ok(Self::copied(Arc::new(self.get_first(path)?.clone())))
+    }
+
+    fn copied(data: Arc<Value>) -> Self {
+        Self {
+            data,
+            value_index: None,
+            rev: 1,
+            json_schema: None,
+            digests: RefCell::default(),
+        }
+    }
+
+    ///
+    /// A copy of the document to apply writes to, before it replaces the document as a whole
+    ///
+    pub fn stage(&self) -> Self {
+        Self {
+            data: Arc::clone(&self.data),
+            value_index: self.value_index.clone(),
+            rev: self.rev,
+            json_schema: self.json_schema.clone(),
+            digests: RefCell::default(),
+        }
+    }
+
+    ///
+    /// The number of documents sharing this one's data, 1 unless it's been copied
+    ///
+    pub fn shares(&self) -> usize {
+        Arc::strong_count(&self.data)
+    }
+
+    /// The data, to write to, copied first if it's shared
+    fn data_mut(&mut self) -> &mut Value {
+        Arc::make_mut(&mut self.data)
+    }
+
+    /// The data, to write and store back, copied if it's shared
+    fn take_data(&mut self) -> Value {
+        Arc::try_unwrap(mem::take(&mut self.data)).unwrap_or_else(|data| (*data).clone())
+    }
+
+    pub fn rev(&self) -> u64 {
+        self.rev
+    }
+
+    ///
+    /// Compare-and-set guard: fails unless the document is still at the expected revision
+    ///
+    pub fn check_rev(&self, expected: Option<u64>) -> Result<(), Error> {
+        match expected {
+            Some(rev) if rev != self.rev => Err("ERR revision mismatch".into()),
+            _ => Ok(()),
+        }
+    }
+
+    fn bump_rev(&mut self) {
+        self.rev = self.rev.wrapping_add(1);
     }
 
     fn add_value(&mut self, path: &str, value: Value) -> Result<bool, Error> {
@@ -123,7 +225,7 @@ impl RedisJSON {
         if let StaticPathElement::ObjectKey(key) =
             parsed_static_path.static_path_elements.pop().unwrap()
         {
-            let mut current_data = self.data.take();
+            let mut current_data = self.take_data();
             if let StaticPathElement::Root = parsed_static_path.static_path_elements.last().unwrap()
             {
                 // Adding to the root, can't use jsonpath_lib::replace_with
@@ -137,12 +239,12 @@ impl RedisJSON {
                 } else {
                     false
                 };
-                self.data = current_data;
+                self.data = Arc::new(current_data);
                 Ok(res)
             } else {
                 // Adding somewhere in existing object, use jsonpath_lib::replace_with
                 let mut set = false;
-                self.data = jsonpath_lib::replace_with(
+                self.data = Arc::new(jsonpath_lib::replace_with(
                     current_data,
                     &parsed_static_path
                         .static_path_elements
@@ -161,7 +263,7 @@ impl RedisJSON {
                         }
                         Some(ret)
                     },
-                )?;
+                )?);
                 Ok(set)
             }
         } else {
@@ -177,21 +279,156 @@ impl RedisJSON {
         format: Format,
     ) -> Result<bool, Error> {
         let json: Value = RedisJSON::parse_str(data, format)?;
+        self.set_json(json, path, option)
+    }
+
+    ///
+    /// Like `set_value`, for a value that was already parsed
+    ///
+    pub fn set_json(
+        &mut self,
+        json: Value,
+        path: &str,
+        option: &SetOptions,
+    ) -> Result<bool, Error> {
+        let updated = match self.validator() {
+            Some(validator) => self.put_json_validated(validator, json, path, option)?,
+            None => trace::phase("mutate", || self.put_json(json, path, option))?,
+        };
+        if updated {
+            self.bump_rev();
+        }
+        Ok(updated)
+    }
+
+    ///
+    /// Like `set_json`, and validates the document against schema `name` from now on
+    ///
+    pub fn set_json_with_schema(
+        &mut self,
+        json: Value,
+        path: &str,
+        option: &SetOptions,
+        name: &str,
+    ) -> Result<bool, Error> {
+        let validator = validator_map::as_ref()
+            .get(name)
+            .ok_or("ERR no such schema")?;
+        let updated = self.write_whole(validator, |doc| {
+            trace::phase("mutate", || doc.put_json(json, path, option))
+        })?;
+        self.json_schema = Some(name.to_string());
+        if updated {
+            self.bump_rev();
+        }
+        Ok(updated)
+    }
+
+    ///
+    /// Validates the document against schema `name`, and keeps doing so on writes
+    ///
+    pub fn bind_schema(&mut self, name: &str) -> Result<(), Error> {
+        let validator = validator_map::as_ref()
+            .get(name)
+            .ok_or("ERR no such schema")?;
+        trace::phase("validate", || validator.validate(&self.data))?;
+        self.json_schema = Some(name.to_string());
+        Ok(())
+    }
+
+    fn validator(&self) -> Option<&'static Validator> {
+        self.json_schema
+            .as_ref()
+            .and_then(|name| validator_map::as_ref().get(name))
+    }
+
+    ///
+    /// What applies to the value a write at `path` changes, if it can be validated on its own
+    ///
+    fn locate(&self, validator: &Validator, path: &str) -> Option<Location> {
+        first_match::compile(path)
+            .ok()
+            .flatten()
+            .and_then(|steps| validator.locate(&self.data, &steps))
+    }
+
+    ///
+    /// Applies `write` and then validates the whole document, undoing the write if it's invalid.
+    /// For writes whose effect can't be validated on its own.
+    ///
+    fn write_whole<T, F>(&mut self, validator: &Validator, write: F) -> Result<T, Error>
+    where
+        F: FnOnce(&mut Self) -> Result<T, Error>,
+    {
+        let (data, rev) = (self.data.clone(), self.rev);
+        let res = write(self).and_then(|res| {
+            trace::phase("validate", || validator.validate(&self.data))?;
+            Ok(res)
+        });
+        if res.is_err() {
+            self.data = data;
+            self.rev = rev;
+        }
+        res
+    }
+
+    fn put_json_validated(
+        &mut self,
+        validator: &Validator,
+        json: Value,
+        path: &str,
+        option: &SetOptions,
+    ) -> Result<bool, Error> {
+        if path == "$" {
+            if SetOptions::NotExists != *option {
+                trace::phase("validate", || validator.validate(&json))?;
+            }
+            return trace::phase("mutate", || self.put_json(json, path, option));
+        }
+        match self.locate(validator, path) {
+            Some(location) => {
+                let writes = match option {
+                    SetOptions::NotExists => !location.exists(),
+                    SetOptions::AlreadyExists => location.exists(),
+                    SetOptions::None => true,
+                };
+                if writes {
+                    trace::phase("validate", || validator.check_set(&location, &json, path))?;
+                }
+                trace::phase("mutate", || self.put_json(json, path, option))
+            }
+            None => self.write_whole(validator, |doc| {
+                trace::phase("mutate", || doc.put_json(json, path, option))
+            }),
+        }
+    }
+
+    fn put_json(&mut self, json: Value, path: &str, option: &SetOptions) -> Result<bool, Error> {
+        self.forget_digests(path, false);
         if path == "$" {
             if SetOptions::NotExists == *option {
                 Ok(false)
             } else {
-                self.data = json;
+                self.data = Arc::new(json);
                 Ok(true)
             }
         } else {
             let mut replaced = false;
             if SetOptions::NotExists != *option {
-                let current_data = self.data.take();
-                self.data = jsonpath_lib::replace_with(current_data, path, &mut |_v| {
-                    replaced = true;
-                    Some(json.clone())
-                })?;
+                if let Some(steps) = static_steps(path) {
+                    // Replaced in place, see `update`
+                    if let Some(value) = defrag::get_mut(self.data_mut(), &steps) {
+                        *value = json;
+                        return Ok(true);
+                    }
+                } else {
+                    let current_data = self.take_data();
+                    self.data =
+                        Arc::new(jsonpath_lib::replace_with(current_data, path, &mut |_v| {
+                            replaced = true;
+                            Some(json.clone())
+                        })?);
+                }
             }
             if replaced {
                 Ok(true)
@@ -204,62 +441,221 @@ impl RedisJSON {
     }
 
     pub fn delete_path(&mut self, path: &str) -> Result<usize, Error> {
-        let current_data = self.data.take();
+        let deleted = match self.validator() {
+            Some(validator) => match self.locate(validator, path) {
+                Some(location) => {
+                    trace::phase("validate", || validator.check_delete(&location, path))?;
+                    self.remove_path(path)?
+                }
+                None => self.write_whole(validator, |doc| doc.remove_path(path))?,
+            },
+            None => self.remove_path(path)?,
+        };
+        if deleted > 0 {
+            self.bump_rev();
+            // Removing array elements leaves the array's capacity behind
+            if let Ok(Some(steps)) = first_match::compile(path) {
+                if let Some(parent) = steps
+                    .split_last()
+                    .and_then(|(_, parent)| defrag::get_mut(self.data_mut(), parent))
+                {
+                    defrag::reclaim(parent);
+                }
+            }
+        }
+        Ok(deleted)
+    }
+
+    ///
+    /// Deletes the values at all of `paths`, finding them in a single walk of the document.
+    /// Validated as a whole, and counted like `delete_path` does.
+    ///
+    pub fn delete_paths(&mut self, paths: &[String]) -> Result<usize, Error> {
+        if let [path] = paths {
+            return self.delete_path(path);
+        }
+        let deleted = match self.validator() {
+            Some(validator) => self.write_whole(validator, |doc| doc.remove_paths(paths))?,
+            None => self.remove_paths(paths)?,
+        };
+        if deleted > 0 {
+            self.bump_rev();
+        }
+        Ok(deleted)
+    }
+
+    fn remove_paths(&mut self, paths: &[String]) -> Result<usize, Error> {
+        let mut compiled = vec![];
+        let mut others = vec![];
+        for path in paths {
+            match first_match::compile(path)? {
+                Some(steps) => compiled.push(steps),
+                None => others.push(path),
+            }
+        }
+
+        let mut targets = trace::phase("select", || first_match::locate_all(&self.data, &compiled));
+        // Parents first, so that the values inside other targets, which go with them, can be
+        // dropped, and elements of the same array by index
+        targets.sort_by(|a, b| compare_locations(a, b));
+        targets.dedup_by(|later, earlier| later.starts_with(earlier));
 
         let mut deleted = 0;
-        self.data = jsonpath_lib::replace_with(current_data, path, &mut |v| {
-            if !v.is_null() {
-                deleted += 1; // might delete more than a single value
+        {
+            let _mutate = trace::phase_guard("mutate");
+            // Backwards, so that removing an element doesn't move those still to remove
+            for location in targets.iter().rev() {
+                if let Some((last, parent)) = location.split_last() {
+                    self.forget_digests_at(location, true);
+                    let removed = match (defrag::get_mut(self.data_mut(), parent), last) {
+                        (Some(Value::Object(map)), Step::Key(key)) => map.remove(key),
+                        (Some(Value::Array(arr)), Step::Index(index))
+                            if (*index as usize) < arr.len() =>
+                        {
+                            Some(arr.remove(*index as usize))
+                        }
+                        _ => None,
+                    };
+                    if removed.map_or(false, |v| !v.is_null()) {
+                        deleted += 1;
+                    }
+                }
             }
-            None
-        })?;
+        }
+        // Paths `first_match` doesn't evaluate are deleted one after the other
+        for path in others {
+            deleted += self.remove_path(path)?;
+        }
+
+        let mut last_parent: Option<&[Step]> = None;
+        for location in &targets {
+            if let Some((_, parent)) = location.split_last() {
+                if last_parent != Some(parent) {
+                    if let Some(parent) = defrag::get_mut(self.data_mut(), parent) {
+                        defrag::reclaim(parent);
+                    }
+                    last_parent = Some(parent);
+                }
+            }
+        }
         Ok(deleted)
     }
 
+    fn remove_path(&mut self, path: &str) -> Result<usize, Error> {
+        self.forget_digests(path, true);
+        let current_data = self.take_data();
+
+        let mut deleted = 0;
+        self.data = Arc::new(trace::phase("mutate", || {
+            jsonpath_lib::replace_with(current_data, path, &mut |v| {
+                if !v.is_null() {
+                    deleted += 1; // might delete more than a single value
+                }
+                None
+            })
+        })?);
+        Ok(deleted)
+    }
+
+    ///
+    /// The Merkle digest of the value at `path`, see `digest`
+    ///
+    pub fn digest(&self, path: &str) -> Result<u64, Error> {
+        if let Some(steps) = first_match::compile(path)? {
+            let mut digests = self.digests.borrow_mut();
+            if let Some(hash) = digest::digest_at(&mut digests, &self.data, &steps) {
+                return Ok(hash);
+            }
+        }
+        // Paths that don't lead to a single value by keys and indexes aren't cached
+        Ok(digest::hash(self.get_first(path)?))
+    }
+
+    ///
+    /// Forgets the cached digests a write at `path` makes stale, should be called before the write
+    ///
+    fn forget_digests(&self, path: &str, shifts: bool) {
+        let mut digests = self.digests.borrow_mut();
+        if digests.is_empty() {
+            return;
+        }
+        match first_match::compile(path) {
+            Ok(Some(steps)) => digest::invalidate(&mut digests, &self.data, &steps, shifts),
+            _ => *digests = Digests::default(),
+        }
+    }
+
+    fn forget_digests_at(&self, steps: &[Step], shifts: bool) {
+        let mut digests = self.digests.borrow_mut();
+        if !digests.is_empty() {
+            digest::invalidate(&mut digests, &self.data, steps, shifts);
+        }
+    }
+
+    ///
+    /// Moves the nodes of the document to fresh allocations, see `defrag::defrag`
+    ///
+    pub fn defrag(
+        &mut self,
+        cursor: &mut Vec<usize>,
+        budget: &mut usize,
+        moved: &mut usize,
+    ) -> bool {
+        // Defragmenting a shared document would unshare it
+        if Arc::strong_count(&self.data) > 1 {
+            return true;
+        }
+        defrag::defrag(self.data_mut(), cursor, budget, moved)
+    }
+
     pub fn to_string(&self, path: &str, format: Format) -> Result<String, Error> {
         let results = self.get_first(path)?;
         Self::serialize(results, format)
     }
 
     pub fn serialize(results: &Value, format: Format) -> Result<String, Error> {
-        let res = match format {
-            Format::JSON => serde_json::to_string(results)?,
-            Format::BSON => return Err("Soon to come...".into()), //results.into() as Bson,
-        };
-        Ok(res)
+        trace::phase("serialize", || match format {
+            Format::JSON => Ok(serde_json::to_string(results)?),
+            Format::BSON => Err("Soon to come...".into()), //results.into() as Bson,
+        })
     }
 
-    pub fn to_json(
-        &self,
-        paths: &mut Vec<Path>,
-        indent: String,
-        newline: String,
-        space: String,
-        format: Format,
-    ) -> Result<String, Error> {
-        let temp_doc;
+    ///
+    /// The value at a single path, or an object mapping each of several paths to its value
+    ///
+    pub fn select(&self, paths: &mut Vec<Path>) -> Result<Cow<Value>, Error> {
         let res = if paths.len() > 1 {
             let mut selector = jsonpath_lib::selector(&self.data);
             // TODO: Creating a temp doc here duplicates memory usage. This can be very memory inefficient.
             // A better way would be to create a doc of references to the original doc but no current support
             // in serde_json. I'm going for this implementation anyway because serde_json isn't supposed to be
             // memory efficient and we're using it anyway. See https://github.com/serde-rs/json/issues/635.
-            temp_doc = Value::Object(paths.drain(..).fold(Map::new(), |mut acc, path| {
-                let value = match selector(&path.fixed) {
-                    Ok(s) => match s.first() {
-                        Some(v) => v,
-                        None => &Value::Null,
-                    },
-                    Err(_) => &Value::Null,
-                };
-                acc.insert(path.path, (*value).clone());
-                acc
-            }));
-            &temp_doc
+            Cow::Owned(trace::phase("select", || {
+                Value::Object(paths.drain(..).fold(Map::new(), |mut acc, path| {
+                    let value = match selector(&path.fixed) {
+                        Ok(s) => match s.first() {
+                            Some(v) => v,
+                            None => &Value::Null,
+                        },
+                        Err(_) => &Value::Null,
+                    };
+                    acc.insert(path.path, (*value).clone());
+                    acc
+                }))
+            }))
         } else {
-            self.get_first(&paths[0].fixed)?
+            Cow::Borrowed(self.get_first(&paths[0].fixed)?)
         };
+        Ok(res)
+    }
 
+    pub fn format(
+        value: &Value,
+        indent: &str,
+        newline: &str,
+        space: &str,
+        format: Format,
+    ) -> Result<String, Error> {
         match format {
             Format::JSON => {
                 let formatter = RedisJsonFormatter::new(
@@ -268,9 +664,11 @@ impl RedisJSON {
                     newline.as_bytes(),
                 );
 
-                let mut out = serde_json::Serializer::with_formatter(Vec::new(), formatter);
-                res.serialize(&mut out).unwrap();
-                Ok(String::from_utf8(out.into_inner()).unwrap())
+                trace::phase("serialize", || {
+                    let mut out = serde_json::Serializer::with_formatter(Vec::new(), formatter);
+                    value.serialize(&mut out).unwrap();
+                    Ok(String::from_utf8(out.into_inner()).unwrap())
+                })
             }
             Format::BSON => Err("Soon to come...".into()), //results.into() as Bson,
         }
@@ -355,28 +753,63 @@ impl RedisJSON {
         }
     }
 
-    pub fn value_op<F>(&mut self, path: &str, mut fun: F) -> Result<Value, Error>
+    ///
+    /// Changes the values at `path` in place with `fun`, which should leave a value untouched when
+    /// it fails. Returns what `fun` returned for the last value, or `None` if there's none.
+    ///
+    pub fn value_op<F, R>(&mut self, path: &str, mut fun: F) -> Result<Option<R>, Error>
     where
-        F: FnMut(&Value) -> Result<Value, Error>,
+        F: FnMut(&mut Value) -> Result<R, Error>,
     {
-        let current_data = self.data.take();
+        match self.validator() {
+            Some(validator) => match self.locate(validator, path) {
+                Some(location) => self.update(path, |value| {
+                    // Changed on a copy, which only replaces the value once it's valid
+                    let mut new_value = value.clone();
+                    let res = fun(&mut new_value)?;
+                    trace::phase("validate", || {
+                        validator.check_set(&location, &new_value, path)
+                    })?;
+                    *value = new_value;
+                    Ok(res)
+                }),
+                None => self.write_whole(validator, |doc| doc.update(path, fun)),
+            },
+            None => self.update(path, fun),
+        }
+    }
+
+    fn update<F, R>(&mut self, path: &str, mut fun: F) -> Result<Option<R>, Error>
+    where
+        F: FnMut(&mut Value) -> Result<R, Error>,
+    {
+        let _mutate = trace::phase_guard("mutate");
+        self.forget_digests(path, false);
+        if let Some(steps) = static_steps(path) {
+            // Changed in place: selecting the value with `SelectorMut` walks the whole document
+            return match defrag::get_mut(self.data_mut(), &steps) {
+                Some(value) => {
+                    let res = fun(value)?;
+                    self.bump_rev();
+                    Ok(Some(res))
+                }
+                None => Ok(None),
+            };
+        }
+        let current_data = self.take_data();
 
         let mut errors = vec![];
-        let mut result = Value::Null; // TODO handle case where path not found
+        let mut result = None;
 
-        let mut collect_fun = |value: Value| {
-            fun(&value)
-                .map(|new_value| {
-                    result = new_value.clone();
-                    new_value
-                })
-                .map_err(|e| {
-                    errors.push(e);
-                })
-                .unwrap_or(value)
+        let mut collect_fun = |mut value: Value| {
+            match fun(&mut value) {
+                Ok(res) => result = Some(res),
+                Err(e) => errors.push(e),
+            }
+            value
         };
 
-        self.data = if path == "$" {
+        self.data = Arc::new(if path == "$" {
             // root needs special handling
             collect_fun(current_data)
         } else {
@@ -393,7 +826,11 @@ impl RedisJSON {
                     errors.push(e.into());
                 })
                 .unwrap_or(current_data)
-        };
+        });
+
+        if result.is_some() && errors.is_empty() {
+            self.bump_rev();
+        }
 
         match errors.len() {
             0 => Ok(result),
@@ -412,23 +849,63 @@ impl RedisJSON {
             Value::Array(v) => mem::size_of_val(v),
             Value::Object(v) => mem::size_of_val(v),
         };
-        Ok(res)
+        // Each of the documents sharing the data accounts for its part
+        Ok(res / self.shares())
     }
 
     pub fn get_first<'a>(&'a self, path: &'a str) -> Result<&'a Value, Error> {
-        let results = self.get_values(path)?;
-        match results.first() {
-            Some(s) => Ok(s),
-            None => Err("ERR path does not exist".into()),
-        }
+        let first = match trace::phase("path", || first_match::compile(path))? {
+            // Stops at the first match
+            Some(steps) => {
+                let mut visits = 0;
+                let first = trace::phase("select", || {
+                    first_match::first(&self.data, &steps, &mut visits)
+                });
+                trace::count("visits", visits);
+                first
+            }
+            None => self.get_values(path)?.first().copied(),
+        };
+        first.ok_or_else(|| "ERR path does not exist".into())
     }
 
     pub fn get_values<'a>(&'a self, path: &'a str) -> Result<Vec<&'a Value>, Error> {
-        let results = jsonpath_lib::select(&self.data, path)?;
+        let results = trace::phase("select", || jsonpath_lib::select(&self.data, path))?;
+        trace::count("matches", results.len() as u64);
         Ok(results)
     }
 }
 
+///
+/// The steps of `path` if they are all keys and indexes, so that it leads to at most one value
+///
+fn static_steps(path: &str) -> Option<Vec<Step>> {
+    first_match::compile(path).ok().flatten().filter(|steps| {
+        steps
+            .iter()
+            .all(|step| matches!(step, Step::Key(_) | Step::Index(_)))
+    })
+}
+
+///
+/// Orders locations made of keys and indexes in document order, parents first
+///
+fn compare_locations(a: &[Step], b: &[Step]) -> Ordering {
+    for (a, b) in a.iter().zip(b.iter()) {
+        let ordering = match (a, b) {
+            (Step::Key(a), Step::Key(b)) => a.cmp(b),
+            (Step::Index(a), Step::Index(b)) => a.cmp(b),
+            (Step::Key(_), _) => Ordering::Less,
+            (_, Step::Key(_)) => Ordering::Greater,
+            _ => Ordering::Equal,
+        };
+        if ordering != Ordering::Equal {
+            return ordering;
+        }
+    }
+    a.len().cmp(&b.len())
+}
+
 pub mod type_methods {
     use super::*;
 
@@ -436,23 +913,39 @@ pub mod type_methods {
     pub extern "C" fn rdb_load(rdb: *mut raw::RedisModuleIO, encver: c_int) -> *mut c_void {
         let json = match encver {
             0 => RedisJSON {
-                data: backward::json_rdb_load(rdb),
+                data: Arc::new(backward::json_rdb_load(rdb)),
                 value_index: None, // TODO handle load from rdb
+                rev: 1,
+                json_schema: None,
+                digests: RefCell::default(),
             },
-            2 => {
+            2..=7 => {
                 let data = raw::load_string(rdb);
-                let schema = if raw::load_unsigned(rdb) > 0 {
+                let mut schema = if raw::load_unsigned(rdb) > 0 {
                     Some(ValueIndex {
                         key: raw::load_string(rdb),
                         index_name: raw::load_string(rdb),
+                        db: 0,
                     })
                 } else {
                     None
                 };
-                let doc = RedisJSON::from_str(&data, &schema, Format::JSON).unwrap();
+                if encver >= 7 {
+                    if let Some(schema) = &mut schema {
+                        schema.db = raw::load_unsigned(rdb) as i32;
+                    }
+                }
+                let mut doc = RedisJSON::from_str(&data, &schema, Format::JSON).unwrap();
+                if encver >= 3 {
+                    doc.rev = raw::load_unsigned(rdb);
+                }
+                if encver >= 6 && raw::load_unsigned(rdb) > 0 {
+                    doc.json_schema = Some(raw::load_string(rdb));
+                }
                 if let Some(schema) = schema {
                     index::add_document(&schema.key, &schema.index_name, &doc).unwrap();
                 }
+                sindex::update_document(&doc);
                 doc
             }
             _ => panic!("Can't load old RedisJSON RDB"),
@@ -469,6 +962,7 @@ pub mod type_methods {
 
         if let Some(value_index) = &json.value_index {
             index::remove_document(&value_index.key, &value_index.index_name);
+            sindex::remove_document(value_index);
         }
     }
 
@@ -480,11 +974,28 @@ pub mod type_methods {
             raw::save_unsigned(rdb, 1);
             raw::save_string(rdb, &value_index.key);
             raw::save_string(rdb, &value_index.index_name);
+            raw::save_unsigned(rdb, value_index.db as u64);
+        } else {
+            raw::save_unsigned(rdb, 0);
+        }
+        raw::save_unsigned(rdb, json.rev);
+        if let Some(name) = &json.json_schema {
+            raw::save_unsigned(rdb, 1);
+            raw::save_string(rdb, name);
         } else {
             raw::save_unsigned(rdb, 0);
         }
     }
 
+    #[allow(non_snake_case, unused)]
+    pub unsafe extern "C" fn digest(md: *mut raw::RedisModuleDigest, value: *mut c_void) {
+        let json = &*(value as *mut RedisJSON);
+        if let Ok(hash) = json.digest("$") {
+            raw::RedisModule_DigestAddLongLong.unwrap()(md, hash as i64);
+        }
+        raw::RedisModule_DigestEndSequence.unwrap()(md);
+    }
+
     #[allow(non_snake_case, unused)]
     pub unsafe extern "C" fn aux_load(rdb: *mut raw::RedisModuleIO, encver: i32, when: i32) -> i32 {
         if (encver > REDIS_JSON_TYPE_VERSION) {
@@ -502,6 +1013,42 @@ pub mod type_methods {
                     index::add_field(&index_name, &field_name, &path);
                 }
             }
+
+            expire_map::init(expire::now_millis());
+            if encver >= 4 {
+                let expires = expire_map::as_mut();
+                let expires_size = raw::load_unsigned(rdb);
+                for _ in 0..expires_size {
+                    let db = raw::load_unsigned(rdb) as i32;
+                    let key = raw::load_string(rdb);
+                    let path = raw::load_string(rdb);
+                    let deadline = raw::load_unsigned(rdb);
+                    expires.set(db, &key, &path, deadline);
+                }
+            }
+
+            sindex_map::init();
+            if encver >= 5 {
+                let sindex_size = raw::load_unsigned(rdb);
+                for _ in 0..sindex_size {
+                    let index_name = raw::load_string(rdb);
+                    let paths_size = raw::load_unsigned(rdb);
+                    for _ in 0..paths_size {
+                        let path = raw::load_string(rdb);
+                        sindex::add_path(&index_name, &path);
+                    }
+                }
+            }
+
+            validator_map::init();
+            if encver >= 6 {
+                let validators_size = raw::load_unsigned(rdb);
+                for _ in 0..validators_size {
+                    let name = raw::load_string(rdb);
+                    let source = raw::load_string(rdb);
+                    validate::add_schema(&name, &source);
+                }
+            }
         }
 
         Status::Ok as i32
@@ -520,6 +1067,32 @@ pub mod type_methods {
                     raw::save_string(rdb, path);
                 }
             }
+
+            let expires = expire_map::as_mut();
+            raw::save_unsigned(rdb, expires.len() as u64);
+            for (db, key, path, deadline) in expires.iter() {
+                raw::save_unsigned(rdb, db as u64);
+                raw::save_string(rdb, key);
+                raw::save_string(rdb, path);
+                raw::save_unsigned(rdb, deadline);
+            }
+
+            let sindexes = sindex_map::as_ref();
+            raw::save_unsigned(rdb, sindexes.len() as u64);
+            for (name, index) in sindexes {
+                raw::save_string(rdb, name);
+                raw::save_unsigned(rdb, index.paths.len() as u64);
+                for path in index.paths.keys() {
+                    raw::save_string(rdb, path);
+                }
+            }
+
+            let validators = validator_map::as_ref();
+            raw::save_unsigned(rdb, validators.len() as u64);
+            for (name, validator) in validators {
+                raw::save_string(rdb, name);
+                raw::save_string(rdb, &validator.source);
+            }
         }
     }
 }
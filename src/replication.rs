@@ -0,0 +1,35 @@
+use redis_module::{raw, Context};
+use std::ffi::CString;
+use std::os::raw::c_char;
+
+///
+/// Replicates `cmd` with the given arguments to the replicas and the AOF.
+/// Used instead of `Context::replicate_verbatim` when the effect of a call is not
+/// the same as re-running the command that triggered it.
+///
+pub fn replicate(ctx: &Context, cmd: &str, args: &[&str]) {
+    let cmd = CString::new(cmd).unwrap();
+    let fmt = CString::new("v").unwrap();
+    unsafe {
+        let argv: Vec<*mut raw::RedisModuleString> = args
+            .iter()
+            .map(|arg| {
+                raw::RedisModule_CreateString.unwrap()(
+                    ctx.ctx,
+                    arg.as_ptr() as *const c_char,
+                    arg.len() as _,
+                )
+            })
+            .collect();
+        raw::RedisModule_Replicate.unwrap()(
+            ctx.ctx,
+            cmd.as_ptr(),
+            fmt.as_ptr(),
+            argv.as_ptr(),
+            argv.len(),
+        );
+        for arg in argv {
+            raw::RedisModule_FreeString.unwrap()(ctx.ctx, arg);
+        }
+    }
+}
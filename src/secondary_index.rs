@@ -0,0 +1,328 @@
+// Built-in secondary index, usable without RediSearch.
+//
+// Every indexed path keeps a hash index for equality lookups on any JSON scalar, and an ordered
+// index for range lookups on numbers and strings. The values each key was indexed with are kept
+// as well, so updating or removing a key touches only its own entries. The keys of every database
+// are indexed apart, since the same key name can exist in several of them.
+
+use serde_json::Value;
+use std::cmp::Ordering;
+use std::collections::{BTreeMap, HashMap, HashSet};
+use std::hash::{Hash, Hasher};
+use std::ops::Bound;
+
+#[derive(Debug, Clone)]
+pub enum IndexValue {
+    Null,
+    Bool(bool),
+    Number(f64),
+    String(String),
+}
+
+impl IndexValue {
+    pub fn from_json(value: &Value) -> Option<IndexValue> {
+        match value {
+            Value::Null => Some(IndexValue::Null),
+            Value::Bool(b) => Some(IndexValue::Bool(*b)),
+            // Normalize -0.0 so that it hashes like 0.0
+            Value::Number(n) => n.as_f64().map(|f| IndexValue::Number(f + 0.0)),
+            Value::String(s) => Some(IndexValue::String(s.clone())),
+            _ => None,
+        }
+    }
+
+    ///
+    /// The values a document is indexed by: the scalars at the path, or inside arrays at the path
+    ///
+    pub fn collect<'a, I>(values: I) -> Vec<IndexValue>
+    where
+        I: IntoIterator<Item = &'a Value>,
+    {
+        let mut res: Vec<IndexValue> = vec![];
+        for value in values {
+            match value {
+                Value::Array(arr) => res.extend(arr.iter().filter_map(IndexValue::from_json)),
+                _ => res.extend(IndexValue::from_json(value)),
+            }
+        }
+        res.sort();
+        res.dedup();
+        res
+    }
+
+    pub fn is_ordered(&self) -> bool {
+        match self {
+            IndexValue::Number(_) | IndexValue::String(_) => true,
+            _ => false,
+        }
+    }
+
+    fn rank(&self) -> u8 {
+        match self {
+            IndexValue::Null => 0,
+            IndexValue::Bool(_) => 1,
+            IndexValue::Number(_) => 2,
+            IndexValue::String(_) => 3,
+        }
+    }
+}
+
+impl Ord for IndexValue {
+    fn cmp(&self, other: &Self) -> Ordering {
+        match (self, other) {
+            (IndexValue::Bool(a), IndexValue::Bool(b)) => a.cmp(b),
+            // JSON numbers are never NaN
+            (IndexValue::Number(a), IndexValue::Number(b)) => {
+                a.partial_cmp(b).unwrap_or(Ordering::Equal)
+            }
+            (IndexValue::String(a), IndexValue::String(b)) => a.cmp(b),
+            _ => self.rank().cmp(&other.rank()),
+        }
+    }
+}
+
+impl PartialOrd for IndexValue {
+    fn partial_cmp(&self, other: &Self) -> Option<Ordering> {
+        Some(self.cmp(other))
+    }
+}
+
+impl PartialEq for IndexValue {
+    fn eq(&self, other: &Self) -> bool {
+        self.cmp(other) == Ordering::Equal
+    }
+}
+
+impl Eq for IndexValue {}
+
+impl Hash for IndexValue {
+    fn hash<H: Hasher>(&self, state: &mut H) {
+        self.rank().hash(state);
+        match self {
+            IndexValue::Null => {}
+            IndexValue::Bool(b) => b.hash(state),
+            IndexValue::Number(n) => n.to_bits().hash(state),
+            IndexValue::String(s) => s.hash(state),
+        }
+    }
+}
+
+#[derive(Default)]
+pub struct PathIndex {
+    hash: HashMap<IndexValue, HashSet<String>>,
+    ordered: BTreeMap<IndexValue, HashSet<String>>,
+    docs: HashMap<String, Vec<IndexValue>>,
+}
+
+impl PathIndex {
+    ///
+    /// Replaces the values `key` is indexed by, `values` must be sorted and deduplicated
+    ///
+    pub fn update(&mut self, key: &str, values: Vec<IndexValue>) {
+        if self.docs.get(key) == Some(&values) {
+            return;
+        }
+        self.remove(key);
+        if values.is_empty() {
+            return;
+        }
+        for value in &values {
+            self.hash
+                .entry(value.clone())
+                .or_insert_with(HashSet::new)
+                .insert(key.to_owned());
+            if value.is_ordered() {
+                self.ordered
+                    .entry(value.clone())
+                    .or_insert_with(HashSet::new)
+                    .insert(key.to_owned());
+            }
+        }
+        self.docs.insert(key.to_owned(), values);
+    }
+
+    pub fn remove(&mut self, key: &str) {
+        if let Some(values) = self.docs.remove(key) {
+            for value in &values {
+                if let Some(keys) = self.hash.get_mut(value) {
+                    keys.remove(key);
+                    if keys.is_empty() {
+                        self.hash.remove(value);
+                    }
+                }
+                if let Some(keys) = self.ordered.get_mut(value) {
+                    keys.remove(key);
+                    if keys.is_empty() {
+                        self.ordered.remove(value);
+                    }
+                }
+            }
+        }
+    }
+
+    pub fn len(&self) -> usize {
+        self.docs.len()
+    }
+
+    pub fn get(&self, value: &IndexValue) -> HashSet<&String> {
+        self.hash
+            .get(value)
+            .map_or_else(HashSet::new, |keys| keys.iter().collect())
+    }
+
+    ///
+    /// Keys with a value between `min` and `max`. Numbers sort before strings, but a range with a
+    /// single bound only spans the type of that bound.
+    ///
+    pub fn range(&self, min: Bound<IndexValue>, max: Bound<IndexValue>) -> HashSet<&String> {
+        let max = match (&min, max) {
+            (Bound::Included(IndexValue::Number(_)), Bound::Unbounded)
+            | (Bound::Excluded(IndexValue::Number(_)), Bound::Unbounded) => {
+                Bound::Excluded(IndexValue::String(String::new()))
+            }
+            (_, max) => max,
+        };
+        let min = match (min, &max) {
+            (Bound::Unbounded, Bound::Included(IndexValue::String(_)))
+            | (Bound::Unbounded, Bound::Excluded(IndexValue::String(_))) => {
+                Bound::Included(IndexValue::String(String::new()))
+            }
+            (min, _) => min,
+        };
+
+        // BTreeMap::range panics on empty or inverted ranges
+        let empty = match (&min, &max) {
+            (Bound::Included(a), Bound::Included(b)) => a > b,
+            (Bound::Included(a), Bound::Excluded(b))
+            | (Bound::Excluded(a), Bound::Included(b))
+            | (Bound::Excluded(a), Bound::Excluded(b)) => a >= b,
+            _ => false,
+        };
+        if empty {
+            return HashSet::new();
+        }
+
+        self.ordered
+            .range((min, max))
+            .flat_map(|(_, keys)| keys.iter())
+            .collect()
+    }
+}
+
+pub struct SecondaryIndex {
+    pub name: String,
+    // The index of each path, by database
+    pub paths: HashMap<String, HashMap<i32, PathIndex>>,
+}
+
+impl SecondaryIndex {
+    pub fn new(name: &str) -> SecondaryIndex {
+        SecondaryIndex {
+            name: name.to_owned(),
+            paths: HashMap::new(),
+        }
+    }
+
+    pub fn update<F>(&mut self, db: i32, key: &str, mut values_at: F)
+    where
+        F: FnMut(&str) -> Vec<IndexValue>,
+    {
+        for (path, indexes) in self.paths.iter_mut() {
+            indexes.entry(db).or_default().update(key, values_at(path));
+        }
+    }
+
+    pub fn remove(&mut self, db: i32, key: &str) {
+        for indexes in self.paths.values_mut() {
+            if let Some(index) = indexes.get_mut(&db) {
+                index.remove(key);
+            }
+        }
+    }
+
+    ///
+    /// The index of `path` in database `db`, `None` if `path` isn't indexed
+    ///
+    pub fn path_index(&self, path: &str, db: i32) -> Option<Option<&PathIndex>> {
+        self.paths.get(path).map(|indexes| indexes.get(&db))
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn values(json: &str) -> Vec<IndexValue> {
+        let value: Value = serde_json::from_str(json).unwrap();
+        IndexValue::collect(vec![&value])
+    }
+
+    fn sorted(keys: HashSet<&String>) -> Vec<&str> {
+        let mut keys: Vec<&str> = keys.into_iter().map(|k| k.as_str()).collect();
+        keys.sort();
+        keys
+    }
+
+    #[test]
+    fn test_equality_and_range() {
+        let mut index = PathIndex::default();
+        index.update("a", values("1"));
+        index.update("b", values("2.5"));
+        index.update("c", values("\"x\""));
+        index.update("d", values("[3, \"y\", true, {}]"));
+        index.update("e", values("null"));
+
+        assert_eq!(sorted(index.get(&IndexValue::Number(1.0))), vec!["a"]);
+        assert_eq!(sorted(index.get(&IndexValue::Bool(true))), vec!["d"]);
+        assert_eq!(sorted(index.get(&IndexValue::Null)), vec!["e"]);
+
+        let num = |n| IndexValue::Number(n);
+        let string = |s: &str| IndexValue::String(s.to_owned());
+        assert_eq!(
+            sorted(index.range(Bound::Included(num(1.0)), Bound::Excluded(num(3.0)))),
+            vec!["a", "b"]
+        );
+        assert_eq!(
+            sorted(index.range(Bound::Excluded(num(1.0)), Bound::Unbounded)),
+            vec!["b", "d"]
+        );
+        assert_eq!(
+            sorted(index.range(Bound::Unbounded, Bound::Included(string("x")))),
+            vec!["c"]
+        );
+        assert_eq!(
+            sorted(index.range(Bound::Included(num(3.0)), Bound::Excluded(num(3.0)))),
+            Vec::<&str>::new()
+        );
+
+        // Updates replace the previous values and removals drop every entry
+        index.update("d", values("[\"y\"]"));
+        assert!(index.get(&num(3.0)).is_empty());
+        index.remove("c");
+        index.remove("d");
+        assert!(index.range(Bound::Unbounded, Bound::Unbounded).len() == 2);
+        assert_eq!(index.len(), 3);
+    }
+
+    #[test]
+    fn test_databases() {
+        let mut index = SecondaryIndex::new("i");
+        index.paths.insert("$.a".to_string(), HashMap::new());
+        index.update(0, "k", |_| values("1"));
+        index.update(1, "k", |_| values("2"));
+
+        let keys = |index: &SecondaryIndex, db, n| {
+            index
+                .path_index("$.a", db)
+                .unwrap()
+                .map_or(0, |path_index| path_index.get(&IndexValue::Number(n)).len())
+        };
+        assert_eq!((keys(&index, 0, 1.0), keys(&index, 0, 2.0)), (1, 0));
+        assert_eq!((keys(&index, 1, 1.0), keys(&index, 1, 2.0)), (0, 1));
+        assert_eq!(keys(&index, 2, 1.0), 0);
+        assert!(index.path_index("$.b", 0).is_none());
+
+        index.remove(0, "k");
+        assert_eq!((keys(&index, 0, 1.0), keys(&index, 1, 2.0)), (0, 1));
+    }
+}
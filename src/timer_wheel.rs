@@ -0,0 +1,177 @@
+// Hierarchical timer wheel.
+//
+// Deadlines are absolute ticks (the module uses Unix milliseconds). Level `n` has `SLOTS` slots,
+// each covering `SLOTS^n` ticks, so inserting and expiring an entry is O(1) amortized no matter
+// how many timers are pending. Entries too far in the future for the top level wait in an overflow
+// list that is re-examined whenever the top level wraps around.
+
+use std::collections::VecDeque;
+use std::mem;
+
+const BITS: u32 = 6;
+const SLOTS: usize = 1 << BITS;
+const MASK: u64 = (SLOTS as u64) - 1;
+const LEVELS: usize = 6;
+
+struct Entry<T> {
+    deadline: u64,
+    item: T,
+}
+
+pub struct TimerWheel<T> {
+    levels: Vec<Vec<Vec<Entry<T>>>>,
+    overflow: Vec<Entry<T>>,
+    ready: VecDeque<(u64, T)>,
+    current: u64,
+    len: usize,
+}
+
+impl<T> TimerWheel<T> {
+    pub fn new(now: u64) -> Self {
+        TimerWheel {
+            levels: (0..LEVELS)
+                .map(|_| (0..SLOTS).map(|_| Vec::new()).collect())
+                .collect(),
+            overflow: Vec::new(),
+            ready: VecDeque::new(),
+            current: now,
+            len: 0,
+        }
+    }
+
+    ///
+    /// Number of pending entries, including expired ones that weren't popped yet
+    ///
+    pub fn len(&self) -> usize {
+        self.len
+    }
+
+    pub fn is_empty(&self) -> bool {
+        self.len == 0
+    }
+
+    ///
+    /// Whether expired entries are waiting to be popped
+    ///
+    pub fn has_expired(&self) -> bool {
+        !self.ready.is_empty()
+    }
+
+    pub fn insert(&mut self, deadline: u64, item: T) {
+        self.len += 1;
+        self.place(Entry { deadline, item });
+    }
+
+    fn place(&mut self, entry: Entry<T>) {
+        if entry.deadline <= self.current {
+            self.ready.push_back((entry.deadline, entry.item));
+            return;
+        }
+        // The lowest level whose enclosing block is shared by the deadline and the current tick
+        for level in 0..LEVELS {
+            let shift = BITS * (level as u32 + 1);
+            if entry.deadline >> shift == self.current >> shift {
+                let slot = ((entry.deadline >> (BITS * level as u32)) & MASK) as usize;
+                self.levels[level][slot].push(entry);
+                return;
+            }
+        }
+        self.overflow.push(entry);
+    }
+
+    ///
+    /// Moves the wheel forward to `now`, queueing every entry whose deadline has passed
+    ///
+    pub fn advance(&mut self, now: u64) {
+        if self.len == self.ready.len() {
+            // Nothing is waiting in the wheel, so skip the idle ticks
+            self.current = self.current.max(now);
+            return;
+        }
+        while self.current < now {
+            self.current += 1;
+            let tick = self.current;
+
+            // Cascade from the top so entries can trickle down several levels in one tick
+            if tick & ((1u64 << (BITS * LEVELS as u32)) - 1) == 0 {
+                for entry in mem::replace(&mut self.overflow, Vec::new()) {
+                    self.place(entry);
+                }
+            }
+            for level in (1..LEVELS).rev() {
+                if tick & ((1u64 << (BITS * level as u32)) - 1) == 0 {
+                    let slot = ((tick >> (BITS * level as u32)) & MASK) as usize;
+                    for entry in mem::replace(&mut self.levels[level][slot], Vec::new()) {
+                        self.place(entry);
+                    }
+                }
+            }
+
+            let slot = (tick & MASK) as usize;
+            for entry in mem::replace(&mut self.levels[0][slot], Vec::new()) {
+                self.ready.push_back((entry.deadline, entry.item));
+            }
+        }
+    }
+
+    ///
+    /// Pops at most `max` expired entries as `(deadline, item)` pairs
+    ///
+    pub fn pop_expired(&mut self, max: usize) -> Vec<(u64, T)> {
+        let n = max.min(self.ready.len());
+        self.len -= n;
+        self.ready.drain(..n).collect()
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn test_expire_in_order() {
+        let mut wheel = TimerWheel::new(1000);
+        for delta in &[5u64, 70, 3000, 300_000, 1, 64, 4096] {
+            wheel.insert(1000 + delta, *delta);
+        }
+        assert_eq!(wheel.len(), 7);
+
+        let mut expired = vec![];
+        let mut now = 1000;
+        while !wheel.is_empty() {
+            now += 7;
+            wheel.advance(now);
+            for (deadline, delta) in wheel.pop_expired(2) {
+                assert!(deadline <= now);
+                assert_eq!(deadline, 1000 + delta);
+                // Nothing may fire more than one advance step late
+                assert!(now - deadline < 7 + 2);
+                expired.push(delta);
+            }
+        }
+        assert_eq!(expired, vec![1, 5, 64, 70, 3000, 4096, 300_000]);
+    }
+
+    #[test]
+    fn test_overdue_and_overflow() {
+        let wrap = 1u64 << (BITS * LEVELS as u32);
+        let far = 2 * wrap + 100;
+
+        let mut wheel = TimerWheel::new(wrap - 10);
+        wheel.insert(10, "overdue");
+        wheel.insert(far, "far");
+        wheel.advance(wrap - 10);
+        assert_eq!(wheel.pop_expired(10), vec![(10, "overdue")]);
+        assert_eq!(wheel.len(), 1);
+
+        // The overflow list is re-examined every time the top level wraps around
+        wheel.advance(wrap);
+        assert!(wheel.pop_expired(10).is_empty());
+        wheel.current = 2 * wrap - 1;
+        wheel.advance(far - 1);
+        assert!(wheel.pop_expired(10).is_empty());
+        wheel.advance(far);
+        assert_eq!(wheel.pop_expired(10), vec![(far, "far")]);
+        assert!(wheel.is_empty());
+    }
+}
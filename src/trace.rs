@@ -0,0 +1,215 @@
+// Per-call tracing, for JSON.DEBUG TRACE.
+//
+// When tracing is on, commands record how long each phase of their work took (path compilation,
+// selection, mutation, serialization...) along with a few counters, and the calls are kept in a
+// bounded log, optionally only when slower than a threshold. Phases may nest: `mutate` includes the
+// `path` and `select` work done to find the values it changes. When tracing is off, every hook
+// costs a single relaxed atomic load.
+
+use std::cell::RefCell;
+use std::collections::VecDeque;
+use std::sync::atomic::{AtomicBool, Ordering};
+use std::time::Instant;
+
+pub const DEFAULT_SIZE: usize = 128;
+
+static ENABLED: AtomicBool = AtomicBool::new(false);
+
+pub struct Call {
+    pub command: &'static str,
+    pub key: String,
+    pub path: String,
+    pub total_ns: u64,
+    pub phases: Vec<(&'static str, u64)>,
+    pub counts: Vec<(&'static str, u64)>,
+    start: Instant,
+}
+
+pub struct TraceLog {
+    pub size: usize,
+    pub slower_than_ns: u64,
+    pub calls: VecDeque<Call>,
+}
+
+thread_local! {
+    // The call being traced on this thread, commands run one at a time
+    static CURRENT: RefCell<Option<Call>> = RefCell::new(None);
+}
+
+/// Only touched from the main thread, which is the only one that begins calls.
+static mut TRACE_LOG: Option<TraceLog> = None;
+
+fn log() -> &'static mut TraceLog {
+    unsafe {
+        TRACE_LOG.get_or_insert_with(|| TraceLog {
+            size: DEFAULT_SIZE,
+            slower_than_ns: 0,
+            calls: VecDeque::new(),
+        })
+    }
+}
+
+pub fn enabled() -> bool {
+    ENABLED.load(Ordering::Relaxed)
+}
+
+///
+/// Turns tracing on, keeping the last `size` calls taking at least `slower_than_ns`
+///
+pub fn enable(size: usize, slower_than_ns: u64) {
+    let log = log();
+    log.size = size;
+    log.slower_than_ns = slower_than_ns;
+    log.calls.truncate(size);
+    ENABLED.store(true, Ordering::Relaxed);
+}
+
+pub fn disable() {
+    ENABLED.store(false, Ordering::Relaxed);
+    CURRENT.with(|current| current.borrow_mut().take());
+}
+
+///
+/// The traced calls, newest first
+///
+pub fn calls() -> &'static VecDeque<Call> {
+    &log().calls
+}
+
+pub fn reset() {
+    log().calls.clear();
+}
+
+///
+/// Traces a call until the returned guard is dropped
+///
+pub fn begin(command: &'static str, key: &str, path: &str) -> Option<CallGuard> {
+    if !enabled() {
+        return None;
+    }
+    CURRENT.with(|current| {
+        *current.borrow_mut() = Some(Call {
+            command,
+            key: key.to_owned(),
+            path: path.to_owned(),
+            total_ns: 0,
+            phases: vec![],
+            counts: vec![],
+            start: Instant::now(),
+        })
+    });
+    Some(CallGuard)
+}
+
+pub struct CallGuard;
+
+impl Drop for CallGuard {
+    fn drop(&mut self) {
+        let call = CURRENT.with(|current| current.borrow_mut().take());
+        if let Some(mut call) = call {
+            call.total_ns = call.start.elapsed().as_nanos() as u64;
+            let log = log();
+            if call.total_ns >= log.slower_than_ns && log.size > 0 {
+                if log.calls.len() == log.size {
+                    log.calls.pop_back();
+                }
+                log.calls.push_front(call);
+            }
+        }
+    }
+}
+
+fn add(entries: &mut Vec<(&'static str, u64)>, name: &'static str, n: u64) {
+    match entries.iter_mut().find(|(entry, _)| *entry == name) {
+        Some((_, total)) => *total += n,
+        None => entries.push((name, n)),
+    }
+}
+
+///
+/// Runs `f`, adding the time it took to phase `name` of the call being traced
+///
+pub fn phase<T, F: FnOnce() -> T>(name: &'static str, f: F) -> T {
+    let _phase = phase_guard(name);
+    f()
+}
+
+///
+/// Adds the time until the returned guard is dropped to phase `name` of the call being traced
+///
+pub fn phase_guard(name: &'static str) -> Option<PhaseGuard> {
+    if !enabled() {
+        return None;
+    }
+    Some(PhaseGuard {
+        name,
+        start: Instant::now(),
+    })
+}
+
+pub struct PhaseGuard {
+    name: &'static str,
+    start: Instant,
+}
+
+impl Drop for PhaseGuard {
+    fn drop(&mut self) {
+        let elapsed = self.start.elapsed().as_nanos() as u64;
+        CURRENT.with(|current| {
+            if let Some(call) = current.borrow_mut().as_mut() {
+                add(&mut call.phases, self.name, elapsed);
+            }
+        });
+    }
+}
+
+///
+/// Adds `n` to counter `name` of the call being traced
+///
+pub fn count(name: &'static str, n: u64) {
+    if !enabled() {
+        return;
+    }
+    CURRENT.with(|current| {
+        if let Some(call) = current.borrow_mut().as_mut() {
+            add(&mut call.counts, name, n);
+        }
+    });
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn test_trace() {
+        assert!(begin("JSON.GET", "k", "$").is_none());
+        assert_eq!(phase("select", || 1), 1);
+
+        enable(2, 0);
+        for key in &["a", "b", "c"] {
+            let _call = begin("JSON.SET", key, "$.x");
+            phase("parse", || ());
+            phase("mutate", || phase("select", || ()));
+            phase("parse", || ());
+            count("visits", 3);
+            count("visits", 4);
+        }
+        let traced = calls();
+        assert_eq!(traced.len(), 2);
+        assert_eq!(traced[0].key, "c");
+        assert_eq!(traced[1].key, "b");
+        let names: Vec<&str> = traced[0].phases.iter().map(|(name, _)| *name).collect();
+        assert_eq!(names, vec!["parse", "select", "mutate"]);
+        assert_eq!(traced[0].counts, vec![("visits", 7)]);
+
+        // Fast calls aren't kept when there's a threshold
+        enable(2, u64::MAX);
+        reset();
+        drop(begin("JSON.GET", "k", "$"));
+        assert!(calls().is_empty());
+
+        disable();
+        assert!(begin("JSON.GET", "k", "$").is_none());
+    }
+}
@@ -0,0 +1,904 @@
+// JSON Schema validation, for JSON.SETSCHEMA and JSON.VALIDATE.
+//
+// A schema is compiled once into a flat list of nodes, with `$ref`s resolved to node positions,
+// so that validating a value never looks at the schema's JSON again. Supported keywords are the
+// draft 7 validation keywords minus `format`, `contains`, `propertyNames`, `dependencies` and
+// `if`/`then`/`else`; other keywords are ignored, as the specification mandates for unknown
+// ones. References must be JSON pointers within the same schema.
+//
+// Writes to a document only validate the values they change. A path made of keys and indexes
+// leads to the nodes that apply to the value at its end (`Validator::locate`), along with those
+// of its parent, for the constraints a container puts on its members. When a write can't be
+// checked locally, because of alternatives (`anyOf`, `oneOf`, `not`), positional `items`, or
+// `enum`, `const` or `uniqueItems` on any of the values that contain it, the whole document is
+// validated instead.
+
+use crate::first_match::Step;
+use regex::Regex;
+use serde_json::Value;
+use std::collections::{HashMap, HashSet};
+
+#[derive(Debug, Clone, Copy, PartialEq)]
+enum JsonType {
+    Null,
+    Boolean,
+    Integer,
+    Number,
+    String,
+    Array,
+    Object,
+}
+
+impl JsonType {
+    fn from_str(s: &str) -> Option<JsonType> {
+        match s {
+            "null" => Some(JsonType::Null),
+            "boolean" => Some(JsonType::Boolean),
+            "integer" => Some(JsonType::Integer),
+            "number" => Some(JsonType::Number),
+            "string" => Some(JsonType::String),
+            "array" => Some(JsonType::Array),
+            "object" => Some(JsonType::Object),
+            _ => None,
+        }
+    }
+
+    fn name(self) -> &'static str {
+        match self {
+            JsonType::Null => "null",
+            JsonType::Boolean => "boolean",
+            JsonType::Integer => "integer",
+            JsonType::Number => "number",
+            JsonType::String => "string",
+            JsonType::Array => "array",
+            JsonType::Object => "object",
+        }
+    }
+
+    fn matches(self, value: &Value) -> bool {
+        match (self, value) {
+            (JsonType::Null, Value::Null)
+            | (JsonType::Boolean, Value::Bool(_))
+            | (JsonType::Number, Value::Number(_))
+            | (JsonType::String, Value::String(_))
+            | (JsonType::Array, Value::Array(_))
+            | (JsonType::Object, Value::Object(_)) => true,
+            (JsonType::Integer, Value::Number(n)) => {
+                n.is_i64() || n.is_u64() || n.as_f64().map_or(false, |f| f.fract() == 0.0)
+            }
+            _ => false,
+        }
+    }
+}
+
+enum Items {
+    Any,
+    All(usize),
+    Tuple(Vec<usize>, Option<usize>),
+}
+
+impl Default for Items {
+    fn default() -> Self {
+        Items::Any
+    }
+}
+
+#[derive(Default)]
+struct Keywords {
+    types: Option<Vec<JsonType>>,
+    enumeration: Option<Vec<Value>>,
+    constant: Option<Value>,
+
+    minimum: Option<f64>,
+    maximum: Option<f64>,
+    exclusive_minimum: Option<f64>,
+    exclusive_maximum: Option<f64>,
+    multiple_of: Option<f64>,
+
+    min_length: Option<usize>,
+    max_length: Option<usize>,
+    pattern: Option<Regex>,
+
+    items: Items,
+    min_items: Option<usize>,
+    max_items: Option<usize>,
+    unique_items: bool,
+
+    properties: HashMap<String, usize>,
+    pattern_properties: Vec<(Regex, usize)>,
+    additional_properties: Option<usize>,
+    required: Vec<String>,
+    min_properties: Option<usize>,
+    max_properties: Option<usize>,
+
+    all_of: Vec<usize>,
+    any_of: Vec<usize>,
+    one_of: Vec<usize>,
+    not: Option<usize>,
+    reference: Option<usize>,
+}
+
+enum Node {
+    Bool(bool),
+    Keywords(Box<Keywords>),
+}
+
+pub struct Validator {
+    // The schema as registered, kept for persistence
+    pub source: String,
+    nodes: Vec<Node>,
+}
+
+///
+/// What applies to the value at the end of a path, see `Validator::locate`
+///
+pub struct Location {
+    nodes: Vec<usize>,
+    parent_nodes: Vec<usize>,
+    parent_len: usize,
+    // The member's key, when the parent is an object
+    key: Option<String>,
+    exists: bool,
+}
+
+impl Location {
+    pub fn exists(&self) -> bool {
+        self.exists
+    }
+}
+
+struct Violation {
+    // Innermost first
+    location: Vec<String>,
+    reason: String,
+}
+
+impl Violation {
+    fn new(reason: String) -> Violation {
+        Violation {
+            location: vec![],
+            reason,
+        }
+    }
+
+    fn at(mut self, step: String) -> Violation {
+        self.location.push(step);
+        self
+    }
+
+    fn message(&self, prefix: &str) -> String {
+        let mut location = prefix.to_string();
+        for step in self.location.iter().rev() {
+            location.push_str(step);
+        }
+        format!("ERR schema violation at {}: {}", location, self.reason)
+    }
+}
+
+fn key_step(key: &str) -> String {
+    format!("[{}]", Value::from(key))
+}
+
+fn index_step(index: usize) -> String {
+    format!("[{}]", index)
+}
+
+struct Compiler<'a> {
+    root: &'a Value,
+    nodes: Vec<Node>,
+    compiled: HashMap<String, usize>,
+}
+
+fn invalid(pointer: &str, reason: &str) -> String {
+    format!("ERR invalid schema at #{}: {}", pointer, reason)
+}
+
+fn escape_pointer(key: &str) -> String {
+    key.replace('~', "~0").replace('/', "~1")
+}
+
+impl<'a> Compiler<'a> {
+    fn compile(&mut self, pointer: &str) -> Result<usize, String> {
+        if let Some(&node) = self.compiled.get(pointer) {
+            return Ok(node);
+        }
+        let schema = self
+            .root
+            .pointer(pointer)
+            .ok_or_else(|| invalid(pointer, "unresolvable reference"))?;
+
+        // Reserved before the children are compiled, so that references can loop back to it
+        let node = self.nodes.len();
+        self.nodes.push(Node::Bool(true));
+        self.compiled.insert(pointer.to_string(), node);
+
+        self.nodes[node] = match schema {
+            Value::Bool(b) => Node::Bool(*b),
+            Value::Object(_) => Node::Keywords(Box::new(self.keywords(pointer, schema)?)),
+            _ => return Err(invalid(pointer, "a schema must be an object or a boolean")),
+        };
+        Ok(node)
+    }
+
+    fn keywords(&mut self, pointer: &str, schema: &Value) -> Result<Keywords, String> {
+        let number = |name: &str| -> Result<Option<f64>, String> {
+            schema.get(name).map_or(Ok(None), |v| {
+                v.as_f64()
+                    .map(Some)
+                    .ok_or_else(|| invalid(pointer, &format!("`{}` must be a number", name)))
+            })
+        };
+        let count = |name: &str| -> Result<Option<usize>, String> {
+            schema.get(name).map_or(Ok(None), |v| {
+                v.as_u64().map(|n| Some(n as usize)).ok_or_else(|| {
+                    invalid(
+                        pointer,
+                        &format!("`{}` must be a non-negative integer", name),
+                    )
+                })
+            })
+        };
+        let regex = |pattern: &str| {
+            Regex::new(pattern).map_err(|e| invalid(pointer, &format!("bad pattern: {}", e)))
+        };
+
+        let mut k = Keywords::default();
+        k.types = match schema.get("type") {
+            None => None,
+            Some(Value::String(t)) => Some(vec![t.as_str()]),
+            Some(Value::Array(types)) => Some(types.iter().filter_map(Value::as_str).collect()),
+            Some(_) => return Err(invalid(pointer, "`type` must be a string or an array")),
+        }
+        .map(|types| {
+            types
+                .into_iter()
+                .map(|t| JsonType::from_str(t).ok_or_else(|| invalid(pointer, "unknown `type`")))
+                .collect::<Result<Vec<_>, _>>()
+        })
+        .transpose()?;
+        k.enumeration = match schema.get("enum") {
+            None => None,
+            Some(Value::Array(values)) => Some(values.clone()),
+            Some(_) => return Err(invalid(pointer, "`enum` must be an array")),
+        };
+        k.constant = schema.get("const").cloned();
+
+        k.minimum = number("minimum")?;
+        k.maximum = number("maximum")?;
+        k.exclusive_minimum = number("exclusiveMinimum")?;
+        k.exclusive_maximum = number("exclusiveMaximum")?;
+        k.multiple_of = number("multipleOf")?;
+
+        k.min_length = count("minLength")?;
+        k.max_length = count("maxLength")?;
+        if let Some(pattern) = schema.get("pattern") {
+            let pattern = pattern
+                .as_str()
+                .ok_or_else(|| invalid(pointer, "`pattern` must be a string"))?;
+            k.pattern = Some(regex(pattern)?);
+        }
+
+        k.items = match schema.get("items") {
+            None => Items::Any,
+            Some(Value::Array(items)) => {
+                let items = (0..items.len())
+                    .map(|i| self.compile(&format!("{}/items/{}", pointer, i)))
+                    .collect::<Result<Vec<_>, _>>()?;
+                let additional = match schema.get("additionalItems") {
+                    Some(_) => Some(self.compile(&format!("{}/additionalItems", pointer))?),
+                    None => None,
+                };
+                Items::Tuple(items, additional)
+            }
+            Some(_) => Items::All(self.compile(&format!("{}/items", pointer))?),
+        };
+        k.min_items = count("minItems")?;
+        k.max_items = count("maxItems")?;
+        k.unique_items = schema.get("uniqueItems") == Some(&Value::Bool(true));
+
+        if let Some(properties) = schema.get("properties") {
+            let properties = properties
+                .as_object()
+                .ok_or_else(|| invalid(pointer, "`properties` must be an object"))?;
+            for key in properties.keys() {
+                let node =
+                    self.compile(&format!("{}/properties/{}", pointer, escape_pointer(key)))?;
+                k.properties.insert(key.clone(), node);
+            }
+        }
+        if let Some(patterns) = schema.get("patternProperties") {
+            let patterns = patterns
+                .as_object()
+                .ok_or_else(|| invalid(pointer, "`patternProperties` must be an object"))?;
+            for pattern in patterns.keys() {
+                let node = self.compile(&format!(
+                    "{}/patternProperties/{}",
+                    pointer,
+                    escape_pointer(pattern)
+                ))?;
+                k.pattern_properties.push((regex(pattern)?, node));
+            }
+        }
+        if schema.get("additionalProperties").is_some() {
+            k.additional_properties =
+                Some(self.compile(&format!("{}/additionalProperties", pointer))?);
+        }
+        k.required = match schema.get("required") {
+            None => vec![],
+            Some(Value::Array(keys)) => keys
+                .iter()
+                .map(|key| key.as_str().map(str::to_string))
+                .collect::<Option<_>>()
+                .ok_or_else(|| invalid(pointer, "`required` must be an array of strings"))?,
+            Some(_) => return Err(invalid(pointer, "`required` must be an array")),
+        };
+        k.min_properties = count("minProperties")?;
+        k.max_properties = count("maxProperties")?;
+
+        for (name, nodes) in &mut [
+            ("allOf", &mut k.all_of),
+            ("anyOf", &mut k.any_of),
+            ("oneOf", &mut k.one_of),
+        ] {
+            if let Some(schemas) = schema.get(*name) {
+                let len = schemas
+                    .as_array()
+                    .ok_or_else(|| invalid(pointer, &format!("`{}` must be an array", name)))?
+                    .len();
+                for i in 0..len {
+                    nodes.push(self.compile(&format!("{}/{}/{}", pointer, name, i))?);
+                }
+            }
+        }
+        if schema.get("not").is_some() {
+            k.not = Some(self.compile(&format!("{}/not", pointer))?);
+        }
+        if let Some(reference) = schema.get("$ref") {
+            let reference = reference
+                .as_str()
+                .filter(|r| r.starts_with('#'))
+                .ok_or_else(|| invalid(pointer, "only local `$ref`s are supported"))?;
+            k.reference = Some(self.compile(&reference[1..])?);
+        }
+        Ok(k)
+    }
+}
+
+impl Validator {
+    pub fn compile(source: &str) -> Result<Validator, String> {
+        let schema: Value = serde_json::from_str(source).map_err(|e| e.to_string())?;
+        let mut compiler = Compiler {
+            root: &schema,
+            nodes: vec![],
+            compiled: HashMap::new(),
+        };
+        compiler.compile("")?;
+        Ok(Validator {
+            source: source.to_string(),
+            nodes: compiler.nodes,
+        })
+    }
+
+    ///
+    /// Validates a whole document
+    ///
+    pub fn validate(&self, value: &Value) -> Result<(), String> {
+        self.check(0, value, 0).map_err(|v| v.message("$"))
+    }
+
+    ///
+    /// `chain` counts the nodes applied to `value` on the way here, so that `$ref` cycles that
+    /// don't go down the value end instead of recursing forever
+    ///
+    fn check(&self, node: usize, value: &Value, chain: usize) -> Result<(), Violation> {
+        if chain > self.nodes.len() {
+            return Err(Violation::new("circular $ref".to_string()));
+        }
+        let k = match &self.nodes[node] {
+            Node::Bool(true) => return Ok(()),
+            Node::Bool(false) => return Err(Violation::new("no value is allowed".to_string())),
+            Node::Keywords(k) => k,
+        };
+        let chain = chain + 1;
+
+        if let Some(types) = &k.types {
+            if !types.iter().any(|t| t.matches(value)) {
+                let names: Vec<&str> = types.iter().map(|t| t.name()).collect();
+                return Err(Violation::new(format!("expected {}", names.join(" or "))));
+            }
+        }
+        if let Some(values) = &k.enumeration {
+            if !values.contains(value) {
+                return Err(Violation::new("value not in enum".to_string()));
+            }
+        }
+        if let Some(constant) = &k.constant {
+            if constant != value {
+                return Err(Violation::new(format!("expected {}", constant)));
+            }
+        }
+
+        match value {
+            Value::Number(n) => self.check_number(k, n.as_f64().unwrap_or(0.0))?,
+            Value::String(s) => {
+                let len = s.chars().count();
+                if k.min_length.map_or(false, |min| len < min) {
+                    return Err(Violation::new(format!(
+                        "shorter than {}",
+                        k.min_length.unwrap()
+                    )));
+                }
+                if k.max_length.map_or(false, |max| len > max) {
+                    return Err(Violation::new(format!(
+                        "longer than {}",
+                        k.max_length.unwrap()
+                    )));
+                }
+                if let Some(pattern) = &k.pattern {
+                    if !pattern.is_match(s) {
+                        return Err(Violation::new(format!("doesn't match {}", pattern)));
+                    }
+                }
+            }
+            Value::Array(arr) => {
+                check_count(arr.len(), k.min_items, k.max_items, "items")?;
+                if k.unique_items {
+                    for (i, item) in arr.iter().enumerate() {
+                        if arr[..i].contains(item) {
+                            return Err(
+                                Violation::new("duplicate item".to_string()).at(index_step(i))
+                            );
+                        }
+                    }
+                }
+                for (i, item) in arr.iter().enumerate() {
+                    let item_node = match &k.items {
+                        Items::Any => None,
+                        Items::All(node) => Some(*node),
+                        Items::Tuple(nodes, additional) => nodes.get(i).copied().or(*additional),
+                    };
+                    if let Some(item_node) = item_node {
+                        self.check(item_node, item, 0)
+                            .map_err(|v| v.at(index_step(i)))?;
+                    }
+                }
+            }
+            Value::Object(map) => {
+                check_count(map.len(), k.min_properties, k.max_properties, "properties")?;
+                for key in &k.required {
+                    if !map.contains_key(key) {
+                        return Err(Violation::new(format!(
+                            "missing required {}",
+                            key_step(key)
+                        )));
+                    }
+                }
+                for (key, member) in map {
+                    for member_node in self.member_nodes(k, key) {
+                        self.check(member_node, member, 0)
+                            .map_err(|v| v.at(key_step(key)))?;
+                    }
+                }
+            }
+            _ => {}
+        }
+
+        for &node in &k.all_of {
+            self.check(node, value, chain)?;
+        }
+        if !k.any_of.is_empty()
+            && !k
+                .any_of
+                .iter()
+                .any(|&node| self.check(node, value, chain).is_ok())
+        {
+            return Err(Violation::new("no match in anyOf".to_string()));
+        }
+        if !k.one_of.is_empty() {
+            let matches = k
+                .one_of
+                .iter()
+                .filter(|&&node| self.check(node, value, chain).is_ok())
+                .count();
+            if matches != 1 {
+                return Err(Violation::new(format!("{} matches in oneOf", matches)));
+            }
+        }
+        if let Some(node) = k.not {
+            if self.check(node, value, chain).is_ok() {
+                return Err(Violation::new("matches not".to_string()));
+            }
+        }
+        if let Some(node) = k.reference {
+            self.check(node, value, chain)?;
+        }
+        Ok(())
+    }
+
+    fn check_number(&self, k: &Keywords, n: f64) -> Result<(), Violation> {
+        let fail = |what: &str, bound: f64| Err(Violation::new(format!("{} {}", what, bound)));
+        if let Some(min) = k.minimum.filter(|&min| n < min) {
+            return fail("less than", min);
+        }
+        if let Some(max) = k.maximum.filter(|&max| n > max) {
+            return fail("greater than", max);
+        }
+        if let Some(min) = k.exclusive_minimum.filter(|&min| n <= min) {
+            return fail("not greater than", min);
+        }
+        if let Some(max) = k.exclusive_maximum.filter(|&max| n >= max) {
+            return fail("not less than", max);
+        }
+        if let Some(multiple) = k.multiple_of {
+            let quotient = n / multiple;
+            if (quotient - quotient.round()).abs() > f64::EPSILON * quotient.abs().max(1.0) {
+                return fail("not a multiple of", multiple);
+            }
+        }
+        Ok(())
+    }
+
+    ///
+    /// The nodes that apply to member `key` of an object
+    ///
+    fn member_nodes(&self, k: &Keywords, key: &str) -> Vec<usize> {
+        let mut nodes: Vec<usize> = k.properties.get(key).copied().into_iter().collect();
+        nodes.extend(
+            k.pattern_properties
+                .iter()
+                .filter(|(pattern, _)| pattern.is_match(key))
+                .map(|(_, node)| *node),
+        );
+        if nodes.is_empty() {
+            nodes.extend(k.additional_properties);
+        }
+        nodes
+    }
+
+    ///
+    /// The nodes that must all hold for a value matching `node`, following `$ref`s and `allOf`s,
+    /// or `None` if they depend on alternatives
+    ///
+    fn conjunction(&self, node: usize, res: &mut Vec<usize>, seen: &mut HashSet<usize>) -> bool {
+        if !seen.insert(node) {
+            return true;
+        }
+        match &self.nodes[node] {
+            Node::Bool(true) => true,
+            Node::Bool(false) => {
+                res.push(node);
+                true
+            }
+            Node::Keywords(k) => {
+                if !k.any_of.is_empty() || !k.one_of.is_empty() || k.not.is_some() {
+                    return false;
+                }
+                res.push(node);
+                k.all_of
+                    .iter()
+                    .chain(k.reference.iter())
+                    .all(|&node| self.conjunction(node, res, seen))
+            }
+        }
+    }
+
+    ///
+    /// Finds the nodes that apply to the value `steps` lead to in `doc`, and to its parent.
+    /// Returns `None` when a write at `steps` can't be validated on its own.
+    ///
+    pub fn locate(&self, doc: &Value, steps: &[Step]) -> Option<Location> {
+        let (last, parent_steps) = steps.split_last()?;
+
+        let mut nodes = vec![];
+        if !self.conjunction(0, &mut nodes, &mut HashSet::new()) || self.whole_value(&nodes) {
+            return None;
+        }
+        let mut value = doc;
+        for step in parent_steps {
+            let (child, child_nodes) = self.step(value, &nodes, step)?;
+            value = child?;
+            let mut next = vec![];
+            let mut seen = HashSet::new();
+            for node in child_nodes {
+                if !self.conjunction(node, &mut next, &mut seen) {
+                    return None;
+                }
+            }
+            if self.whole_value(&next) {
+                return None;
+            }
+            nodes = next;
+        }
+
+        let (current, child_nodes) = self.step(value, &nodes, last)?;
+        let parent_len = match value {
+            Value::Array(arr) => arr.len(),
+            Value::Object(map) => map.len(),
+            _ => return None,
+        };
+        Some(Location {
+            nodes: child_nodes,
+            parent_nodes: nodes,
+            parent_len,
+            key: match last {
+                Step::Key(key) => Some(key.clone()),
+                _ => None,
+            },
+            exists: current.is_some(),
+        })
+    }
+
+    ///
+    /// Whether any of `nodes` constrains its value as a whole (`enum`, `const`, `uniqueItems`),
+    /// so that a write anywhere below it must be checked against the entire value
+    ///
+    fn whole_value(&self, nodes: &[usize]) -> bool {
+        nodes.iter().any(|&node| match &self.nodes[node] {
+            Node::Keywords(k) => k.enumeration.is_some() || k.constant.is_some() || k.unique_items,
+            Node::Bool(_) => false,
+        })
+    }
+
+    fn step<'v>(
+        &self,
+        value: &'v Value,
+        nodes: &[usize],
+        step: &Step,
+    ) -> Option<(Option<&'v Value>, Vec<usize>)> {
+        let keywords = nodes.iter().filter_map(|&node| match &self.nodes[node] {
+            Node::Keywords(k) => Some(k),
+            Node::Bool(_) => None,
+        });
+        match step {
+            Step::Key(key) => {
+                let child = value.as_object()?.get(key);
+                let nodes = keywords.flat_map(|k| self.member_nodes(k, key)).collect();
+                Some((child, nodes))
+            }
+            Step::Index(index) => {
+                let arr = value.as_array()?;
+                // Like `first_match::first`
+                let index = if *index < 0 {
+                    (*index + arr.len() as isize).max(0) as usize
+                } else {
+                    *index as usize
+                };
+                let mut child_nodes = vec![];
+                for k in keywords {
+                    match &k.items {
+                        Items::Any => {}
+                        Items::All(node) => child_nodes.push(*node),
+                        // Positions shift as items are added and removed
+                        Items::Tuple(_, _) => return None,
+                    }
+                }
+                Some((arr.get(index), child_nodes))
+            }
+            Step::Wildcard | Step::Descendant(_) => None,
+        }
+    }
+
+    fn check_all(&self, nodes: &[usize], value: &Value) -> Result<(), Violation> {
+        for &node in nodes {
+            self.check(node, value, 0)?;
+        }
+        Ok(())
+    }
+
+    ///
+    /// Validates `value` as the new value at `location`, replacing the current one if it exists
+    ///
+    pub fn check_set(&self, location: &Location, value: &Value, path: &str) -> Result<(), String> {
+        let mut res = self.check_all(&location.nodes, value);
+        if res.is_ok() && !location.exists {
+            res = self.check_parent(location, location.parent_len + 1);
+        }
+        res.map_err(|v| v.message(path))
+    }
+
+    ///
+    /// Checks that the value at `location` can be deleted
+    ///
+    pub fn check_delete(&self, location: &Location, path: &str) -> Result<(), String> {
+        if !location.exists {
+            return Ok(());
+        }
+        let mut res = self.check_parent(location, location.parent_len - 1);
+        if let (Ok(()), Some(key)) = (&res, &location.key) {
+            for &node in &location.parent_nodes {
+                if let Node::Keywords(k) = &self.nodes[node] {
+                    if k.required.contains(key) {
+                        res = Err(Violation::new("required".to_string()));
+                    }
+                }
+            }
+        }
+        res.map_err(|v| v.message(path))
+    }
+
+    fn check_parent(&self, location: &Location, len: usize) -> Result<(), Violation> {
+        for &node in &location.parent_nodes {
+            match &self.nodes[node] {
+                Node::Keywords(k) => match location.key {
+                    Some(_) => check_count(len, k.min_properties, k.max_properties, "properties"),
+                    None => check_count(len, k.min_items, k.max_items, "items"),
+                }
+                .map_err(|v| Violation::new(format!("parent would have {}", v.reason)))?,
+                Node::Bool(_) => {}
+            }
+        }
+        Ok(())
+    }
+}
+
+fn check_count(
+    len: usize,
+    min: Option<usize>,
+    max: Option<usize>,
+    what: &str,
+) -> Result<(), Violation> {
+    if min.map_or(false, |min| len < min) {
+        return Err(Violation::new(format!(
+            "fewer than {} {}",
+            min.unwrap(),
+            what
+        )));
+    }
+    if max.map_or(false, |max| len > max) {
+        return Err(Violation::new(format!(
+            "more than {} {}",
+            max.unwrap(),
+            what
+        )));
+    }
+    Ok(())
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn validator(schema: &str) -> Validator {
+        Validator::compile(schema).unwrap()
+    }
+
+    fn valid(schema: &str, json: &str) -> bool {
+        validator(schema)
+            .validate(&serde_json::from_str(json).unwrap())
+            .is_ok()
+    }
+
+    #[test]
+    fn test_keywords() {
+        assert!(valid("true", "[1]"));
+        assert!(!valid("false", "[1]"));
+        assert!(valid(r#"{"type": "integer"}"#, "1.0"));
+        assert!(!valid(r#"{"type": "integer"}"#, "1.5"));
+        assert!(valid(r#"{"type": ["string", "null"]}"#, "null"));
+        assert!(!valid(r#"{"enum": [1, "a"]}"#, "2"));
+        assert!(valid(r#"{"const": {"a": 1}}"#, r#"{"a": 1}"#));
+        assert!(!valid(r#"{"minimum": 2, "exclusiveMaximum": 3}"#, "3"));
+        assert!(valid(r#"{"multipleOf": 0.1}"#, "0.3"));
+        assert!(!valid(r#"{"maxLength": 2}"#, r#""abc""#));
+        assert!(valid(r#"{"maxLength": 2}"#, r#""éé""#));
+        assert!(!valid(r#"{"pattern": "^a+$"}"#, r#""ab""#));
+        assert!(!valid(r#"{"items": {"type": "number"}}"#, r#"[1, "2"]"#));
+        assert!(!valid(
+            r#"{"items": [{"type": "number"}], "additionalItems": false}"#,
+            "[1, 2]"
+        ));
+        assert!(!valid(r#"{"uniqueItems": true}"#, "[1, 2, 1]"));
+        assert!(!valid(r#"{"minItems": 2}"#, "[1]"));
+        assert!(!valid(r#"{"required": ["a"]}"#, r#"{"b": 1}"#));
+        let object = r#"{
+            "properties": {"a": {"type": "string"}},
+            "patternProperties": {"^x": {"type": "number"}},
+            "additionalProperties": false
+        }"#;
+        assert!(valid(object, r#"{"a": "s", "x1": 1}"#));
+        assert!(!valid(object, r#"{"x1": "s"}"#));
+        assert!(!valid(object, r#"{"b": 1}"#));
+        assert!(valid(
+            r#"{"anyOf": [{"type": "string"}, {"minimum": 3}]}"#,
+            "4"
+        ));
+        assert!(!valid(
+            r#"{"oneOf": [{"type": "number"}, {"minimum": 3}]}"#,
+            "4"
+        ));
+        assert!(!valid(r#"{"not": {"type": "null"}}"#, "null"));
+        assert!(!valid(
+            r#"{"allOf": [{"minimum": 1}, {"maximum": 2}]}"#,
+            "3"
+        ));
+    }
+
+    #[test]
+    fn test_references() {
+        let tree = r##"{
+            "definitions": {"node": {
+                "type": "object",
+                "properties": {"children": {"type": "array", "items": {"$ref": "#/definitions/node"}}},
+                "required": ["children"]
+            }},
+            "$ref": "#/definitions/node"
+        }"##;
+        assert!(valid(tree, r#"{"children": [{"children": []}]}"#));
+        assert!(!valid(tree, r#"{"children": [{"children": [{}]}]}"#));
+        assert_eq!(
+            validator(tree)
+                .validate(&serde_json::from_str(r#"{"children": [{"children": [{}]}]}"#).unwrap())
+                .unwrap_err(),
+            r#"ERR schema violation at $["children"][0]["children"][0]: missing required ["children"]"#
+        );
+
+        // Loops that don't consume the value end
+        assert!(!valid(r##"{"$ref": "#"}"##, "1"));
+
+        assert!(Validator::compile(r##"{"$ref": "#/nowhere"}"##).is_err());
+        assert!(Validator::compile(r#"{"$ref": "other.json"}"#).is_err());
+        assert!(Validator::compile(r#"{"type": "integr"}"#).is_err());
+        assert!(Validator::compile(r#"{"pattern": "("}"#).is_err());
+        assert!(Validator::compile(r#"{"minItems": -1}"#).is_err());
+    }
+
+    #[test]
+    fn test_locate() {
+        let v = validator(
+            r#"{
+                "type": "object",
+                "properties": {
+                    "a": {"type": "array", "items": {"type": "integer"}, "minItems": 1},
+                    "b": {"anyOf": [{"type": "string"}, {"type": "object"}]},
+                    "c": {"items": [{"type": "string"}]},
+                    "d": {"type": "object", "required": ["e"], "maxProperties": 2},
+                    "u": {"uniqueItems": true},
+                    "k": {"const": {"x": 1}},
+                    "n": {"properties": {"y": {"enum": [[1, 2], [3]]}}}
+                }
+            }"#,
+        );
+        let doc: Value = serde_json::from_str(
+            r#"{"a": [1], "b": {"x": 1}, "c": ["s"], "d": {"e": 1}, "u": [{"a": 1}, {"a": 2}],
+                "k": {"x": 1}, "n": {"y": [1, 2]}}"#,
+        )
+        .unwrap();
+        let key = |k: &str| Step::Key(k.to_string());
+
+        let loc = v.locate(&doc, &[key("a"), Step::Index(0)]).unwrap();
+        assert!(loc.exists());
+        assert!(v.check_set(&loc, &Value::from(2), "$.a[0]").is_ok());
+        assert!(v.check_set(&loc, &Value::from("2"), "$.a[0]").is_err());
+        assert!(v.check_delete(&loc, "$.a[0]").is_err());
+
+        let loc = v.locate(&doc, &[key("d"), key("e")]).unwrap();
+        assert!(v.check_delete(&loc, "$.d.e").is_err());
+        let loc = v.locate(&doc, &[key("d"), key("f")]).unwrap();
+        assert!(!loc.exists());
+        assert!(v.check_set(&loc, &Value::from(1), "$.d.f").is_ok());
+        assert!(v.check_delete(&loc, "$.d.f").is_ok());
+
+        // Can't be checked locally
+        assert!(v.locate(&doc, &[key("b"), key("x")]).is_none());
+        assert!(v.locate(&doc, &[key("c"), Step::Index(0)]).is_none());
+        assert!(v.locate(&doc, &[key("u"), Step::Index(0)]).is_none());
+        // Nor below values constrained as a whole, at any depth
+        assert!(v
+            .locate(&doc, &[key("u"), Step::Index(0), key("a")])
+            .is_none());
+        assert!(v.locate(&doc, &[key("k"), key("x")]).is_none());
+        assert!(v
+            .locate(&doc, &[key("n"), key("y"), Step::Index(0)])
+            .is_none());
+        assert!(v.locate(&doc, &[key("n"), key("y")]).is_some());
+        assert!(validator(r#"{"enum": [{"x": 1}]}"#)
+            .locate(&doc, &[key("x")])
+            .is_none());
+        assert!(v.locate(&doc, &[Step::Wildcard]).is_none());
+        assert!(v.locate(&doc, &[key("missing"), key("x")]).is_none());
+
+        // Members of unconstrained values are unconstrained
+        let loc = v.locate(&doc, &[key("x")]).unwrap();
+        assert!(v.check_set(&loc, &Value::Null, "$.x").is_ok());
+    }
+}
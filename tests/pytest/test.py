@@ -4,6 +4,8 @@ import sys
 import os
 import redis
 import json
+import tempfile
+import time
 from RLTest import Env
 from includes import *
 
@@ -687,6 +689,608 @@ def testSetGetComparePassJSONCaseFiles(env):
                     d2 = json.loads(raw)
                     r.assertEqual(d1, d2, message=path)
 
+def testParserBackends(env):
+    """Test that every available parser agrees on the JSON test case files"""
+    r = env
+
+    default = r.execute_command('JSON.DEBUG', 'PARSER')
+    r.assertEqual(r.execute_command('JSON.DEBUG', 'PARSER', 'SCALAR'), 'SCALAR')
+    try:
+        r.execute_command('JSON.DEBUG', 'PARSER', 'SIMD')
+    except redis.exceptions.ResponseError:
+        env.skip()  # Not supported by this build or CPU
+    r.expect('JSON.DEBUG', 'PARSER', 'FOO').raiseError()
+
+    for jsonfile in os.listdir(JSON_PATH):
+        if not jsonfile.endswith('.json'):
+            continue
+        with open('{}/{}'.format(JSON_PATH, jsonfile), 'rb') as f:
+            value = f.read()
+        results = []
+        for parser in ['SCALAR', 'SIMD']:
+            r.assertEqual(r.execute_command('JSON.DEBUG', 'PARSER', parser), parser)
+            try:
+                r.execute_command('JSON.SET', parser, '.', value)
+                results.append(r.execute_command('JSON.GET', parser))
+            except redis.exceptions.ResponseError:
+                results.append(None)
+            r.execute_command('DEL', parser)
+        r.assertEqual(results[0], results[1], message=jsonfile)
+        if jsonfile.startswith('pass-'):
+            r.assertIsNotNone(results[0], message=jsonfile)
+
+    # Both stop at the same nesting depth, past the size from which SIMD is used
+    for depth, ok in [(127, True), (128, False), (10000, False)]:
+        value = '[' * depth + ']' * depth
+        for parser in ['SCALAR', 'SIMD']:
+            r.assertEqual(r.execute_command('JSON.DEBUG', 'PARSER', parser), parser)
+            if ok:
+                r.assertOk(r.execute_command('JSON.SET', parser, '.', value))
+                r.assertEqual(r.execute_command('JSON.GET', parser), value)
+                r.execute_command('DEL', parser)
+            else:
+                r.expect('JSON.SET', parser, '.', value).raiseError()
+
+    r.assertEqual(r.execute_command('JSON.DEBUG', 'PARSER', default), default)
+
+def testRevisionCommands(env):
+    """Test IFREV conditional reads and REV compare-and-set writes"""
+    r = env
+
+    # A missing key is at revision 0
+    r.expect('JSON.SET', 'test', '.', '{"foo":1}', 'REV', 1).raiseError()
+    r.assertOk(r.execute_command('JSON.SET', 'test', '.', '{"foo":1}', 'REV', 0))
+
+    rev, raw = r.execute_command('JSON.GET', 'test', 'IFREV', 0)
+    r.assertEqual(rev, 1)
+    r.assertEqual(json.loads(raw), {'foo': 1})
+    r.assertEqual(r.execute_command('JSON.GET', 'test', 'IFREV', rev), 'NOTMODIFIED')
+
+    # Every successful write bumps the revision
+    r.assertEqual(r.execute_command('JSON.NUMINCRBY', 'test', '.foo', 1, 'REV', rev), '2')
+    r.expect('JSON.NUMINCRBY', 'test', '.foo', 1, 'REV', rev).raiseError()
+    r.assertOk(r.execute_command('JSON.SET', 'test', '.bar', '[]', 'REV', rev + 1))
+    r.assertEqual(r.execute_command('JSON.ARRAPPEND', 'test', '.bar', 1, 2, 'REV', rev + 2), 2)
+    r.assertEqual(r.execute_command('JSON.DEL', 'test', 'REV', rev + 3, '.foo'), 1)
+
+    rev, raw = r.execute_command('JSON.GET', 'test', '.bar', 'IFREV', rev)
+    r.assertEqual(rev, 5)
+    r.assertEqual(json.loads(raw), [1, 2])
+
+    # Failed writes leave the revision as is
+    r.expect('JSON.STRAPPEND', 'test', '.bar', '"baz"').raiseError()
+    r.assertEqual(r.execute_command('JSON.GET', 'test', 'IFREV', rev), 'NOTMODIFIED')
+
+    for _ in r.retry_with_rdb_reload():
+        r.assertEqual(r.execute_command('JSON.GET', 'test', 'IFREV', rev), 'NOTMODIFIED')
+
+def testRevisionOptionPosition(env):
+    """Test that REV isn't mistaken for paths named REV"""
+    r = env
+
+    r.assertOk(r.execute_command('JSON.SET', 'test', '.', '{"a":1,"REV":2,"1":3,"b":4,"arr":[1,2]}'))
+
+    # After the paths, REV and a number are paths too
+    r.assertEqual(r.execute_command('JSON.DEL', 'test', 'a', 'REV', '1'), 3)
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'test')), {'b': 4, 'arr': [1, 2]})
+
+    # Right after the key, REV is the option
+    r.expect('JSON.DEL', 'test', 'REV', 1, 'b').raiseError()
+    r.assertEqual(r.execute_command('JSON.DEL', 'test', 'REV', 2, 'b'), 1)
+
+    # Without a path, JSON.ARRPOP takes REV as the path
+    r.assertOk(r.execute_command('JSON.SET', 'test', '.REV', '[5,6]'))
+    r.assertEqual(r.execute_command('JSON.ARRPOP', 'test', 'REV', 0), '5')
+    r.assertEqual(r.execute_command('JSON.ARRPOP', 'test', '.arr', 'REV', 5), '2')
+
+def testExpireCommand(env):
+    """Test path-level expiry with JSON.EXPIRE and JSON.TTL"""
+    r = env
+
+    r.assertOk(r.execute_command('JSON.SET', 'test', '.', '{"session":{"a":1,"b":2},"keep":true}'))
+    r.assertEqual(r.execute_command('JSON.EXPIRE', 'test', '.session.a', 1), 1)
+    r.assertEqual(r.execute_command('JSON.EXPIRE', 'test', '.missing', 1), 0)
+    r.assertEqual(r.execute_command('JSON.EXPIRE', 'missing', '.', 1), 0)
+    r.expect('JSON.EXPIRE', 'test', '.session.b', 0).raiseError()
+
+    r.assertEqual(r.execute_command('JSON.TTL', 'test', '.session.a'), 1)
+    r.assertEqual(r.execute_command('JSON.TTL', 'test', '.keep'), -1)
+    r.assertEqual(r.execute_command('JSON.TTL', 'test', '.missing'), -2)
+
+    time.sleep(1.5)
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'test')), {'session': {'b': 2}, 'keep': True})
+
+    # Expiries survive a reload
+    r.assertEqual(r.execute_command('JSON.EXPIRE', 'test', '.session.b', 100), 1)
+    for _ in r.retry_with_rdb_reload():
+        r.assertTrue(r.execute_command('JSON.TTL', 'test', '.session.b') > 90)
+
+    # Replacing a value drops the expiries below it
+    r.assertOk(r.execute_command('JSON.SET', 'test', '.session', '{"b":3}'))
+    r.assertEqual(r.execute_command('JSON.TTL', 'test', '.session.b'), -1)
+
+    # Only paths made of object keys can expire
+    r.assertOk(r.execute_command('JSON.SET', 'test', '.arr', '[1,2,3]'))
+    r.expect('JSON.EXPIRE', 'test', '.arr[1]', 100).raiseError()
+    r.expect('JSON.EXPIRE', 'test', '$..b', 100).raiseError()
+    r.expect('JSON.EXPIRE', 'test', '.session.b', 2 ** 62).raiseError()
+
+    # Deadlines can be absolute, which is what is replicated
+    deadline = int(time.time() * 1000) + 100000
+    r.assertEqual(r.execute_command('JSON.PEXPIREAT', 'test', '.session.b', deadline), 1)
+    r.assertTrue(r.execute_command('JSON.TTL', 'test', '.session.b') > 90)
+    r.assertEqual(r.execute_command('JSON.PEXPIREAT', 'test', '.session', int(time.time() * 1000) - 1), 1)
+    time.sleep(0.5)
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'test')), {'keep': True, 'arr': [1, 2, 3]})
+
+    # Renaming a key takes its expiries along, deleting it drops them
+    r.assertEqual(r.execute_command('JSON.EXPIRE', 'test', '.keep', 100), 1)
+    r.assertOk(r.execute_command('RENAME', 'test', 'renamed'))
+    r.assertTrue(r.execute_command('JSON.TTL', 'renamed', '.keep') > 90)
+    r.assertEqual(r.execute_command('DEL', 'renamed'), 1)
+    r.assertOk(r.execute_command('JSON.SET', 'renamed', '.', '{"keep":true}'))
+    r.assertEqual(r.execute_command('JSON.TTL', 'renamed', '.keep'), -1)
+
+def testMSetCommand(env):
+    """Test JSON.MSET"""
+    r = env
+
+    r.assertOk(r.execute_command('JSON.SET', 'doc', '.', '{"a":1,"b":{"c":2}}'))
+    r.assertOk(r.execute_command('JSON.MSET',
+                                 'doc', '.a', '3',
+                                 'doc', '.b.d', '"x"',
+                                 'new', '.', '{"e":[]}',
+                                 'new', '.f', 'true'))
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'doc')), {'a': 3, 'b': {'c': 2, 'd': 'x'}})
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'new')), {'e': [], 'f': True})
+
+    # Nothing is changed unless every write can be applied
+    r.expect('JSON.MSET', 'doc', '.a', '4', 'other', '.', '{}', 'doc', '.b', '{"bad"').raiseError()
+    r.expect('JSON.MSET', 'doc', '.a', '4', 'missing', '.g', '1').raiseError()
+    r.expect('JSON.MSET', 'doc', '.a', '4', 'doc', '$..zz', '1').raiseError()
+    r.expect('JSON.MSET', 'doc', '.a', '4', 'brand', '.', '{}', 'brand', '$..zz', '1').raiseError()
+    r.expect('JSON.MSET', 'doc', '.a').raiseError()
+    r.assertEqual(r.execute_command('JSON.GET', 'doc', '.a'), '3')
+    r.assertEqual(r.execute_command('EXISTS', 'other', 'brand'), 0)
+
+    r.assertOk(r.execute_command('SET', 'string', 'foo'))
+    r.expect('JSON.MSET', 'doc', '.a', '4', 'string', '.', '{}').raiseError()
+    r.assertEqual(r.execute_command('JSON.GET', 'doc', '.a'), '3')
+
+    # Writes to the same key apply to the result of the previous ones, and a later failing
+    # write undoes them all
+    r.assertOk(r.execute_command('JSON.SET', 'arr', '.', '{"a":[1,2]}'))
+    r.expect('JSON.MSET', 'arr', '.a', '{}', 'doc', '.a', '5', 'arr', '.a[0]', '5').raiseError()
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'arr')), {'a': [1, 2]})
+    r.assertEqual(r.execute_command('JSON.GET', 'doc', '.a'), '3')
+    r.assertOk(r.execute_command('JSON.MSET', 'arr', '.a', '{}', 'arr', '.a.b', '5'))
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'arr')), {'a': {'b': 5}})
+
+def testUploadCommand(env):
+    """Test JSON.UPLOAD"""
+    r = env
+
+    doc = {'a': [1, -2.5e3, 'x"y', True, None], 'b': {'c': {}}, 'd': 'z' * 100}
+    value = json.dumps(doc)
+
+    upload = r.execute_command('JSON.UPLOAD', 'BEGIN', 'doc', '.')
+    for i in range(0, len(value), 7):
+        r.assertEqual(r.execute_command('JSON.UPLOAD', 'CHUNK', upload, value[i:i + 7]), min(i + 7, len(value)))
+    r.assertIsNone(r.execute_command('JSON.GET', 'doc'))
+    r.assertOk(r.execute_command('JSON.UPLOAD', 'COMMIT', upload))
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'doc')), doc)
+    r.expect('JSON.UPLOAD', 'COMMIT', upload).raiseError()
+
+    # Uploads can set paths, with the same options as JSON.SET
+    upload = r.execute_command('JSON.UPLOAD', 'BEGIN', 'doc', '.b.e', 'NX')
+    r.assertEqual(r.execute_command('JSON.UPLOAD', 'CHUNK', upload, '[1, 2'), 5)
+    r.assertEqual(r.execute_command('JSON.UPLOAD', 'CHUNK', upload, ', 3]'), 9)
+    r.assertOk(r.execute_command('JSON.UPLOAD', 'COMMIT', upload))
+    r.assertEqual(r.execute_command('JSON.GET', 'doc', '.b.e'), '[1,2,3]')
+    upload = r.execute_command('JSON.UPLOAD', 'BEGIN', 'doc', '.b.e', 'NX')
+    r.execute_command('JSON.UPLOAD', 'CHUNK', upload, '4')
+    r.assertIsNone(r.execute_command('JSON.UPLOAD', 'COMMIT', upload))
+
+    # Invalid JSON ends the upload
+    upload = r.execute_command('JSON.UPLOAD', 'BEGIN', 'bad', '.')
+    r.execute_command('JSON.UPLOAD', 'CHUNK', upload, '{"a": ')
+    r.expect('JSON.UPLOAD', 'CHUNK', upload, '1,,').raiseError()
+    r.expect('JSON.UPLOAD', 'COMMIT', upload).raiseError()
+    upload = r.execute_command('JSON.UPLOAD', 'BEGIN', 'bad', '.')
+    r.execute_command('JSON.UPLOAD', 'CHUNK', upload, '{"a": 1')
+    r.expect('JSON.UPLOAD', 'COMMIT', upload).raiseError()
+
+    upload = r.execute_command('JSON.UPLOAD', 'BEGIN', 'bad', '.')
+    r.execute_command('JSON.UPLOAD', 'CHUNK', upload, '{}')
+    r.assertOk(r.execute_command('JSON.UPLOAD', 'ABORT', upload))
+    r.expect('JSON.UPLOAD', 'CHUNK', upload, '{}').raiseError()
+    r.assertEqual(r.execute_command('EXISTS', 'bad'), 0)
+    r.expect('JSON.UPLOAD', 'BEGIN', 'bad', '.', 'FOO').raiseError()
+
+    # Chunks can split multibyte characters
+    upload = r.execute_command('JSON.UPLOAD', 'BEGIN', 'utf8', '.')
+    r.assertEqual(r.execute_command('JSON.UPLOAD', 'CHUNK', upload, b'["caf\xc3'), 6)
+    r.assertEqual(r.execute_command('JSON.UPLOAD', 'CHUNK', upload, b'\xa9"]'), 9)
+    r.assertOk(r.execute_command('JSON.UPLOAD', 'COMMIT', upload))
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'utf8')), [u'caf\xe9'])
+    r.expect('JSON.UPLOAD', 'FOO').raiseError()
+
+def testOffload(env):
+    """Test that large payloads parsed and serialized by the worker pool behave the same"""
+    r = env
+
+    default = r.execute_command('JSON.DEBUG', 'OFFLOAD')
+    r.assertGreater(default, 0)
+    r.assertEqual(r.execute_command('JSON.DEBUG', 'OFFLOAD', 1000), 1000)
+
+    doc = {'items': [{'id': i, 'name': 'item {}'.format(i)} for i in range(1000)]}
+    r.assertOk(r.execute_command('JSON.SET', 'big', '.', json.dumps(doc)))
+    r.assertOk(r.execute_command('JSON.SET', 'small', '.', '{"a":1}'))
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'big')), doc)
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'big', 'INDENT', '  ', '.items')), doc['items'])
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'big', '.items[0]')), doc['items'][0])
+    r.assertEqual(r.execute_command('JSON.GET', 'big', 'IFREV', 1), 'NOTMODIFIED')
+
+    doc['items'].append({'id': -1})
+    r.assertIsNone(r.execute_command('JSON.SET', 'big', '.', json.dumps(doc), 'NX'))
+    r.expect('JSON.SET', 'big', '.', json.dumps(doc) + ']').raiseError()
+    r.expect('JSON.SET', 'big', '.', json.dumps(doc), 'REV', 7).raiseError()
+    r.assertOk(r.execute_command('JSON.SET', 'big', '.', json.dumps(doc), 'REV', 1))
+    rev, res = r.execute_command('JSON.GET', 'big', 'IFREV', 1)
+    r.assertEqual(rev, 2)
+    r.assertEqual(json.loads(res), doc)
+    r.assertEqual(r.execute_command('JSON.GET', 'small', '.a'), '1')
+
+    # Offloaded commands are not blocked within transactions
+    r.assertOk(r.execute_command('MULTI'))
+    r.assertEqual(r.execute_command('JSON.SET', 'big', '.items[0]', json.dumps(doc)), 'QUEUED')
+    r.assertEqual(r.execute_command('JSON.GET', 'big', '.items[0].items[1000]'), 'QUEUED')
+    r.assertEqual(r.execute_command('EXEC'), ['OK', '{"id":-1}'])
+
+    for _ in r.retry_with_rdb_reload():
+        r.assertEqual(json.loads(r.execute_command('JSON.GET', 'big', '.items[1000]')), {'id': -1})
+
+    r.assertEqual(r.execute_command('JSON.DEBUG', 'OFFLOAD', 0), 0)
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'big', '.items[1000]')), {'id': -1})
+    r.assertEqual(r.execute_command('JSON.DEBUG', 'OFFLOAD', default), default)
+    r.expect('JSON.DEBUG', 'OFFLOAD', -1).raiseError()
+
+def testFirstMatchPaths(env):
+    """Test that single-value commands report the first match of wildcard paths"""
+    r = env
+
+    r.assertOk(r.execute_command('JSON.SET', 'doc', '.', json.dumps({
+        'a': {'b': [{'c': 'x'}, {'c': 'yy', 'd': {'c': [1, 2, 3]}}], 'c': {'k': 1}},
+        'e': [[1, 2], [3, [4, 5]]],
+    })))
+    r.assertEqual(r.execute_command('JSON.TYPE', 'doc', '$..c'), 'object')
+    r.assertEqual(r.execute_command('JSON.STRLEN', 'doc', '$.a.b[*].c'), 1)
+    r.assertEqual(r.execute_command('JSON.ARRLEN', 'doc', '$..d.c'), 3)
+    r.assertEqual(r.execute_command('JSON.OBJKEYS', 'doc', '$.*.c'), ['k'])
+    r.assertEqual(r.execute_command('JSON.GET', 'doc', '$.e[*][-1]'), '2')
+    r.assertEqual(r.execute_command('JSON.GET', 'doc', '$.a.b[?(@.d)].c'), '"yy"')
+    r.assertIsNone(r.execute_command('JSON.TYPE', 'doc', '$..missing'))
+    r.expect('JSON.GET', 'doc', '$..missing').raiseError()
+
+def testDebugTrace(env):
+    """Test tracing the phases of commands"""
+    r = env
+
+    r.assertOk(r.execute_command('JSON.SET', 'doc', '.', json.dumps({'a': [{'b': 1}, {'b': 2}]})))
+    r.assertEqual(r.execute_command('JSON.DEBUG', 'TRACE', 'GET'), [])
+    r.assertOk(r.execute_command('JSON.DEBUG', 'TRACE', 'ON', 'SIZE', 2))
+    r.assertEqual(r.execute_command('JSON.TYPE', 'doc', '$..b'), 'integer')
+    r.assertOk(r.execute_command('JSON.SET', 'doc', '.c', '"x"'))
+    r.assertEqual(r.execute_command('JSON.GET', 'doc', '.a[1]'), '{"b":2}')
+
+    calls = [dict(zip(call[::2], call[1::2])) for call in r.execute_command('JSON.DEBUG', 'TRACE', 'GET')]
+    r.assertEqual([(c['command'], c['key'], c['path']) for c in calls],
+                  [('JSON.GET', 'doc', '.a[1]'), ('JSON.SET', 'doc', '$.c')])
+    get_phases = dict(zip(calls[0]['phases'][::2], calls[0]['phases'][1::2]))
+    r.assertTrue(set(get_phases) >= {'path', 'select', 'serialize'})
+    set_phases = dict(zip(calls[1]['phases'][::2], calls[1]['phases'][1::2]))
+    r.assertTrue(set(set_phases) >= {'parse', 'mutate', 'replicate'})
+    r.assertTrue(calls[0]['total_ns'] >= max(get_phases.values()))
+
+    # Only slow calls are kept, and nothing is kept when off
+    r.assertOk(r.execute_command('JSON.DEBUG', 'TRACE', 'RESET'))
+    r.assertOk(r.execute_command('JSON.DEBUG', 'TRACE', 'ON', 'SLOWER-THAN', 10000000))
+    r.execute_command('JSON.GET', 'doc')
+    r.assertEqual(r.execute_command('JSON.DEBUG', 'TRACE', 'GET'), [])
+    r.assertOk(r.execute_command('JSON.DEBUG', 'TRACE', 'OFF'))
+    r.assertOk(r.execute_command('JSON.DEBUG', 'TRACE', 'ON'))
+    r.assertOk(r.execute_command('JSON.DEBUG', 'TRACE', 'OFF'))
+    r.execute_command('JSON.GET', 'doc')
+    r.assertEqual(r.execute_command('JSON.DEBUG', 'TRACE', 'GET'), [])
+    r.expect('JSON.DEBUG', 'TRACE', 'ON', 'SIZE', -1).raiseError()
+    r.expect('JSON.DEBUG', 'TRACE', 'MAYBE').raiseError()
+
+def testDefrag(env):
+    """Test moving documents to fresh allocations"""
+    r = env
+
+    doc = {'a': [{'b': 'x' * 100, 'c': list(range(100))}, 'y'], 'd': {'e': None}}
+    r.assertOk(r.execute_command('JSON.SET', 'doc', '.', json.dumps(doc)))
+    # Arrays, strings and object keys, not numbers or nulls
+    r.assertEqual(r.execute_command('JSON.DEBUG', 'DEFRAG', 'doc'), 9)
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'doc')), doc)
+    r.assertEqual(r.execute_command('JSON.DEBUG', 'DEFRAG', 'missing'), 0)
+
+    # Documents aren't signaled as modified
+    r.assertOk(r.execute_command('WATCH', 'doc'))
+    r.assertEqual(r.execute_command('JSON.DEBUG', 'DEFRAG', 'doc'), 9)
+    r.assertOk(r.execute_command('MULTI'))
+    r.assertEqual(r.execute_command('JSON.GET', 'doc', '.d'), 'QUEUED')
+    r.assertEqual(r.execute_command('EXEC'), ['{"e":null}'])
+
+    # Deleting array elements releases their capacity
+    for i in range(90):
+        r.assertEqual(r.execute_command('JSON.DEL', 'doc', '.a[0].c[0]'), 1)
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'doc', '.a[0].c')), list(range(90, 100)))
+
+    # So does popping and trimming them
+    r.assertOk(r.execute_command('JSON.SET', 'doc', '.a[0].c', json.dumps(list(range(100)))))
+    for i in range(90):
+        r.assertEqual(r.execute_command('JSON.ARRPOP', 'doc', '.a[0].c'), str(99 - i))
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'doc', '.a[0].c')), list(range(10)))
+    r.assertOk(r.execute_command('JSON.SET', 'big', '.', json.dumps(list(range(100000)))))
+    used = r.execute_command('INFO', 'memory')['used_memory']
+    r.assertEqual(r.execute_command('JSON.ARRTRIM', 'big', '.', 0, 9), 10)
+    # The array's 100000 slots took over 3MB
+    r.assertLess(r.execute_command('INFO', 'memory')['used_memory'], used - 2000000)
+
+def testSchemaValidation(env):
+    """Test validating documents against a JSON Schema"""
+    r = env
+
+    schema = {
+        'type': 'object',
+        'required': ['name', 'tags'],
+        'properties': {
+            'name': {'type': 'string', 'minLength': 1},
+            'age': {'type': 'integer', 'minimum': 0},
+            'tags': {'type': 'array', 'items': {'$ref': '#/definitions/tag'}, 'maxItems': 3},
+            'kind': {'anyOf': [{'const': 'a'}, {'const': 'b'}]},
+        },
+        'additionalProperties': False,
+        'definitions': {'tag': {'type': 'string', 'pattern': '^[a-z]+$'}},
+    }
+    r.assertOk(r.execute_command('JSON.SETSCHEMA', 'person', json.dumps(schema)))
+    r.expect('JSON.SETSCHEMA', 'bad', '{"type": "nope"}').raiseError()
+    r.expect('JSON.SETSCHEMA', 'bad', '{"$ref": "#/missing"}').raiseError()
+
+    r.assertOk(r.execute_command('JSON.VALIDATE', 'person', '{"name": "x", "tags": []}'))
+    r.expect('JSON.VALIDATE', 'person', '{"name": "x"}').raiseError()
+    r.expect('JSON.VALIDATE', 'missing', '{}').raiseError()
+
+    r.expect('JSON.SET', 'doc', '.', '{"name": ""}', 'SCHEMA', 'person').raiseError()
+    r.assertIsNone(r.execute_command('JSON.GET', 'doc'))
+    r.expect('JSON.SET', 'doc', '.', '{}', 'SCHEMA', 'missing').raiseError()
+    r.assertOk(r.execute_command('JSON.SET', 'doc', '.', '{"name": "x", "tags": ["a"]}', 'SCHEMA', 'person'))
+
+    # Writes checked locally
+    r.assertOk(r.execute_command('JSON.SET', 'doc', '.age', '3'))
+    r.expect('JSON.SET', 'doc', '.age', '3.5').raiseError()
+    r.expect('JSON.SET', 'doc', '.other', '1').raiseError()
+    r.expect('JSON.NUMINCRBY', 'doc', '.age', '-4').raiseError()
+    r.expect('JSON.ARRAPPEND', 'doc', '.tags', '"B"').raiseError()
+    r.expect('JSON.ARRAPPEND', 'doc', '.tags', '"b"', '"c"', '"d"').raiseError()
+    r.assertEqual(r.execute_command('JSON.ARRAPPEND', 'doc', '.tags', '"b"'), 2)
+    r.expect('JSON.DEL', 'doc', '.name').raiseError()
+    r.assertEqual(r.execute_command('JSON.DEL', 'doc', '.age'), 1)
+
+    # Writes that validate the whole document
+    r.assertOk(r.execute_command('JSON.SET', 'doc', '.kind', '"a"'))
+    r.expect('JSON.SET', 'doc', '.kind', '"c"').raiseError()
+    r.expect('JSON.SET', 'doc', '..name', '""').raiseError()
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'doc')),
+                  {'name': 'x', 'tags': ['a', 'b'], 'kind': 'a'})
+
+    # Values constrained as a whole are checked however deep a write goes into them
+    whole = {
+        'properties': {
+            'items': {'type': 'array', 'uniqueItems': True},
+            'origin': {'const': {'x': 0, 'y': 0}},
+            'pair': {'enum': [[[1], [2]], [[3], [4]]]},
+        },
+    }
+    r.assertOk(r.execute_command('JSON.SETSCHEMA', 'whole', json.dumps(whole)))
+    value = {'items': [{'a': 1}, {'a': 2}], 'origin': {'x': 0, 'y': 0}, 'pair': [[1], [2]]}
+    r.assertOk(r.execute_command('JSON.SET', 'w', '.', json.dumps(value), 'SCHEMA', 'whole'))
+    r.expect('JSON.SET', 'w', '.items[1].a', '1').raiseError()
+    r.assertOk(r.execute_command('JSON.SET', 'w', '.items[1].a', '3'))
+    r.expect('JSON.SET', 'w', '.origin.x', '1').raiseError()
+    r.expect('JSON.NUMINCRBY', 'w', '.origin.y', '1').raiseError()
+    r.expect('JSON.SET', 'w', '.pair[0][0]', '3').raiseError()
+    r.expect('JSON.ARRAPPEND', 'w', '.pair[1]', '5').raiseError()
+    value['items'][1]['a'] = 3
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'w')), value)
+
+    # The schema binding survives a reload
+    r.expect('JSON.SET', 'doc', '.', '{"name": "x"}').raiseError()
+    r.assertOk(r.execute_command('DEBUG', 'RELOAD'))
+    r.expect('JSON.SET', 'doc', '.name', '1').raiseError()
+    r.assertOk(r.execute_command('JSON.VALIDATE', 'person', '{"name": "y", "tags": []}'))
+
+def testDigest(env):
+    """Test digests of documents and subtrees"""
+    r = env
+
+    doc = {'a': [{'b': i, 'c': [i, str(i)]} for i in range(50)], 'd': {'e': 'x', 'f': [1, 2]}}
+    r.assertOk(r.execute_command('JSON.SET', 'doc', '.', json.dumps(doc)))
+    r.assertOk(r.execute_command('JSON.SET', 'copy', '.', json.dumps(doc)))
+    digest = r.execute_command('JSON.DIGEST', 'doc')
+    r.assertEqual(len(digest), 16)
+    r.assertEqual(r.execute_command('JSON.DIGEST', 'copy', '.'), digest)
+    r.assertEqual(r.execute_command('JSON.DIGEST', 'doc', '.a[3]'),
+                  r.execute_command('JSON.DIGEST', 'copy', '$.a[3]'))
+    r.assertNotEqual(r.execute_command('JSON.DIGEST', 'doc', '.a[3]'),
+                     r.execute_command('JSON.DIGEST', 'doc', '.a[4]'))
+    r.assertIsNone(r.execute_command('JSON.DIGEST', 'missing'))
+    r.expect('JSON.DIGEST', 'doc', '.missing').raiseError()
+
+    # Key order doesn't matter
+    r.assertOk(r.execute_command('JSON.SET', 'x', '.', '{"a": 1, "b": [2]}'))
+    r.assertOk(r.execute_command('JSON.SET', 'y', '.', '{"b": [2], "a": 1}'))
+    r.assertEqual(r.execute_command('JSON.DIGEST', 'x'), r.execute_command('JSON.DIGEST', 'y'))
+
+    # Writes change the digests on their path, and only those
+    sibling = r.execute_command('JSON.DIGEST', 'doc', '.d')
+    r.assertOk(r.execute_command('JSON.SET', 'doc', '.a[10].c[0]', '"changed"'))
+    r.assertNotEqual(r.execute_command('JSON.DIGEST', 'doc'), digest)
+    r.assertEqual(r.execute_command('JSON.DIGEST', 'doc', '.d'), sibling)
+    r.assertOk(r.execute_command('JSON.SET', 'doc', '.a[10].c[0]', '10'))
+    r.assertEqual(r.execute_command('JSON.DIGEST', 'doc'), digest)
+
+    for command in [('JSON.ARRAPPEND', 'doc', '.d.f', '3'), ('JSON.NUMINCRBY', 'doc', '.a[0].b', '1'),
+                    ('JSON.DEL', 'doc', '.a[0]'), ('JSON.SET', 'doc', '..e', '"y"')]:
+        r.execute_command(*command)
+        r.execute_command('JSON.SET', 'copy', '.', r.execute_command('JSON.GET', 'doc'))
+        r.assertEqual(r.execute_command('JSON.DIGEST', 'doc'), r.execute_command('JSON.DIGEST', 'copy'))
+
+    r.assertEqual(r.execute_command('DEBUG', 'DIGEST-VALUE', 'doc'),
+                  r.execute_command('DEBUG', 'DIGEST-VALUE', 'copy'))
+    r.assertNotEqual(r.execute_command('DEBUG', 'DIGEST-VALUE', 'doc'),
+                     r.execute_command('DEBUG', 'DIGEST-VALUE', 'x'))
+
+def testLoad(env):
+    """Test bulk loading NDJSON files"""
+    r = env
+
+    def wait(load_id):
+        for _ in range(100):
+            status = r.execute_command('JSON.LOAD', 'STATUS', load_id)
+            status = dict(zip(status[::2], status[1::2]))
+            if status['state'] != 'running':
+                return status
+            time.sleep(0.1)
+        r.assertTrue(False)
+
+    lines = [json.dumps({'id': i, 'name': 'item {}'.format(i), 'tags': ['a'] * (i % 3)}) for i in range(5000)]
+    lines[10] = '{"id": 10, bad'
+    lines[20] = '{"name": "no id"}'
+    lines.insert(30, '')
+    with tempfile.NamedTemporaryFile('w', suffix='.ndjson', delete=False) as f:
+        f.write('\r\n'.join(lines))
+    try:
+        load_id = r.execute_command('JSON.LOAD', f.name, 'KEYFIELD', '.id', 'PREFIX', 'item:', 'BATCH', '100')
+        status = wait(load_id)
+        r.assertEqual(status['state'], 'done')
+        r.assertEqual(status['loaded'], 4998)
+        r.assertEqual(status['errors'], 2)
+        r.assertEqual(status['bytes'], status['total_bytes'])
+        r.assertEqual(json.loads(r.execute_command('JSON.GET', 'item:42')),
+                      {'id': 42, 'name': 'item 42', 'tags': []})
+        r.assertEqual(r.execute_command('JSON.TYPE', 'item:10'), None)
+        r.assertEqual(len(r.execute_command('JSON.LOAD', 'STATUS')), 1)
+    finally:
+        os.unlink(f.name)
+
+    r.expect('JSON.LOAD', '/no/such/file', 'KEYFIELD', '.id').raiseError()
+    r.expect('JSON.LOAD', 'STATUS', '42').raiseError()
+    r.expect('JSON.LOAD', f.name, 'KEYFIELD', '.id', 'BATCH', '0').raiseError()
+
+def testDelMultiplePaths(env):
+    """Test deleting several paths in one call"""
+    r = env
+
+    doc = {'a': [0, 1, 2, 3, 4], 'b': {'c': 1, 'd': {'c': 2}}, 'e': 'x', 'f': [{'g': 1}, {'g': 2}]}
+    r.assertOk(r.execute_command('JSON.SET', 'doc', '.', json.dumps(doc)))
+
+    # Indexes refer to the array before the call
+    r.assertEqual(r.execute_command('JSON.DEL', 'doc', '.a[0]', '.a[1]', '$.a[-1]'), 3)
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'doc', '.a')), [2, 3])
+
+    # Values inside other deleted values, and paths given twice, count once
+    r.assertEqual(r.execute_command('JSON.DEL', 'doc', '$..c', '.b.d', '.e', '.e', '.missing'), 3)
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'doc')), {'a': [2, 3], 'b': {}, 'f': [{'g': 1}, {'g': 2}]})
+
+    # Along with a path that's evaluated on its own
+    r.assertEqual(r.execute_command('JSON.DEL', 'doc', '.a[0]', '$.f[?(@.g==2)]'), 2)
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'doc')), {'a': [3], 'b': {}, 'f': [{'g': 1}]})
+
+    r.assertEqual(r.execute_command('JSON.DEL', 'doc', '.b', '.'), 1)
+    r.assertIsNone(r.execute_command('JSON.GET', 'doc'))
+
+def testScan(env):
+    """Test JSON.SCAN"""
+    r = env
+
+    for i in range(20):
+        doc = {'id': i, 'name': 'user {}'.format(i), 'orders': [{'total': i * 10}]}
+        r.assertOk(r.execute_command('JSON.SET', 'user:{}'.format(i), '.', json.dumps(doc)))
+    r.execute_command('SET', 'user:string', 'not json')
+    r.assertOk(r.execute_command('JSON.SET', 'other', '.', '{"id": 100}'))
+
+    def scan(*args):
+        """All the keys and values of an iteration"""
+        res = {}
+        cursor = '0'
+        while True:
+            cursor, items = r.execute_command('JSON.SCAN', cursor, *args)
+            for key, values in zip(items[::2], items[1::2]):
+                res[key] = [None if v is None else json.loads(v) for v in values]
+            if cursor == '0':
+                return res
+
+    res = scan('MATCH', 'user:*', 'COUNT', 5, 'PROJECT', '.id', '.name', '.missing')
+    r.assertEqual(len(res), 20)
+    r.assertEqual(res['user:3'], [3, 'user 3', None])
+
+    res = scan('FILTER', '$.orders[?(@.total > 150)]', 'PROJECT', 'id')
+    r.assertEqual(sorted(res), ['user:16', 'user:17', 'user:18', 'user:19'])
+    r.assertEqual(res['user:17'], [17])
+
+    r.expect('JSON.SCAN', '0', 'MATCH', '*').raiseError()
+    r.expect('JSON.SCAN', 'x', 'PROJECT', '.').raiseError()
+    r.expect('JSON.SCAN', '0', 'BOGUS', 'PROJECT', '.').raiseError()
+
+def testCopy(env):
+    """Test JSON.COPY"""
+    r = env
+
+    doc = {'a': {'b': [1, 2, 3]}, 'c': 'x'}
+    r.assertOk(r.execute_command('JSON.SET', 'src', '.', json.dumps(doc)))
+    size = r.execute_command('JSON.DEBUG', 'MEMORY', 'src', '.')
+    r.assertEqual(r.execute_command('JSON.COPY', 'src', 'dst'), 1)
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'dst')), doc)
+
+    # The keys share the document, and split its size
+    r.assertEqual(r.execute_command('JSON.DEBUG', 'MEMORY', 'src', '.'), size // 2)
+    r.assertEqual(r.execute_command('JSON.DEBUG', 'MEMORY', 'dst', '.'), size // 2)
+
+    # Writes to either key aren't seen by the other
+    r.assertEqual(r.execute_command('JSON.NUMINCRBY', 'dst', '.a.b[0]', 10), '11')
+    r.assertEqual(r.execute_command('JSON.DEBUG', 'MEMORY', 'src', '.'), size)
+    r.assertEqual(r.execute_command('JSON.DEBUG', 'MEMORY', 'dst', '.'), size)
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'src', '.a.b')), [1, 2, 3])
+    r.assertOk(r.execute_command('JSON.SET', 'src', '.c', '"y"'))
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'dst')), {'a': {'b': [11, 2, 3]}, 'c': 'x'})
+
+    # A path is copied to the root of the new key
+    r.assertEqual(r.execute_command('JSON.COPY', 'src', 'sub', '.a'), 1)
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'sub')), {'b': [1, 2, 3]})
+    # and shares nothing with the source
+    r.assertEqual(r.execute_command('JSON.DEBUG', 'MEMORY', 'src', '.'), size)
+    r.assertEqual(r.execute_command('JSON.DEBUG', 'MEMORY', 'sub', '.'), size)
+    r.assertEqual(r.execute_command('JSON.ARRAPPEND', 'sub', '.b', 4), 4)
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'src', '.a.b')), [1, 2, 3])
+
+    # Copies survive reloading
+    r.assertEqual(r.execute_command('JSON.COPY', 'src', 'shared'), 1)
+    r.assertEqual(r.execute_command('JSON.DEBUG', 'MEMORY', 'shared', '.'), size // 2)
+    r.assertOk(r.execute_command('DEBUG', 'RELOAD'))
+    r.assertEqual(json.loads(r.execute_command('JSON.GET', 'shared')), {'a': {'b': [1, 2, 3]}, 'c': 'y'})
+    # as documents of their own
+    r.assertEqual(r.execute_command('JSON.DEBUG', 'MEMORY', 'shared', '.'), size)
+
+    # Existing destinations and missing sources aren't copied
+    r.assertEqual(r.execute_command('JSON.COPY', 'src', 'dst'), 0)
+    r.assertEqual(r.execute_command('JSON.COPY', 'missing', 'new'), 0)
+    r.assertEqual(r.execute_command('EXISTS', 'new'), 0)
+    r.expect('JSON.COPY', 'src', 'other', '.missing').raiseError()
+    r.expect('JSON.COPY', 'src').raiseError()
+
 def testIssue_13(env):
     """https://github.com/RedisJSON/RedisJSON/issues/13"""
     r = env
@@ -755,6 +1359,78 @@ def testRediSearch(env):
             json.loads(r.execute_command('JSON.QGET', index, query, path)),
             json.loads(results))
 
+def testSecondaryIndex(env):
+    """Test the built-in secondary index"""
+    r = env
+
+    r.assertOk(r.execute_command('JSON.SINDEX', 'ADD', 'person', '$.age'))
+    r.assertOk(r.execute_command('JSON.SINDEX', 'ADD', 'person', '$.last'))
+    r.expect('JSON.SINDEX', 'ADD', 'person', '$.age').raiseError()
+
+    r.assertOk(r.execute_command('JSON.SET', 'joe', '.', '{"first": "Joe", "last": "Smith", "age": 30}', 'INDEX', 'person'))
+    r.assertOk(r.execute_command('JSON.SET', 'kevin', '.', '{"first": "Kevin", "last": "Smith", "age": 40}', 'INDEX', 'person'))
+    r.assertOk(r.execute_command('JSON.SET', 'mike', '.', '{"first": "Mike", "last": "Lane", "age": 25}', 'INDEX', 'person'))
+    r.assertOk(r.execute_command('JSON.SET', 'dave', '.', '{"first": "Dave", "age": 30}'))
+
+    def query(*args):
+        return json.loads(r.execute_command('JSON.SQUERY', 'person', *args))
+
+    r.assertEqual(query('$.last', 'EQ', '"Smith"', '$.first'), {'joe': ['Joe'], 'kevin': ['Kevin']})
+    r.assertEqual(query('$.age', 'EQ', '30', '$.first'), {'joe': ['Joe']})
+    r.assertEqual(query('$.age', 'RANGE', '25', '(40', '$.first'), {'joe': ['Joe'], 'mike': ['Mike']})
+    r.assertEqual(query('$.age', 'RANGE', '(25', '+', '$.first'), {'joe': ['Joe'], 'kevin': ['Kevin']})
+    r.assertEqual(query('$.last', 'RANGE', '-', '"M"', '$.first'), {'mike': ['Mike']})
+    r.expect('JSON.SQUERY', 'person', '$.first', 'EQ', '"Joe"').raiseError()
+    r.expect('JSON.SQUERY', 'person', '$.age', 'RANGE', 'true', '+').raiseError()
+
+    # Every write keeps the index up to date
+    r.assertEqual(r.execute_command('JSON.NUMINCRBY', 'mike', '.age', 10), '35')
+    r.assertEqual(query('$.age', 'RANGE', '35', '35', '$.first'), {'mike': ['Mike']})
+    r.assertEqual(r.execute_command('JSON.DEL', 'joe', '.age'), 1)
+    r.assertEqual(query('$.age', 'EQ', '30'), {})
+    r.assertEqual(r.execute_command('DEL', 'kevin'), 1)
+    r.assertEqual(query('$.last', 'EQ', '"Smith"', '$.first'), {'joe': ['Joe']})
+
+    for _ in r.retry_with_rdb_reload():
+        r.assertEqual(query('$.last', 'RANGE', '-', '+', '$.first'), {'joe': ['Joe'], 'mike': ['Mike']})
+
+    r.assertOk(r.execute_command('JSON.SINDEX', 'DEL', 'person'))
+    r.expect('JSON.SQUERY', 'person', '$.age', 'EQ', '30').raiseError()
+
+def testSecondaryIndexDatabases(env):
+    """Test that the built-in secondary index keeps the keys of every database apart"""
+    env.skipOnCluster()
+    r = env.getConnection()
+
+    def query(*args):
+        return json.loads(r.execute_command('JSON.SQUERY', 'byage', '$.age', *args))
+
+    # Indexed before the path is added, so by the background scan
+    r.execute_command('SELECT', 1)
+    env.assertTrue(r.execute_command('JSON.SET', 'p', '.', '{"age": 1}', 'INDEX', 'byage'))
+    r.execute_command('SELECT', 0)
+    env.assertTrue(r.execute_command('JSON.SET', 'p', '.', '{"age": 0}', 'INDEX', 'byage'))
+    env.assertTrue(r.execute_command('JSON.SINDEX', 'ADD', 'byage', '$.age'))
+
+    r.execute_command('SELECT', 1)
+    for _ in range(100):
+        if query('EQ', '1'):
+            break
+        time.sleep(0.01)
+    env.assertEqual(query('RANGE', '-', '+'), {'p': [{'age': 1}]})
+
+    # Writes and deletes only touch the key of their database
+    env.assertEqual(r.execute_command('JSON.NUMINCRBY', 'p', '.age', 1), '2')
+    r.execute_command('SELECT', 0)
+    env.assertEqual(query('RANGE', '-', '+'), {'p': [{'age': 0}]})
+    env.assertEqual(r.execute_command('DEL', 'p'), 1)
+    env.assertEqual(query('RANGE', '-', '+'), {})
+    r.execute_command('SELECT', 1)
+    env.assertEqual(query('EQ', '2'), {'p': [{'age': 2}]})
+    env.assertEqual(r.execute_command('DEL', 'p'), 1)
+    r.execute_command('SELECT', 0)
+    env.assertTrue(r.execute_command('JSON.SINDEX', 'DEL', 'byage'))
+
 def testDoubleParse(env):
     r = env
     r.cmd('JSON.SET', 'dblNum', '.', '[1512060373.222988]')
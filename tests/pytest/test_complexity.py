@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import json
+import math
+import os
+from RLTest import Env
+from includes import *
+
+#----------------------------------------------------------------------------------------------
+
+# Algorithmic complexity tests: the server time per call of commands on documents of growing
+# size is fitted to a power of the size, and commands that only touch a small part of the
+# document must not get slower as it grows.
+
+SIZES = [1 << 10, 10 << 10, 100 << 10, 1 << 20, 10 << 20]
+
+# Highest exponent of the document's size tolerated for commands that don't depend on it
+MAX_FLAT_EXPONENT = 0.2
+
+# Lowest exponent expected from commands that are linear in the document's size
+MIN_LINEAR_EXPONENT = 0.8
+
+def make_doc(size):
+    """A document whose serialization is roughly `size` bytes"""
+    item = {'id': 0, 'name': 'x' * 16, 'tags': ['a', 'b'], 'score': 1.5}
+    count = max(1, size // len(json.dumps(item)))
+    return {
+        'meta': {'count': 0},
+        'items': [dict(item, id=i) for i in range(count)],
+    }
+
+def exponent(sizes, times):
+    """The least squares fit of `k` in time = c * size ** k"""
+    xs = [math.log(size) for size in sizes]
+    ys = [math.log(max(t, 1e-3)) for t in times]
+    mx = sum(xs) / len(xs)
+    my = sum(ys) / len(ys)
+    return sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sum((x - mx) ** 2 for x in xs)
+
+def usec_per_call(env, command):
+    stats = env.cmd('INFO', 'commandstats')
+    return float(stats['cmdstat_' + command.lower()]['usec_per_call'])
+
+def measure(env, commands, calls):
+    """The server time per call of each of `commands` (a function of a document's size), by size"""
+    r = env.getConnection()
+    times = {}
+    for size in SIZES:
+        doc = make_doc(size)
+        env.assertOk(r.execute_command('JSON.SET', 'doc', '.', json.dumps(doc)))
+        env.cmd('CONFIG', 'RESETSTAT')
+        p = r.pipeline(transaction=False)
+        for _ in range(calls):
+            for command in commands(doc):
+                p.execute_command(*command)
+        p.execute()
+        for command in commands(doc):
+            times.setdefault(command[0], []).append(usec_per_call(env, command[0]))
+    r.delete('doc')
+    return times
+
+def skipUnlessTimed(env):
+    env.skipOnCluster()
+    if os.getenv('VALGRIND') == '1' or os.getenv('VD') == '1':
+        env.skip()
+
+def testWritesDontDependOnDocumentSize(env):
+    """Test that writes to a small part of a document take the same time whatever its size"""
+    skipUnlessTimed(env)
+
+    def commands(doc):
+        middle = len(doc['items']) // 2
+        # The array grows by one item per round, and is as large as the document
+        return [
+            ('JSON.NUMINCRBY', 'doc', '.meta.count', 1),
+            ('JSON.SET', 'doc', '.items[{}].name'.format(middle), '"y"'),
+            ('JSON.ARRAPPEND', 'doc', '.items', 0),
+            ('JSON.ARRINSERT', 'doc', '.items', -1, 0),
+            ('JSON.ARRPOP', 'doc', '.items'),
+        ]
+
+    times = measure(env, commands, 2000)
+    for command, command_times in times.items():
+        k = exponent(SIZES, command_times)
+        env.assertLess(k, MAX_FLAT_EXPONENT, message='{} grows as size ** {:.2f}: {}'.format(
+            command, k, command_times))
+
+def testSerializationIsLinear(env):
+    """Test that the measurements see commands that depend on the document's size"""
+    skipUnlessTimed(env)
+
+    times = measure(env, lambda doc: [('JSON.GET', 'doc', '.')], 10)
+    k = exponent(SIZES, times['JSON.GET'])
+    env.assertGreater(k, MIN_LINEAR_EXPONENT, message='JSON.GET grows as size ** {:.2f}: {}'.format(
+        k, times['JSON.GET']))
@@ -1,86 +1,273 @@
+#!/usr/bin/env python3
+"""
+Load generator: throughput and latency percentiles of a weighted mix of commands over a key space
+of documents, from asyncio connections spread over one or more worker processes. Latencies are
+recorded in microsecond histograms, and the results can be appended to a CSV file in the format of
+benchmarks/graphs/benchmark.csv.
+"""
+import argparse
+import asyncio
+import csv
+import json
 import multiprocessing
+import os
+import random
+import sys
 import time
+from urllib.parse import urlparse
+
 import redis
-import sys
-import argparse
-from urlparse import urlparse
-import os
-from collections import defaultdict
-import math
+import redis.asyncio
+
+# The document used when no template file is given, with a number at `.sclr` and an array at `.arr`
+TEMPLATE = {
+    'sclr': 1,
+    'str': 'foo',
+    'arr': [1, 2, 3],
+    'obj': {'a': True, 'b': None, 'c': 'bar', 'd': [{'e': 1.5}]},
+}
+
+# The commands of a mix, by name: their title, in the CSV's format, and a function that builds the
+# command for a key, a random generator (to pick other keys) and the workload's context
+OPS = {
+    'set_root': ('JSON.SET {key} .', lambda key, rng, ctx: ('JSON.SET', key, '.', ctx['doc'])),
+    'get_root': ('JSON.GET {key} .', lambda key, rng, ctx: ('JSON.GET', key, '.')),
+    'get_path': ('JSON.GET {key} {path}', lambda key, rng, ctx: ('JSON.GET', key, ctx['path'])),
+    'set_path': ('JSON.SET {key} {path} {value}',
+                 lambda key, rng, ctx: ('JSON.SET', key, ctx['path'], ctx['value'])),
+    'numincrby': ('JSON.NUMINCRBY {key} {path} 1',
+                  lambda key, rng, ctx: ('JSON.NUMINCRBY', key, ctx['path'], 1)),
+    'arrappend': ('JSON.ARRAPPEND {key} {array_path} 1',
+                  lambda key, rng, ctx: ('JSON.ARRAPPEND', key, ctx['array_path'], 1)),
+    'mget': ('JSON.MGET {key} ... {path}',
+             lambda key, rng, ctx: ('JSON.MGET', key,
+                                    *(random_key(rng, ctx) for _ in range(ctx['mget_keys'] - 1)),
+                                    ctx['path'])),
+}
+
+PERCENTILES = [50, 90, 95, 99, 99.5, 100]
+
+CSV_HEADER = 'title,size,concurrency,rate,avgLatency,' + \
+    ','.join('{:.2f}%-tile'.format(p) for p in PERCENTILES)
+
+
+class Histogram:
+    """
+    Latencies in microseconds, HDR-style: values below 2 * 2**SUB_BITS are counted exactly, and
+    larger ones in buckets that keep their SUB_BITS + 1 most significant bits, so percentiles are
+    within 0.4% of the recorded values whatever their magnitude.
+    """
+    SUB_BITS = 8
+    SUB = 1 << SUB_BITS
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    @classmethod
+    def bucket(cls, value):
+        shift = max(0, value.bit_length() - cls.SUB_BITS - 1)
+        return shift * cls.SUB + (value >> shift)
+
+    @classmethod
+    def value(cls, bucket):
+        """The highest value counted in `bucket`"""
+        shift = max(0, bucket // cls.SUB - 1)
+        return ((bucket - shift * cls.SUB) << shift) + (1 << shift) - 1
+
+    def record(self, value, count=1):
+        value = int(value)
+        bucket = self.bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += count
+        self.sum += value * count
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0
+
+    def percentile(self, p):
+        if not self.count:
+            return 0
+        if p >= 100:
+            return self.max
+        rank = max(1, int(self.count * p / 100.0 + 0.5))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self.value(bucket), self.max)
+        return self.max
 
-def ping(r):
-    r.ping()
 
-def jsonset(r):
-    r.execute_command('JSON.SET', 'j', '.', '{}')
+def parse_mix(mix):
+    """Parses 'name[=weight],...' into a list of (name, weight) pairs"""
+    res = []
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        if name not in OPS:
+            raise argparse.ArgumentTypeError('unknown command {!r}, expected one of {}'.format(
+                name, ', '.join(OPS)))
+        res.append((name, float(weight) if weight else 1.0))
+    return res
 
-def runWorker(ctx):
-    wpid = os.getpid()
-    print '{} '.format(wpid),
+
+def key_name(ctx, n):
+    return '{}:{}'.format(ctx['prefix'], n)
+
+
+def random_key(rng, ctx):
+    return key_name(ctx, rng.randrange(ctx['keys']))
+
+
+async def connection(ctx, count, hists):
+    r = redis.asyncio.Redis(host=ctx['host'], port=ctx['port'])
+    rng = random.Random()
+    names = [name for name, _ in ctx['mix']]
+    weights = [weight for _, weight in ctx['mix']]
+    pipeline = max(1, ctx['pipeline'])
+    try:
+        for _ in range(0, count, pipeline):
+            batch = rng.choices(names, weights, k=pipeline)
+            commands = [OPS[name][1](random_key(rng, ctx), rng, ctx) for name in batch]
+            if ctx['pipeline'] == 0:
+                s0 = time.perf_counter()
+                await r.execute_command(*commands[0])
+            else:
+                p = r.pipeline(transaction=False)
+                for command in commands:
+                    p.execute_command(*command)
+                s0 = time.perf_counter()
+                await p.execute()
+            # Pipelined commands all take the time of the round trip
+            elapsed = (time.perf_counter() - s0) * 1e6
+            for name in batch:
+                hists[name].record(elapsed)
+    finally:
+        await r.close()
+
+
+async def run_connections(ctx):
+    hists = {name: Histogram() for name, _ in ctx['mix']}
+    await asyncio.gather(*(connection(ctx, ctx['count'], hists)
+                           for _ in range(ctx['connections'])))
+    return hists
+
+
+def run_worker(ctx):
+    print('{} '.format(os.getpid()), end='')
     sys.stdout.flush()
+    return asyncio.run(run_connections(ctx))
+
 
-    rep = defaultdict(int)
-    r = redis.StrictRedis(host=ctx['host'], port=ctx['port'])
-    work = ctx['work']
-    if ctx['pipeline'] == 0:
-        for i in range(0, ctx['count']):
-            s0 = time.time()
-            work(r)
-            s1 = time.time() - s0
-            bin = int(math.floor(s1 * 1000)) + 1
-            rep[bin] += 1
-    else:        
-        for i in range(0, ctx['count'], ctx['pipeline']):
-            p = r.pipeline()
-            s0 = time.time()
-            for j in range(0, ctx['pipeline']):
-                work(p)
+def populate(r, ctx):
+    p = r.pipeline(transaction=False)
+    for n in range(ctx['keys']):
+        p.execute_command('JSON.SET', key_name(ctx, n), '.', ctx['doc'])
+        if len(p) >= 1000:
             p.execute()
-            s1 = time.time() - s0
-            bin = int(math.floor(s1 * 1000)) + 1
-            rep[bin] += ctx['pipeline']
+    p.execute()
 
-    return rep
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='ReJSON Benchmark', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser = argparse.ArgumentParser(description='ReJSON Benchmark',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-c', '--count', type=int, default=100000, help='total number of operations')
     parser.add_argument('-p', '--pipeline', type=int, default=0, help='pipeline size')
-    parser.add_argument('-w', '--workers', type=int, default=8, help='number of worker processes')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('-n', '--connections', type=int, default=16, help='connections per worker')
+    parser.add_argument('-m', '--mix', type=parse_mix, default='set_root,get_root,get_path,set_path',
+                        help='weighted commands, as name[=weight],... with names among ' +
+                        ', '.join(OPS))
+    parser.add_argument('-k', '--keys', type=int, default=1, help='number of keys')
+    parser.add_argument('-t', '--template', type=str, default=None,
+                        help='JSON file of the documents, a built-in document by default')
+    parser.add_argument('--path', type=str, default='sclr',
+                        help='path of the path commands, which must lead to a number for NUMINCRBY')
+    parser.add_argument('--array-path', type=str, default='arr', help='path of the ARRAPPEND array')
+    parser.add_argument('--mget-keys', type=int, default=10, help='keys of each MGET')
+    parser.add_argument('--prefix', type=str, default='benchmark', help='prefix of the key names')
+    parser.add_argument('--csv', type=str, default=None, help='CSV file to append the results to')
     parser.add_argument('-u', '--uri', type=str, default='redis://localhost:6379', help='Redis server URI')
     args = parser.parse_args()
     uri = urlparse(args.uri)
 
-    r = redis.Redis(host=uri.hostname, port=uri.port)
+    if args.template:
+        with open(args.template) as f:
+            template = json.load(f)
+    else:
+        template = TEMPLATE
+    doc = json.dumps(template, separators=(',', ':'))
 
-    pool = multiprocessing.Pool(args.workers)
-    s0 = time.time()
+    r = redis.Redis(host=uri.hostname, port=uri.port, decode_responses=True)
     ctx = {
-        'count': args.count / args.workers,
-        'pipeline': args.pipeline,
         'host': uri.hostname,
         'port': uri.port,
-        'work': jsonset,
+        'pipeline': args.pipeline,
+        'connections': args.connections,
+        'mix': args.mix,
+        'keys': args.keys,
+        'prefix': args.prefix,
+        'doc': doc,
+        'path': args.path,
+        'array_path': args.array_path,
+        'mget_keys': args.mget_keys,
+        'count': args.count // (args.workers * args.connections),
     }
+    populate(r, ctx)
+    ctx['value'] = r.execute_command('JSON.GET', key_name(ctx, 0), args.path)
 
-    print 'Starting workers: ',
+    print('Starting workers: ', end='')
     sys.stdout.flush()
-    results = pool.map(runWorker, (ctx, ) * args.workers)
-    print
-    sys.stdout.flush()
-
+    s0 = time.time()
+    if args.workers == 1:
+        results = [run_worker(ctx)]
+    else:
+        with multiprocessing.Pool(args.workers) as pool:
+            results = pool.map(run_worker, (ctx, ) * args.workers)
     s1 = time.time() - s0
-    agg = defaultdict(int)
+    print()
+
+    hists = {name: Histogram() for name, _ in args.mix}
     for res in results:
-        for k, v in res.iteritems():
-            agg[k] += v
-
-    print
-    print 'Count: {}, Workers: {}, Pipeline: {}'.format(args.count, args.workers, args.pipeline)
-    print 'Using hireds: {}'.format(redis.utils.HIREDIS_AVAILABLE)
-    print 'Runtime: {} seconds'.format(round(s1, 2))
-    print 'Throughput: {} requests per second'.format(round(args.count/s1, 2))
-    for k, v in sorted(agg.items()):
-        perc = 100.0 * v / args.count
-        print '{}% <= {} milliseconds'.format(perc, k)
-    
+        for name, hist in res.items():
+            hists[name].merge(hist)
+    total = sum(hist.count for hist in hists.values())
+    concurrency = args.workers * args.connections
+
+    print()
+    print('Count: {}, Workers: {}, Connections: {}, Pipeline: {}, Keys: {}, Size: {} bytes'.format(
+        total, args.workers, concurrency, args.pipeline, args.keys, len(doc)))
+    print('Using hiredis: {}'.format(redis.utils.HIREDIS_AVAILABLE))
+    print('Runtime: {} seconds'.format(round(s1, 2)))
+    print('Throughput: {} requests per second'.format(round(total / s1, 2)))
+
+    rows = []
+    for name, hist in hists.items():
+        title = OPS[name][0].format(key='{key}', path=args.path, array_path=args.array_path,
+                                    value=ctx['value'])
+        rows.append([title, len(doc), concurrency, hist.count / s1, hist.mean() / 1000] +
+                    [hist.percentile(p) / 1000 for p in PERCENTILES])
+        print()
+        print('{}: {} requests, {} requests per second'.format(title, hist.count,
+                                                               round(hist.count / s1, 2)))
+        for p in PERCENTILES:
+            print('{:.2f}% <= {:.3f} milliseconds'.format(p, hist.percentile(p) / 1000))
+
+    if args.csv:
+        header = not os.path.exists(args.csv) or os.path.getsize(args.csv) == 0
+        with open(args.csv, 'a', newline='') as f:
+            if header:
+                f.write(CSV_HEADER + '\n')
+            writer = csv.writer(f, lineterminator='\n')
+            for row in rows:
+                writer.writerow(row[:3] + ['{:.2f}'.format(v) for v in row[3:]])
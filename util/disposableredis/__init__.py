@@ -1,11 +1,25 @@
+"""
+Redis servers for the duration of a run, e.g.:
+
+    with DisposableRedis(loadmodule='rejson.so', unix=True, rdb='tests/files/backward.rdb') as r:
+        r.execute_command('JSON.GET', 'complex')
+
+    with DisposableRedisPool(4, loadmodule='rejson.so') as clients:
+        ...
+"""
 import subprocess
 import socket
 import tempfile
+import shutil
 import redis
 import time
 import os
 import itertools
 
+# The line a server logs once it accepts connections, which comes after it has loaded its RDB
+READY = 'eady to accept connections'
+
+
 def get_random_port():
     sock = socket.socket()
     sock.listen(0)
@@ -16,10 +30,13 @@ def get_random_port():
 
 
 class DisposableRedis(object):
-    def __init__(self, port=None, path='redis-server', **extra_args):
+    def __init__(self, port=None, path='redis-server', unix=False, rdb=None, timeout=30, **extra_args):
         """
         :param port: port number to start the redis server on. Specify none to automatically generate
         :type port: int|None
+        :param unix: listen on a unix socket instead of a TCP port
+        :param rdb: path of an RDB file the server starts from, e.g. one made by `dump_rdb`
+        :param timeout: seconds to wait for the server to be ready
         :param extra_args: any extra arguments kwargs will be passed to redis server as --key val
         """
 
@@ -28,51 +45,151 @@ class DisposableRedis(object):
         # this will hold the actual port the redis is listening on. It's equal to `_port` unless `_port` is None
         # in that case `port` is randomly generated
         self.port = None
+        self.socket = None
+        self.unix = unix
+        self.rdb = rdb
+        self.timeout = timeout
         self.extra_args = list(itertools.chain(
                 *(('--%s'%k, v) for k, v in extra_args.items())
                ))
         self.path = path
-        
-       
-    def __enter__(self):
-        if self._port is None:
-            self.port = get_random_port()
+        self.process = None
+        self.pool = None
+        self.dir = None
+
+    def start(self):
+        """
+        Starts the server without waiting for it, so that several can start in parallel
+        """
+        self.dir = tempfile.mkdtemp(prefix='disposableredis-')
+        self.logfile = os.path.join(self.dir, 'redis.log')
+        if self.rdb is not None:
+            shutil.copyfile(self.rdb, os.path.join(self.dir, 'dump.rdb'))
+
+        if self.unix:
+            self.port = 0
+            self.socket = os.path.join(self.dir, 'redis.sock')
+            listen = ['--port', '0', '--unixsocket', self.socket]
         else:
-            self.port = self._port
-        args = [self.path,
-             '--port', str(self.port),
-             '--dir', tempfile.gettempdir(),
+            self.port = get_random_port() if self._port is None else self._port
+            listen = ['--port', str(self.port)]
+        args = [self.path] + listen + [
+             '--dir', self.dir,
+             '--dbfilename', 'dump.rdb',
+             '--logfile', self.logfile,
              '--save', ''] + self.extra_args
-       
+
         self.process = subprocess.Popen(
             args,
-             #cwd=os.getcwd(),
             stdin=subprocess.PIPE,
-            stdout=open(os.devnull, 'w')
+            stdout=subprocess.DEVNULL
         )
-       
-       
-        while True:
-            try:
-                self.client().ping()
 
+    def wait(self):
+        """
+        Waits until the server logs that it's ready. A server that exits before is started again on
+        another port if it couldn't bind to a random one.
+        """
+        deadline = time.time() + self.timeout
+        while True:
+            log = self.log()
+            if READY in log:
                 break
-            except redis.ConnectionError:
-                self.process.poll()
-                if self.process.returncode is not None:
-                    raise RuntimeError("Process has exited")
-                time.sleep(0.1)
-        
+            if self.process.poll() is not None:
+                if 'Address already in use' in log and self._port is None and not self.unix:
+                    self.cleanup()
+                    self.start()
+                    continue
+                raise RuntimeError("Process has exited:\n" + log[-2000:])
+            if time.time() > deadline:
+                self.stop()
+                raise RuntimeError("Server not ready after {} seconds".format(self.timeout))
+            time.sleep(0.01)
+
+    def log(self):
+        try:
+            with open(self.logfile) as f:
+                return f.read()
+        except IOError:
+            return ''
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+        if self.pool is not None:
+            self.pool.disconnect()
+            self.pool = None
+        self.cleanup()
+
+    def cleanup(self):
+        if self.dir is not None:
+            shutil.rmtree(self.dir, ignore_errors=True)
+            self.dir = None
+
+    def __enter__(self):
+        self.start()
+        self.wait()
         return self.client()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.process.terminate()
+        self.stop()
 
     def client(self):
         """
+        A client of the server, whose connections are pooled with those of the other clients
+
         :rtype: redis.StrictRedis
         """
 
-        return redis.StrictRedis(port=self.port)
+        if self.pool is None:
+            if self.unix:
+                self.pool = redis.ConnectionPool(connection_class=redis.UnixDomainSocketConnection,
+                                                 path=self.socket)
+            else:
+                self.pool = redis.ConnectionPool(port=self.port)
+        return redis.StrictRedis(connection_pool=self.pool)
+
+
+class DisposableRedisPool(object):
+    def __init__(self, count, **kwargs):
+        """
+        :param count: number of servers, which are started in parallel
+        :param kwargs: arguments of every `DisposableRedis`
+        """
+
+        self.servers = [DisposableRedis(**kwargs) for _ in range(count)]
+
+    def __enter__(self):
+        try:
+            for server in self.servers:
+                server.start()
+            for server in self.servers:
+                server.wait()
+        except:
+            self.stop()
+            raise
+        return [server.client() for server in self.servers]
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def stop(self):
+        for server in self.servers:
+            server.stop()
+
+
+def dump_rdb(populate, rdb, **kwargs):
+    """
+    Saves the dataset `populate` creates to the RDB file `rdb`, for servers to start from
 
+    :param populate: function that's called with a client of a new server
+    :param kwargs: arguments of the `DisposableRedis` that populates the dataset
+    """
 
+    server = DisposableRedis(**kwargs)
+    with server as r:
+        populate(r)
+        r.save()
+        shutil.copyfile(os.path.join(server.dir, 'dump.rdb'), rdb)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Ingest benchmark: JSON.SET throughput by document size for every parser the module supports
+(see JSON.DEBUG PARSER). Times are taken from Redis' command statistics, so they cover the
+command itself and not the network.
+"""
+import argparse
+import json
+import random
+import string
+from urllib.parse import urlparse
+
+import redis
+
+SIZES = [1 << 10, 10 << 10, 100 << 10, 1 << 20, 10 << 20]
+
+
+def make_doc(size):
+    """A document mixing numbers, strings, arrays and nested objects, roughly `size` bytes long"""
+    rnd = random.Random(size)
+    items = []
+    length = 2
+    while length < size:
+        item = {
+            'id': rnd.randint(0, 1 << 40),
+            'name': ''.join(rnd.choice(string.ascii_letters) for _ in range(rnd.randint(4, 24))),
+            'price': round(rnd.uniform(0, 1000), 2),
+            'active': rnd.random() < 0.5,
+            'tags': [rnd.choice(['red', 'green', 'blue', 'new', 'sale']) for _ in range(3)],
+            'dims': {'w': rnd.randint(1, 100), 'h': rnd.randint(1, 100)},
+        }
+        length += len(json.dumps(item)) + 1
+        items.append(item)
+    return json.dumps(items)
+
+
+def usec_per_call(r):
+    stats = r.info('commandstats').get('cmdstat_json.set')
+    return stats['usec_per_call'] if stats else 0.0
+
+
+def run(r, parser, doc, count):
+    r.execute_command('JSON.DEBUG', 'PARSER', parser)
+    r.config_resetstat()
+    p = r.pipeline(transaction=False)
+    for i in range(count):
+        p.execute_command('JSON.SET', 'ingestbench:{}'.format(i % 16), '.', doc)
+    p.execute()
+    return usec_per_call(r)
+
+
+def human(size):
+    for unit in ['B', 'KB', 'MB']:
+        if size < 1024:
+            return '{}{}'.format(size, unit)
+        size //= 1024
+    return '{}GB'.format(size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ReJSON ingest benchmark',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-b', '--bytes', type=int, default=64 << 20, help='bytes to ingest per size and parser')
+    parser.add_argument('-u', '--uri', type=str, default='redis://localhost:6379', help='Redis server URI')
+    args = parser.parse_args()
+    uri = urlparse(args.uri)
+
+    r = redis.Redis(host=uri.hostname, port=uri.port, decode_responses=True)
+    parsers = ['SCALAR']
+    try:
+        r.execute_command('JSON.DEBUG', 'PARSER', 'SIMD')
+        parsers.append('SIMD')
+    except redis.ResponseError:
+        print('The SIMD parser is not supported by this build or CPU')
+
+    # Measure the parser on the main thread, not the time to hand it off to a worker
+    previous_parser = r.execute_command('JSON.DEBUG', 'PARSER')
+    previous_offload = r.execute_command('JSON.DEBUG', 'OFFLOAD')
+    r.execute_command('JSON.DEBUG', 'OFFLOAD', 0)
+    try:
+        print('{:>8} {:>8} {:>12} {:>10}'.format('size', 'parser', 'usec/call', 'MB/s'))
+        for size in SIZES:
+            doc = make_doc(size)
+            count = max(10, args.bytes // len(doc))
+            for name in parsers:
+                usec = run(r, name, doc, count)
+                print('{:>8} {:>8} {:>12.2f} {:>10.1f}'.format(
+                    human(size), name, usec, len(doc) / usec if usec else 0))
+        for i in range(16):
+            r.delete('ingestbench:{}'.format(i))
+    finally:
+        r.execute_command('JSON.DEBUG', 'PARSER', previous_parser)
+        r.execute_command('JSON.DEBUG', 'OFFLOAD', previous_offload)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Export and import the JSON keys of a server as NDJSON, one {"key": ..., "value": ...} object per
+line, e.g. to migrate them without the rest of the dataset.
+
+The export SCANs for keys of the module's type and hands batches of them to worker processes,
+which read them with pipelined JSON.MGET calls. The import hands batches of lines to workers,
+which write them with pipelined JSON.SET calls. Queues between the file and the workers are
+bounded, so memory use doesn't depend on the size of the dataset. Files ending in .gz, .bz2 or .xz
+are compressed.
+"""
+import argparse
+import bz2
+import gzip
+import json
+import lzma
+import multiprocessing
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+import redis
+
+TYPE = 'ReJSON-RL'
+
+OPENERS = {
+    '.gz': gzip.open,
+    '.bz2': bz2.open,
+    '.xz': lzma.open,
+}
+
+
+def open_file(name, mode):
+    """Opens a file, in binary mode, compressed according to its suffix"""
+    if name == '-':
+        return sys.stdout.buffer if 'w' in mode else sys.stdin.buffer
+    for suffix, opener in OPENERS.items():
+        if name.endswith(suffix):
+            return opener(name, mode + 'b')
+    return open(name, mode + 'b')
+
+
+def connect(ctx):
+    return redis.Redis(host=ctx['host'], port=ctx['port'], password=ctx['password'], db=ctx['db'],
+                       decode_responses=True)
+
+
+class Progress:
+    """Reports the keys and bytes done per second, every few seconds and at the end"""
+
+    def __init__(self, what):
+        self.what = what
+        self.keys = 0
+        self.bytes = 0
+        self.start = self.last = time.time()
+
+    def add(self, keys, size):
+        self.keys += keys
+        self.bytes += size
+        now = time.time()
+        if now - self.last >= 5:
+            self.last = now
+            self.report()
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        print('{} {} keys, {:.1f} MB in {:.1f} seconds: {:.0f} keys/sec, {:.1f} MB/sec'.format(
+            self.what, self.keys, self.bytes / 1e6, elapsed, self.keys / elapsed,
+            self.bytes / 1e6 / elapsed), file=sys.stderr)
+
+
+def run(ctx, worker, produce, consume):
+    """
+    Runs `worker` processes on the tasks `produce` yields, from a thread, and passes their results
+    to `consume`, until every worker is done
+    """
+    tasks = multiprocessing.Queue(ctx['workers'] * 2)
+    results = multiprocessing.Queue(ctx['workers'] * 2)
+    workers = [multiprocessing.Process(target=worker, args=(ctx, tasks, results))
+               for _ in range(ctx['workers'])]
+    for w in workers:
+        w.start()
+
+    def feed():
+        for task in produce():
+            tasks.put(task)
+        for _ in workers:
+            tasks.put(None)
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    done = 0
+    while done < len(workers):
+        result = results.get()
+        if result is None:
+            done += 1
+        else:
+            consume(result)
+    feeder.join()
+    for w in workers:
+        w.join()
+
+
+def export_worker(ctx, tasks, results):
+    r = connect(ctx)
+    while True:
+        keys = tasks.get()
+        if keys is None:
+            break
+        p = r.pipeline(transaction=False)
+        batches = [keys[i:i + ctx['batch']] for i in range(0, len(keys), ctx['batch'])]
+        for batch in batches:
+            p.execute_command('JSON.MGET', *batch, '.')
+        lines = []
+        for batch, values in zip(batches, p.execute()):
+            for key, value in zip(batch, values):
+                # Keys deleted since they were scanned are skipped
+                if value is not None:
+                    lines.append('{{"key":{},"value":{}}}\n'.format(json.dumps(key), value))
+        results.put((len(lines), ''.join(lines).encode()))
+    results.put(None)
+
+
+def export(ctx, out):
+    r = connect(ctx)
+    progress = Progress('Exported')
+
+    def produce():
+        # Each task is enough keys for a pipeline of JSON.MGET calls
+        size = ctx['batch'] * ctx['pipeline']
+        keys = []
+        for key in r.scan_iter(match=ctx['match'], count=ctx['batch'], _type=TYPE):
+            keys.append(key)
+            if len(keys) >= size:
+                yield keys
+                keys = []
+        if keys:
+            yield keys
+
+    def consume(result):
+        count, data = result
+        out.write(data)
+        progress.add(count, len(data))
+
+    run(ctx, export_worker, produce, consume)
+    progress.report()
+
+
+def import_worker(ctx, tasks, results):
+    r = connect(ctx)
+    options = ('NX', ) if ctx['nx'] else ()
+    while True:
+        lines = tasks.get()
+        if lines is None:
+            break
+        size = 0
+        p = r.pipeline(transaction=False)
+        for line in lines:
+            size += len(line)
+            record = json.loads(line)
+            value = json.dumps(record['value'], separators=(',', ':'), ensure_ascii=False)
+            p.execute_command('JSON.SET', record['key'], '.', value, *options)
+            if len(p) >= ctx['batch']:
+                p.execute()
+        p.execute()
+        results.put((len(lines), size))
+    results.put(None)
+
+
+def import_(ctx, inp):
+    progress = Progress('Imported')
+
+    def produce():
+        lines = []
+        for line in inp:
+            if line.strip():
+                lines.append(line)
+                if len(lines) >= ctx['batch'] * ctx['pipeline']:
+                    yield lines
+                    lines = []
+        if lines:
+            yield lines
+
+    run(ctx, import_worker, produce, lambda result: progress.add(*result))
+    progress.report()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ReJSON NDJSON export and import',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('command', choices=['export', 'import'], help='direction')
+    parser.add_argument('file', type=str,
+                        help='NDJSON file, compressed if it ends in .gz, .bz2 or .xz, or - for stdio')
+    parser.add_argument('-m', '--match', type=str, default=None, help='export the keys matching a pattern')
+    parser.add_argument('--nx', action='store_true', help="import only the keys that don't exist")
+    parser.add_argument('-w', '--workers', type=int, default=4, help='number of worker processes')
+    parser.add_argument('-b', '--batch', type=int, default=100,
+                        help='keys per JSON.MGET when exporting, and per pipeline when importing')
+    parser.add_argument('-p', '--pipeline', type=int, default=10,
+                        help='JSON.MGET calls per pipeline when exporting, pipelines per task when importing')
+    parser.add_argument('-u', '--uri', type=str, default='redis://localhost:6379', help='Redis server URI, as redis://[:password@]host:port[/db]')
+    args = parser.parse_args()
+    uri = urlparse(args.uri)
+
+    ctx = {
+        'host': uri.hostname,
+        'port': uri.port,
+        'password': uri.password,
+        'db': int(uri.path.lstrip('/') or 0),
+        'match': args.match,
+        'nx': args.nx,
+        'workers': args.workers,
+        'batch': args.batch,
+        'pipeline': args.pipeline,
+    }
+    if args.command == 'export':
+        with open_file(args.file, 'w') as out:
+            export(ctx, out)
+    else:
+        with open_file(args.file, 'r') as inp:
+            import_(ctx, inp)
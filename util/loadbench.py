@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Loader benchmark: documents per second when bulk loading with pipelined JSON.SET calls, compared
+with JSON.MSET batches of the same size.
+"""
+import argparse
+import json
+import time
+from urllib.parse import urlparse
+
+import redis
+
+
+def make_doc(i):
+    return json.dumps({
+        'id': i,
+        'name': 'user {}'.format(i),
+        'email': 'user{}@example.com'.format(i),
+        'age': i % 90,
+        'tags': ['a', 'b', 'c'],
+        'address': {'city': 'city {}'.format(i % 1000), 'zip': '{:05}'.format(i % 100000)},
+    })
+
+
+def load_set(r, docs, batch):
+    for start in range(0, len(docs), batch):
+        p = r.pipeline(transaction=False)
+        for i, doc in enumerate(docs[start:start + batch], start):
+            p.execute_command('JSON.SET', 'loadbench:{}'.format(i), '.', doc)
+        p.execute()
+
+
+def load_mset(r, docs, batch):
+    for start in range(0, len(docs), batch):
+        args = []
+        for i, doc in enumerate(docs[start:start + batch], start):
+            args += ['loadbench:{}'.format(i), '.', doc]
+        r.execute_command('JSON.MSET', *args)
+
+
+def run(r, loader, docs, batch):
+    r.flushdb()
+    s0 = time.time()
+    loader(r, docs, batch)
+    return len(docs) / (time.time() - s0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ReJSON loader benchmark',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-n', '--count', type=int, default=200000, help='number of documents')
+    parser.add_argument('-b', '--batches', type=str, default='10,100,1000', help='batch sizes')
+    parser.add_argument('-u', '--uri', type=str, default='redis://localhost:6379', help='Redis server URI')
+    args = parser.parse_args()
+    uri = urlparse(args.uri)
+
+    r = redis.Redis(host=uri.hostname, port=uri.port)
+    docs = [make_doc(i) for i in range(args.count)]
+
+    # Note: both loaders flush the selected database between runs
+    print('{:>8} {:>16} {:>16}'.format('batch', 'JSON.SET docs/s', 'JSON.MSET docs/s'))
+    for batch in [int(b) for b in args.batches.split(',')]:
+        set_rate = run(r, load_set, docs, batch)
+        mset_rate = run(r, load_mset, docs, batch)
+        print('{:>8} {:>16.0f} {:>16.0f}'.format(batch, set_rate, mset_rate))
+    r.flushdb()
@@ -1,77 +1,141 @@
-# Creates count of keys from a document
+#!/usr/bin/env python3
+"""
+Memory profiler: the memory taken by documents of every file of tests/files and of generated
+shapes (wide objects, deep nesting, numeric arrays, long strings), in a server of its own with the
+module loaded. For each case, reports the bytes per document, their ratio to the size of the raw
+JSON and the fragmentation, as a table, JSON or CSV. Run it against two builds and compare the
+outputs to find memory regressions.
+"""
 import argparse
-from urlparse import urlparse
+import csv
+import json
 import os
+import sys
+from urllib.parse import urlparse
+
 import redis
 
-# http://code.activestate.com/recipes/577081-humanized-representation-of-a-number-of-bytes/#c7
-def GetHumanReadable(size, precision=2):
-    suffixes = ['B ', 'KB', 'MB', 'GB', 'TB', 'PB', 'ZB']
-    suffixIndex = 0
-    while size > 1024:
-        suffixIndex += 1  # increment the index of the suffix
-        size = size / 1024.0  # apply the division
-    fmt = '{{:4.{}f}} {{}}'.format(precision)
-    return fmt.format(size, suffixes[suffixIndex])
+from disposableredis import DisposableRedis
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+FIELDS = ['case', 'raw_bytes', 'documents', 'bytes_per_doc', 'json_memory', 'overhead',
+          'fragmentation', 'allocator_fragmentation']
+
+
+def shapes():
+    """The generated cases, as (name, JSON) pairs"""
+    deep = 0
+    for _ in range(100):
+        deep = {'a': deep}
+    return [
+        ('wide object', json.dumps({'key{}'.format(i): i for i in range(10000)})),
+        ('deep nesting', json.dumps(deep)),
+        ('numeric array', json.dumps([i * 0.5 for i in range(10000)])),
+        ('integer array', json.dumps(list(range(10000)))),
+        ('long string', json.dumps('x' * (1 << 20))),
+        ('array of objects', json.dumps([{'id': i, 'name': 'item {}'.format(i), 'tags': ['a', 'b']}
+                                         for i in range(1000)])),
+    ]
+
+
+def files():
+    """The cases of tests/files, as (name, JSON) pairs"""
+    res = []
+    path = os.path.join(ROOT, 'tests', 'files')
+    for name in sorted(os.listdir(path)):
+        if name.startswith('pass-') and name.endswith('.json'):
+            with open(os.path.join(path, name)) as f:
+                res.append((name, f.read()))
+    return res
+
+
+def profile(r, name, doc, count):
+    """Sets `count` documents and returns the case's report"""
+    r.flushall()
+    before = r.info(section='memory')
+    p = r.pipeline(transaction=False)
+    for i in range(count):
+        p.execute_command('JSON.SET', 'memprof:{}'.format(i), '.', doc)
+        if len(p) >= 1000:
+            p.execute()
+    p.execute()
+    after = r.info(section='memory')
+    raw = len(doc.encode())
+    per_doc = (after['used_memory'] - before['used_memory']) / count
+    return {
+        'case': name,
+        'raw_bytes': raw,
+        'documents': count,
+        'bytes_per_doc': round(per_doc),
+        'json_memory': r.execute_command('JSON.DEBUG', 'MEMORY', 'memprof:0'),
+        'overhead': round(per_doc / raw, 2),
+        'fragmentation': after.get('mem_fragmentation_ratio'),
+        'allocator_fragmentation': after.get('allocator_frag_ratio'),
+    }
+
+
+def report(reports, fmt, out):
+    if fmt == 'json':
+        json.dump(reports, out, indent=2)
+        out.write('\n')
+    elif fmt == 'csv':
+        writer = csv.DictWriter(out, FIELDS, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(reports)
+    else:
+        out.write('| {:<32} | {:>9} | {:>9} | {:>13} | {:>8} | {:>13} |\n'.format(
+            'Case', 'Raw', 'Documents', 'Bytes per doc', 'Overhead', 'Fragmentation'))
+        out.write('| {} | {} | {} | {} | {} | {} |\n'.format(
+            '-' * 32, '-' * 9, '-' * 9, '-' * 13, '-' * 8, '-' * 13))
+        for rep in reports:
+            out.write('| {case:<32} | {raw_bytes:>9} | {documents:>9} | {bytes_per_doc:>13} | '
+                      '{overhead:>8} | {fragmentation:>13} |\n'.format(**rep))
+
+
+def run(r, args):
+    cases = []
+    if not args.no_files:
+        cases.extend(files())
+    if not args.no_shapes:
+        cases.extend(shapes())
+    reports = []
+    for name, doc in cases:
+        # Fewer copies of the larger documents, to keep the runs short
+        count = max(1, min(args.count, args.budget // len(doc)))
+        reports.append(profile(r, name, doc, count))
+        print('{}: {} documents'.format(name, count), file=sys.stderr)
+    return reports
+
 
 if __name__ == '__main__':
-    # handle arguments
-    parser = argparse.ArgumentParser(description='ReJSON memory profiler', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('file', type=str, default=None, help='JSON filename')
-    parser.add_argument('-u', '--uri', type=str, default=None, help='Redis server URI')
-    parser.add_argument('-s', '--steps', type=int, default=5, help='number of steps')
-    parser.add_argument('-c', '--count', type=int, default=1, help='initial count of documents')
+    parser = argparse.ArgumentParser(description='ReJSON memory profiler',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-m', '--module', type=str,
+                        default=os.path.join(ROOT, 'target', 'release', 'rejson.so'), help='module path')
+    parser.add_argument('-s', '--server', type=str, default='redis-server', help='redis-server path')
+    parser.add_argument('-u', '--uri', type=str, default=None,
+                        help='Redis server URI, to profile a running server instead (which is flushed)')
+    parser.add_argument('-c', '--count', type=int, default=1000, help='documents per case')
+    parser.add_argument('-b', '--budget', type=int, default=256 << 20,
+                        help='bytes of raw JSON per case, which limits the documents of large cases')
+    parser.add_argument('-f', '--format', type=str, default='table', choices=['table', 'json', 'csv'],
+                        help='report format')
+    parser.add_argument('-o', '--output', type=str, default=None, help='report file, stdout by default')
+    parser.add_argument('--no-files', action='store_true', help='skip the files of tests/files')
+    parser.add_argument('--no-shapes', action='store_true', help='skip the generated shapes')
     args = parser.parse_args()
+
     if args.uri is not None:
         uri = urlparse(args.uri)
+        reports = run(redis.Redis(host=uri.hostname, port=uri.port), args)
     else:
-        uri = None
-
-    # initialize
-    port = None
-    serverpath = os.path.abspath(os.path.join(os.getcwd(), '../../redis/src/redis-server'))
-    serverargs = {
-        'loadmodule': os.path.abspath(os.path.join(os.getcwd(), '../lib/rejson.so')),
-        'save': '',
-    }
+        server = DisposableRedis(path=args.server, unix=True, loadmodule=os.path.abspath(args.module))
+        with server as r:
+            reports = run(r, args)
 
-    with open(args.file) as f:
-        json = f.read()
-    
-    count = args.count
-    info = {
-        'before': [],
-        'after': [],
-    }
-
-    # TODO make client connect to an existing instance
-    # client = DisposableRedis(port=port, path=serverpath, **serverargs)
-    r = redis.StrictRedis()
-
-    # Print file and ReJSON sizes
-    r.execute_command('JSON.SET', 'json', '.', json)
-    print 'File size: {}'.format(GetHumanReadable(len(json)))
-    print 'As ReJSON: {}'.format(GetHumanReadable(r.execute_command('JSON.MEMORY', 'json')))
-    print
-
-    # do the steps
-    print '| Step | Documents | Dataset memory | Server memory |'
-    print '| ---- | --------- | -------------- | ------------- |'
-    for i in range(0, args.steps):
-        # with client as r:
-            # create documents
-            info['before'].append(r.info(section='memory'))
-            for j in range(0, count):
-                r.execute_command('JSON.SET', 'json:{}:{}'.format(i, j), '.', json)
-            info['after'].append(r.info(section='memory'))
-
-            # print report
-            row = [i + 1, count,
-                GetHumanReadable(info['after'][-1]['used_memory_dataset'] - info['before'][-1]['used_memory_dataset']),
-                GetHumanReadable(info['after'][-1]['used_memory'] - info['before'][-1]['used_memory'])]
-            fmt = '| {{:>4}} | {{:>{}}} | {{:>14}} | {{:>13}} |'.format(max(args.steps, 9))
-            print fmt.format(*row)
-
-            # wrap up
-            count = count * 10
-    print
+    if args.output:
+        with open(args.output, 'w', newline='') as out:
+            report(reports, args.format, out)
+    else:
+        report(reports, args.format, sys.stdout)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Mixed workload benchmark: tail latency of small JSON commands while other clients set and get a
+large document, with and without offloading large payloads to the module's worker pool.
+"""
+import argparse
+import json
+import multiprocessing
+import time
+from urllib.parse import urlparse
+
+import redis
+
+
+def make_doc(size):
+    """A document whose serialization is roughly `size` bytes"""
+    item = {'id': 0, 'name': 'x' * 32, 'tags': ['a', 'b', 'c'], 'score': 1.5}
+    count = max(1, size // len(json.dumps(item)))
+    return json.dumps({'items': [dict(item, id=i) for i in range(count)]})
+
+
+def big_worker(ctx):
+    r = redis.Redis(host=ctx['host'], port=ctx['port'])
+    key = 'mixedload:big:{}'.format(ctx['id'])
+    doc = ctx['doc']
+    ops = 0
+    deadline = time.time() + ctx['duration']
+    while time.time() < deadline:
+        r.execute_command('JSON.SET', key, '.', doc)
+        r.execute_command('JSON.GET', key)
+        ops += 2
+    return ops
+
+
+def small_worker(ctx):
+    r = redis.Redis(host=ctx['host'], port=ctx['port'])
+    key = 'mixedload:small:{}'.format(ctx['id'])
+    r.execute_command('JSON.SET', key, '.', '{"counter":0,"name":"small"}')
+    latencies = []
+    deadline = time.time() + ctx['duration']
+    while time.time() < deadline:
+        s0 = time.perf_counter()
+        r.execute_command('JSON.NUMINCRBY', key, '.counter', 1)
+        latencies.append(time.perf_counter() - s0)
+        s0 = time.perf_counter()
+        r.execute_command('JSON.GET', key, '.name')
+        latencies.append(time.perf_counter() - s0)
+    return latencies
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def run(args, uri, doc, threshold):
+    r = redis.Redis(host=uri.hostname, port=uri.port)
+    r.execute_command('JSON.DEBUG', 'OFFLOAD', threshold)
+
+    ctx = {
+        'host': uri.hostname,
+        'port': uri.port,
+        'duration': args.duration,
+        'doc': doc,
+    }
+    pool = multiprocessing.Pool(args.big_clients + args.small_clients)
+    big = pool.map_async(big_worker, [dict(ctx, id=i) for i in range(args.big_clients)])
+    small = pool.map_async(small_worker, [dict(ctx, id=i) for i in range(args.small_clients)])
+    big_ops = sum(big.get())
+    latencies = sorted(l for res in small.get() for l in res)
+    pool.close()
+    pool.join()
+
+    return {
+        'threshold': threshold,
+        'small_ops': len(latencies),
+        'big_ops': big_ops,
+        'p50': percentile(latencies, 50) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'p999': percentile(latencies, 99.9) * 1000,
+        'max': latencies[-1] * 1000,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ReJSON mixed workload benchmark',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-s', '--size', type=int, default=20, help='size of the large document in MB')
+    parser.add_argument('-b', '--big-clients', type=int, default=2, help='clients working on large documents')
+    parser.add_argument('-c', '--small-clients', type=int, default=8, help='clients sending small commands')
+    parser.add_argument('-d', '--duration', type=int, default=10, help='duration of each run in seconds')
+    parser.add_argument('-t', '--threshold', type=int, default=1 << 20, help='offload threshold in bytes')
+    parser.add_argument('-u', '--uri', type=str, default='redis://localhost:6379', help='Redis server URI')
+    args = parser.parse_args()
+    uri = urlparse(args.uri)
+
+    doc = make_doc(args.size << 20)
+    previous = redis.Redis(host=uri.hostname, port=uri.port).execute_command('JSON.DEBUG', 'OFFLOAD')
+    try:
+        results = [run(args, uri, doc, 0), run(args, uri, doc, args.threshold)]
+    finally:
+        redis.Redis(host=uri.hostname, port=uri.port).execute_command('JSON.DEBUG', 'OFFLOAD', previous)
+
+    print('Document: {} MB, large clients: {}, small clients: {}, duration: {} seconds'.format(
+        args.size, args.big_clients, args.small_clients, args.duration))
+    print('{:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'threshold', 'small ops', 'large ops', 'p50 ms', 'p99 ms', 'p99.9 ms', 'max ms'))
+    for res in results:
+        print('{threshold:>10} {small_ops:>10} {big_ops:>10} {p50:>10.3f} {p99:>10.3f} '
+              '{p999:>10.3f} {max:>10.3f}'.format(**res))
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Path benchmark: server-side cost of single-value commands with wildcard and recursive descent
+paths over a large document. Run it against two builds and compare the outputs, e.g. before and
+after a change to path evaluation.
+"""
+import argparse
+import json
+from urllib.parse import urlparse
+
+import redis
+
+PATHS = [
+    ('JSON.TYPE', '$.items[0].name'),
+    ('JSON.TYPE', '$.*[0].name'),
+    ('JSON.TYPE', '$.items[*].name'),
+    ('JSON.STRLEN', '$..name'),
+    ('JSON.ARRLEN', '$..tags'),
+    ('JSON.OBJLEN', '$..dims'),
+    ('JSON.GET', '$..price'),
+    ('JSON.TYPE', '$..missing'),
+]
+
+
+def make_doc(count):
+    return json.dumps({
+        'items': [{
+            'id': i,
+            'name': 'item {}'.format(i),
+            'price': i * 0.5,
+            'tags': ['a', 'b', 'c'],
+            'dims': {'w': i % 100, 'h': i % 10},
+        } for i in range(count)],
+    })
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ReJSON path benchmark',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-n', '--items', type=int, default=100000, help='number of items in the document')
+    parser.add_argument('-c', '--count', type=int, default=1000, help='calls per command and path')
+    parser.add_argument('-l', '--label', type=str, default='', help='label of this run, e.g. the build')
+    parser.add_argument('-u', '--uri', type=str, default='redis://localhost:6379', help='Redis server URI')
+    args = parser.parse_args()
+    uri = urlparse(args.uri)
+
+    r = redis.Redis(host=uri.hostname, port=uri.port, decode_responses=True)
+    r.execute_command('JSON.SET', 'pathbench', '.', make_doc(args.items))
+
+    print('label,command,path,usec_per_call')
+    for command, path in PATHS:
+        r.config_resetstat()
+        p = r.pipeline(transaction=False)
+        for _ in range(args.count):
+            p.execute_command(command, 'pathbench', path)
+        p.execute(raise_on_error=False)
+        stats = r.info('commandstats')['cmdstat_{}'.format(command.lower())]
+        print('{},{},{},{}'.format(args.label, command, path, stats['usec_per_call']))
+    r.delete('pathbench')
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Schema benchmark: throughput of writes to documents bound to a JSON Schema with JSON.SET ... SCHEMA,
+against the same writes to unbound documents. Covers whole documents, which are validated in full,
+subtree writes, which only validate what they change, and writes that fall back to validating the
+whole document.
+"""
+import argparse
+import json
+import time
+from urllib.parse import urlparse
+
+import redis
+
+SCHEMA = {
+    'type': 'object',
+    'required': ['id', 'name', 'items'],
+    'properties': {
+        'id': {'type': 'integer', 'minimum': 0},
+        'name': {'type': 'string', 'maxLength': 64},
+        'status': {'enum': ['new', 'paid', 'shipped']},
+        'items': {'type': 'array', 'items': {'$ref': '#/definitions/item'}, 'maxItems': 1000},
+        'note': {'anyOf': [{'type': 'string'}, {'type': 'null'}]},
+    },
+    'additionalProperties': False,
+    'definitions': {
+        'item': {
+            'type': 'object',
+            'required': ['sku', 'qty'],
+            'properties': {
+                'sku': {'type': 'string', 'pattern': '^[A-Z]{3}-[0-9]+$'},
+                'qty': {'type': 'integer', 'minimum': 1},
+                'price': {'type': 'number', 'exclusiveMinimum': 0},
+            },
+        },
+    },
+}
+
+
+def make_doc(i, count):
+    return json.dumps({
+        'id': i,
+        'name': 'order {}'.format(i),
+        'status': 'new',
+        'items': [{'sku': 'ABC-{}'.format(j), 'qty': 1 + j % 5, 'price': 1.5 * (j + 1)}
+                  for j in range(count)],
+        'note': None,
+    })
+
+
+def writes(key, i, count):
+    """The writes of one round, as (name, command) pairs"""
+    return [
+        ('set $', ('JSON.SET', key, '.', make_doc(i, count))),
+        ('set .status', ('JSON.SET', key, '.status', '"paid"')),
+        ('set .items[0].qty', ('JSON.SET', key, '.items[0].qty', '2')),
+        ('numincrby .id', ('JSON.NUMINCRBY', key, '.id', '1')),
+        ('set .note', ('JSON.SET', key, '.note', '"fragile"')),
+    ]
+
+
+def run(r, bound, keys, rounds, count):
+    """Returns the writes per second of every kind of write"""
+    for k in range(keys):
+        options = ('SCHEMA', 'orders') if bound else ()
+        r.execute_command('JSON.SET', 'schemabench:{}'.format(k), '.', make_doc(k, count), *options)
+
+    elapsed = {}
+    for n in range(rounds):
+        for k in range(keys):
+            for name, command in writes('schemabench:{}'.format(k), n, count):
+                start = time.perf_counter()
+                r.execute_command(*command)
+                elapsed[name] = elapsed.get(name, 0) + time.perf_counter() - start
+    return {name: rounds * keys / secs for name, secs in elapsed.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ReJSON schema validation benchmark',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-k', '--keys', type=int, default=100, help='number of documents')
+    parser.add_argument('-n', '--rounds', type=int, default=100, help='rounds of writes per document')
+    parser.add_argument('-i', '--items', type=int, default=50, help='array items per document')
+    parser.add_argument('-u', '--uri', type=str, default='redis://localhost:6379', help='Redis server URI')
+    args = parser.parse_args()
+    uri = urlparse(args.uri)
+
+    r = redis.Redis(host=uri.hostname, port=uri.port, decode_responses=True)
+    r.execute_command('JSON.SETSCHEMA', 'orders', json.dumps(SCHEMA))
+
+    plain = run(r, False, args.keys, args.rounds, args.items)
+    validated = run(r, True, args.keys, args.rounds, args.items)
+    r.delete(*['schemabench:{}'.format(k) for k in range(args.keys)])
+
+    print('write,unvalidated_ops,validated_ops,ratio')
+    for name in plain:
+        print('{},{:.0f},{:.0f},{:.2f}'.format(name, plain[name], validated[name],
+                                              validated[name] / plain[name]))
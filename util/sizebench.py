@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Document size benchmark: setting and getting the root and a scalar at a path of documents from
+tests/files and of synthetic documents from 100 B to 10 MB, with the module and with the Lua
+scripts of benchmarks/lua, which store the documents as JSON or MessagePack strings. The results
+of all the engines go to one CSV, and the rates of the module relative to the fastest script are
+printed per document, to show the sizes from which keeping documents as trees pays off.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import sys
+import time
+from urllib.parse import urlparse
+
+import redis
+import redis.asyncio
+
+from benchmark import Histogram, PERCENTILES
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# Documents of tests/files, with the path of a scalar in each, as keys and array indexes
+FILES = [
+    ('pass-100.json', ['sclr']),
+    ('pass-jsonsl-1.json', [8, 'zero']),
+    ('pass-json-parser-0000.json', ['web-app', 'servlet', 0, 'servlet-name']),
+    ('pass-jsonsl-yahoo2.json', ['ResultSet', 'totalResultsAvailable']),
+    ('pass-jsonsl-yelp.json', ['message', 'code']),
+]
+
+SIZES = [100, 1 << 10, 10 << 10, 100 << 10, 1 << 20, 10 << 20]
+
+ENGINES = ['module', 'lua-json', 'lua-msgpack']
+
+OPS = ['set root', 'get root', 'set path', 'get path']
+
+CSV_HEADER = ['engine', 'document', 'op', 'size', 'concurrency', 'rate', 'avgLatency'] + \
+    ['{:.2f}%-tile'.format(p) for p in PERCENTILES]
+
+
+def make_doc(size):
+    """A document whose serialization is roughly `size` bytes, with a number at `.meta.count`"""
+    item = {'id': 0, 'name': 'x' * 16, 'tags': ['a', 'b'], 'score': 1.5}
+    count = max(1, (size - 30) // (len(json.dumps(item, separators=(',', ':'))) + 1))
+    return {'meta': {'count': count}, 'items': [dict(item, id=i) for i in range(count)]}
+
+
+def documents(files, sizes):
+    """The documents to run, as (name, JSON, path) tuples"""
+    res = []
+    for name, path in FILES:
+        if name in files:
+            with open(os.path.join(ROOT, 'tests', 'files', name)) as f:
+                res.append((name, json.dumps(json.load(f), separators=(',', ':')), path))
+    for size in sizes:
+        res.append(('synthetic {} B'.format(size), json.dumps(make_doc(size), separators=(',', ':')),
+                    ['meta', 'count']))
+    return res
+
+
+def module_path(path):
+    """The module's path of a list of keys and indexes"""
+    res = ''
+    for token in path:
+        if isinstance(token, int):
+            res += '[{}]'.format(token)
+        elif token.isidentifier():
+            res += '.' + token
+        else:
+            res += '[{}]'.format(json.dumps(token))
+    return res or '.'
+
+
+def load_scripts(r):
+    """Loads the scripts of benchmarks/lua, like its load-scripts.sh, and returns their hashes"""
+    shas = {}
+    lua = os.path.join(ROOT, 'benchmarks', 'lua')
+    for name in sorted(os.listdir(lua)):
+        if name.endswith('.lua'):
+            with open(os.path.join(lua, name)) as f:
+                shas[name[:-len('.lua')]] = r.script_load(f.read())
+    return shas
+
+
+def commands(engine, shas, key, doc, path, value):
+    """The commands of every op with an engine"""
+    if engine == 'module':
+        mpath = module_path(path)
+        return {
+            'set root': ('JSON.SET', key, '.', doc),
+            'get root': ('JSON.GET', key, '.'),
+            'set path': ('JSON.SET', key, mpath, value),
+            'get path': ('JSON.GET', key, mpath),
+        }
+    prefix = engine[len('lua-'):]
+    tokens = [str(token) for token in path]
+    return {
+        'set root': ('EVALSHA', shas[prefix + '-set-root'], 1, key, doc),
+        'get root': ('EVALSHA', shas[prefix + '-get-root'], 1, key),
+        'set path': ('EVALSHA', shas[prefix + '-set-path'], 1, key, *tokens, value),
+        'get path': ('EVALSHA', shas[prefix + '-get-path'], 1, key, *tokens),
+    }
+
+
+async def connection(ctx, command, hist, deadline):
+    r = redis.asyncio.Redis(host=ctx['host'], port=ctx['port'])
+    try:
+        while time.perf_counter() < deadline:
+            s0 = time.perf_counter()
+            await r.execute_command(*command)
+            hist.record((time.perf_counter() - s0) * 1e6)
+    finally:
+        await r.close()
+
+
+async def measure(ctx, command):
+    """Runs `command` from all the connections for the duration, and returns its histogram"""
+    hist = Histogram()
+    deadline = time.perf_counter() + ctx['duration']
+    await asyncio.gather(*(connection(ctx, command, hist, deadline)
+                           for _ in range(ctx['connections'])))
+    return hist
+
+
+def run(r, ctx, shas, name, doc, path):
+    """Returns the rows of a document, with every engine and op"""
+    key = 'sizebench:{}'.format(name)
+    value = json.loads(doc)
+    for token in path:
+        value = value[token]
+    value = json.dumps(value)
+    rows = []
+    for engine in ctx['engines']:
+        cmds = commands(engine, shas, key, doc, path, value)
+        r.execute_command(*cmds['set root'])
+        for op in OPS:
+            hist = asyncio.run(measure(ctx, cmds[op]))
+            rate = hist.count / ctx['duration']
+            rows.append([engine, name, op, len(doc), ctx['connections'], rate,
+                         hist.mean() / 1000] + [hist.percentile(p) / 1000 for p in PERCENTILES])
+            print('{:<12} {:<28} {:<9} {:>12.2f} ops/sec'.format(engine, name, op, rate))
+            sys.stdout.flush()
+        r.delete(key)
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ReJSON document size benchmark',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-f', '--files', type=str, nargs='*', default=[name for name, _ in FILES],
+                        help='documents of tests/files')
+    parser.add_argument('-s', '--sizes', type=int, nargs='*', default=SIZES,
+                        help='sizes of the synthetic documents in bytes')
+    parser.add_argument('-e', '--engines', type=str, nargs='*', default=ENGINES, choices=ENGINES,
+                        help='engines to compare')
+    parser.add_argument('-n', '--connections', type=int, default=16, help='concurrent connections')
+    parser.add_argument('-d', '--duration', type=float, default=2, help='seconds per measurement')
+    parser.add_argument('-o', '--output', type=str, default='sizebench.csv', help='CSV file')
+    parser.add_argument('-u', '--uri', type=str, default='redis://localhost:6379', help='Redis server URI')
+    args = parser.parse_args()
+    uri = urlparse(args.uri)
+
+    r = redis.Redis(host=uri.hostname, port=uri.port, decode_responses=True)
+    shas = load_scripts(r)
+    ctx = {
+        'host': uri.hostname,
+        'port': uri.port,
+        'connections': args.connections,
+        'duration': args.duration,
+        'engines': args.engines,
+    }
+
+    docs = documents(args.files, args.sizes)
+    rows = []
+    for name, doc, path in docs:
+        rows.extend(run(r, ctx, shas, name, doc, path))
+
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(CSV_HEADER)
+        for row in rows:
+            writer.writerow(row[:5] + ['{:.2f}'.format(v) for v in row[5:]])
+
+    if 'module' in args.engines and len(args.engines) > 1:
+        rates = {(row[0], row[1], row[2]): row[5] for row in rows}
+        print()
+        print('Module rate relative to the fastest script')
+        print('{:<28} {:>10} '.format('document', 'size') + ' '.join('{:>9}'.format(op) for op in OPS))
+        for name, doc, _ in docs:
+            ratios = []
+            for op in OPS:
+                best = max(rates[(engine, name, op)] for engine in args.engines if engine != 'module')
+                ratios.append(rates[('module', name, op)] / best if best else float('inf'))
+            print('{:<28} {:>10} '.format(name, len(doc)) +
+                  ' '.join('{:>9.2f}'.format(ratio) for ratio in ratios))